@@ -0,0 +1,47 @@
+"""add message full text search
+
+Revision ID: 18e4607e5e6c
+Revises: bcb85f8bbb2f
+Create Date: 2026-10-18 11:03:27.548120
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '18e4607e5e6c'
+down_revision: Union[str, Sequence[str], None] = 'bcb85f8bbb2f'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    dialect = op.get_bind().dialect.name
+    if dialect == 'postgresql':
+        # Stored generated column: maintained by Postgres on every insert.
+        op.execute(
+            "ALTER TABLE messages ADD COLUMN content_tsv tsvector "
+            "GENERATED ALWAYS AS (to_tsvector('simple', content)) STORED"
+        )
+        op.execute("CREATE INDEX ix_messages_content_tsv ON messages USING gin (content_tsv)")
+    elif dialect == 'sqlite':
+        # External-content FTS5 table, filled by the crud write path.
+        op.execute(
+            "CREATE VIRTUAL TABLE messages_fts USING fts5("
+            "content, content='messages', content_rowid='id')"
+        )
+        op.execute("INSERT INTO messages_fts(rowid, content) SELECT id, content FROM messages")
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    dialect = op.get_bind().dialect.name
+    if dialect == 'postgresql':
+        op.execute("DROP INDEX ix_messages_content_tsv")
+        op.drop_column('messages', 'content_tsv')
+    elif dialect == 'sqlite':
+        op.execute("DROP TABLE messages_fts")
@@ -0,0 +1,119 @@
+"""partition messages by month and add room retention
+
+Revision ID: 5c2e8a1f9d34
+Revises: 18e4607e5e6c
+Create Date: 2026-10-18 12:41:09.204511
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '5c2e8a1f9d34'
+down_revision: Union[str, Sequence[str], None] = '18e4607e5e6c'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+MESSAGE_COLUMNS = "id, room_id, user_id, role, content, created_at"
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    with op.batch_alter_table('chatrooms') as batch_op:
+        batch_op.add_column(sa.Column('retention_days', sa.Integer(), nullable=True))
+
+    if op.get_bind().dialect.name == 'sqlite':
+        # AUTOINCREMENT, so ids of archived messages are never handed out again.
+        with op.batch_alter_table('messages', recreate='always', table_kwargs={'sqlite_autoincrement': True}):
+            pass
+        return
+
+    # Swap the heap table for one range-partitioned by month on created_at.
+    # The primary key must include the partition key; ids still come from
+    # messages_id_seq, so they stay unique on their own.
+    op.execute("DROP INDEX ix_messages_content_tsv")
+    op.execute("DROP INDEX ix_messages_room_id_id")
+    op.execute("DROP INDEX ix_messages_id")
+    op.execute("ALTER TABLE messages RENAME TO messages_unpartitioned")
+    op.execute("ALTER INDEX messages_pkey RENAME TO messages_unpartitioned_pkey")
+    op.execute("""
+        CREATE TABLE messages (
+            id integer NOT NULL DEFAULT nextval('messages_id_seq'::regclass),
+            room_id integer NOT NULL REFERENCES chatrooms (id),
+            user_id integer REFERENCES users (id),
+            role varchar,
+            content text NOT NULL,
+            created_at timestamptz NOT NULL DEFAULT now(),
+            content_tsv tsvector GENERATED ALWAYS AS (to_tsvector('simple', content)) STORED,
+            PRIMARY KEY (id, created_at)
+        ) PARTITION BY RANGE (created_at)
+    """)
+    # One partition per month from the oldest message to three months ahead
+    # (UTC boundaries, matching app.retention.ensure_partitions), plus a
+    # default partition so inserts never fail if maintenance falls behind.
+    op.execute("""
+        DO $$
+        DECLARE month timestamptz;
+        BEGIN
+            FOR month IN
+                SELECT generate_series(
+                    date_trunc('month', coalesce(min(created_at), now()), 'UTC'),
+                    date_trunc('month', now(), 'UTC') + interval '3 months',
+                    interval '1 month'
+                ) FROM messages_unpartitioned
+            LOOP
+                EXECUTE format(
+                    'CREATE TABLE %I PARTITION OF messages FOR VALUES FROM (%L) TO (%L)',
+                    'messages_' || to_char(month AT TIME ZONE 'UTC', 'YYYY_MM'),
+                    month,
+                    month + interval '1 month'
+                );
+            END LOOP;
+        END $$
+    """)
+    op.execute("CREATE TABLE messages_default PARTITION OF messages DEFAULT")
+    op.execute(
+        f"INSERT INTO messages ({MESSAGE_COLUMNS}) "
+        f"SELECT id, room_id, user_id, role, content, coalesce(created_at, now()) FROM messages_unpartitioned"
+    )
+    op.execute("ALTER SEQUENCE messages_id_seq OWNED BY messages.id")
+    op.execute("DROP TABLE messages_unpartitioned")
+    op.execute("CREATE INDEX ix_messages_id ON messages (id)")
+    op.execute("CREATE INDEX ix_messages_room_id_id ON messages (room_id, id)")
+    op.execute("CREATE INDEX ix_messages_content_tsv ON messages USING gin (content_tsv)")
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    if op.get_bind().dialect.name == 'postgresql':
+        op.execute("ALTER TABLE messages RENAME TO messages_partitioned")
+        op.execute("ALTER INDEX ix_messages_id RENAME TO ix_messages_partitioned_id")
+        op.execute("ALTER INDEX ix_messages_room_id_id RENAME TO ix_messages_partitioned_room_id_id")
+        op.execute("ALTER INDEX ix_messages_content_tsv RENAME TO ix_messages_partitioned_content_tsv")
+        op.execute("ALTER INDEX messages_pkey RENAME TO messages_partitioned_pkey")
+        op.execute("""
+            CREATE TABLE messages (
+                id integer NOT NULL DEFAULT nextval('messages_id_seq'::regclass) PRIMARY KEY,
+                room_id integer NOT NULL REFERENCES chatrooms (id),
+                user_id integer REFERENCES users (id),
+                role varchar,
+                content text NOT NULL,
+                created_at timestamptz DEFAULT now(),
+                content_tsv tsvector GENERATED ALWAYS AS (to_tsvector('simple', content)) STORED
+            )
+        """)
+        op.execute(
+            f"INSERT INTO messages ({MESSAGE_COLUMNS}) "
+            f"SELECT {MESSAGE_COLUMNS} FROM messages_partitioned"
+        )
+        op.execute("ALTER SEQUENCE messages_id_seq OWNED BY messages.id")
+        op.execute("DROP TABLE messages_partitioned CASCADE")
+        op.execute("CREATE INDEX ix_messages_id ON messages (id)")
+        op.execute("CREATE INDEX ix_messages_room_id_id ON messages (room_id, id)")
+        op.execute("CREATE INDEX ix_messages_content_tsv ON messages USING gin (content_tsv)")
+
+    with op.batch_alter_table('chatrooms') as batch_op:
+        batch_op.drop_column('retention_days')
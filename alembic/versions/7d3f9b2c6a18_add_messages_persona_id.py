@@ -0,0 +1,33 @@
+"""add messages persona_id
+
+Revision ID: 7d3f9b2c6a18
+Revises: 5c2e8a1f9d34
+Create Date: 2026-10-18 16:05:27.381940
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '7d3f9b2c6a18'
+down_revision: Union[str, Sequence[str], None] = '5c2e8a1f9d34'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    # On Postgres the column and its foreign key propagate to every partition.
+    with op.batch_alter_table('messages', table_kwargs={'sqlite_autoincrement': True}) as batch_op:
+        batch_op.add_column(sa.Column('persona_id', sa.Integer(), nullable=True))
+        batch_op.create_foreign_key('fk_messages_persona_id_personas', 'personas', ['persona_id'], ['id'])
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    with op.batch_alter_table('messages', table_kwargs={'sqlite_autoincrement': True}) as batch_op:
+        batch_op.drop_constraint('fk_messages_persona_id_personas', type_='foreignkey')
+        batch_op.drop_column('persona_id')
@@ -0,0 +1,28 @@
+"""add messages room_id id index
+
+Revision ID: bcb85f8bbb2f
+Revises: ef1b68041e17
+Create Date: 2026-10-18 09:12:41.205316
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'bcb85f8bbb2f'
+down_revision: Union[str, Sequence[str], None] = 'ef1b68041e17'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.create_index('ix_messages_room_id_id', 'messages', ['room_id', 'id'], unique=False)
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_index('ix_messages_room_id_id', table_name='messages')
@@ -1,4 +1,4 @@
-from fastapi import FastAPI, HTTPException,  WebSocket, WebSocketDisconnect, Query
+from fastapi import FastAPI, HTTPException,  WebSocket, WebSocketDisconnect, Query, status
 from fastapi.responses import FileResponse
 import logging
 import uvicorn
@@ -6,11 +6,26 @@ import time
 import asyncio
 import datetime
 
+from app import codec
+from app.broadcast import Connection, ConnectionRegistry
+from app.heartbeat import Heartbeat, is_pong
+from app.presence import Presence
+from app.ratelimit import DISCONNECT, DROP, NOTICE_KEY, RateLimiter, notice
+from app.backplane import create_backplane
+
 logger = logging.getLogger(__file__)
 
 app = FastAPI()
-clients: dict[str, 'Client'] = {}
+# a user may be connected from several devices at once
+clients = ConnectionRegistry()
 room_queue: asyncio.Queue['Message'] = asyncio.Queue()
+backplane = create_backplane()
+rate_limiter = RateLimiter()
+# membership only: app.py still announces joins and leaves as chat events
+presence = Presence()
+heartbeat = Heartbeat()
+# app.py serves a single room
+ROOM = "lobby"
 
 
 class Message:
@@ -25,36 +40,44 @@ class Message:
 
 
 class Client:
-    def __init__(self, user_id: str):
+    def __init__(self, user_id: str, ws: WebSocket):
         self.user_id = user_id
-        self.tx: asyncio.Queue[Message] = asyncio.Queue()
+        self.tx = Connection(ws.send_text, lambda code: ws.close(code=code))
+        self.limits = rate_limiter.connection_bucket()
 
-    def send(self, message: Message):
-        self.tx.put_nowait(message)
+    def send(self, frame: str, key=None):
+        self.tx.enqueue(frame, key)
 
     async def task_recv_from_client(self, ws: WebSocket, rx: asyncio.Queue[Message]):
         while True:
             text = await ws.receive_text()
+            if is_pong(text):
+                heartbeat.seen(self.tx, pong=True)
+                continue
+            heartbeat.seen(self.tx)
+            verdict, retry_after = await rate_limiter.acquire(self.user_id, ROOM, self.limits)
+            if verdict == DROP:
+                self.send(codec.dumps(notice(retry_after)), NOTICE_KEY)
+                continue
+            if verdict == DISCONNECT:
+                logging.info(f"ws: {self.user_id} disconnected for flooding")
+                await ws.close(code=status.WS_1008_POLICY_VIOLATION)
+                return
             message = Message(sender=self.user_id,
                               text=text, ctime=datetime.datetime.now())
             await rx.put(message)
 
-    async def task_send_to_client(self, ws: WebSocket):
-        while True:
-            message = await self.tx.get()
-            if not message:
-                return
-            await ws.send_json(message.to_json())
-
     async def serve(self, ws: WebSocket, tx: asyncio.Queue[Message]):
+        self.tx.start()
+        heartbeat.track(self.tx, ROOM)
         try:
-            await asyncio.gather(self.task_recv_from_client(ws, tx),
-                                 self.task_send_to_client(ws))
+            await self.task_recv_from_client(ws, tx)
         except WebSocketDisconnect:
             logging.info(f"ws: {self.user_id} disconnected")
         finally:
-            # send None to signal the end of the `task_send_to_client`
-            self.tx.put_nowait(None)
+            # stop the writer task; frames still queued for a gone client are dropped
+            heartbeat.untrack(self.tx)
+            await self.tx.close()
             ws.close()
 
 
@@ -65,26 +88,35 @@ async def chat(ws: WebSocket, user_id: str = Query(title="User ID", description=
 
     await ws.accept()
 
-    if user_id in clients:
-        return HTTPException(status_code=400, detail="User ID already exists")
-
-    clients[user_id] = Client(user_id)
-    join_message = Message(
-        sender="@system", text=f"{user_id} joined", ctime=time.time(), event_type="join")
-    await room_queue.put(join_message)
+    client = Client(user_id, ws)
+    # only the user's first device announces a join, and the last one a leave
+    first = not clients.user_connections(user_id, ROOM)
+    clients.join(ROOM, client.tx, user_id)
+    presence.join(ROOM, user_id, user_id)
+    if first:
+        join_message = Message(
+            sender="@system", text=f"{user_id} joined", ctime=time.time(), event_type="join")
+        await room_queue.put(join_message)
 
     try:
-        await clients[user_id].serve(ws, room_queue)
+        await client.serve(ws, room_queue)
     finally:
-        del clients[user_id]
-        leave_message = Message(
-            sender="@system", text=f"{user_id} leave", ctime=time.time(), event_type="leave")
-        await room_queue.put(leave_message)
+        clients.leave(ROOM, client.tx)
+        presence.leave(ROOM, user_id)
+        if not clients.user_connections(user_id, ROOM):
+            leave_message = Message(
+                sender="@system", text=f"{user_id} leave", ctime=time.time(), event_type="leave")
+            await room_queue.put(leave_message)
 
 
 @app.get("/clients")
 async def get_clients():
-    return clients.keys()
+    return {"count": presence.count(ROOM), "members": [m["user_id"] for m in presence.members(ROOM)]}
+
+
+@app.get("/metrics")
+async def metrics():
+    return {"clients": clients.stats(), "rate_limit": rate_limiter.stats(), "presence": presence.stats(), "heartbeat": heartbeat.stats()}
 
 
 @app.get("/")
@@ -99,15 +131,18 @@ async def dispatch_message():
         if not msg:
             return
 
-        for client in clients.values():
-            try:
-                client.send(msg)
-            except Exception as e:
-                del clients[client.user_id]
-                logging.error(e)
+        # encode once; the backplane hands the same frame to every worker
+        await backplane.publish(ROOM, codec.dumps(msg.to_json()))
+
+
+def deliver(room: str, frame: str, message=None):
+    clients.broadcast(ROOM, frame)
 
 
 async def run_app():
+    await backplane.start(deliver)
+    await backplane.subscribe(ROOM)
+    await heartbeat.start()
     asyncio.create_task(dispatch_message())
     server = uvicorn.Server(uvicorn.Config(app, host='0.0.0.0', port=8000))
 
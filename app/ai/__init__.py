@@ -0,0 +1,23 @@
+"""AI personas: providers, response cache, prompt context, generation engine, turn-taking and routing."""
+from app.ai.context import ContextStore, RoomContext, count_tokens
+from app.ai.engine import Generation, PersonaEngine
+from app.ai.providers import GenerationRequest, Provider, StubProvider, create_provider
+from app.ai.response_cache import CachingProvider, ResponseCache
+from app.ai.routing import PersonaRouter
+from app.ai.turns import TurnScheduler
+
+__all__ = [
+    "CachingProvider",
+    "ContextStore",
+    "Generation",
+    "GenerationRequest",
+    "PersonaEngine",
+    "PersonaRouter",
+    "Provider",
+    "ResponseCache",
+    "RoomContext",
+    "StubProvider",
+    "TurnScheduler",
+    "count_tokens",
+    "create_provider",
+]
@@ -0,0 +1,170 @@
+"""Per-room prompt context for persona generations.
+
+A ``RoomContext`` holds the recent turns of one room with their token counts
+and a running total. Every message delivered to the room is appended as it
+arrives and the oldest turns are evicted to stay within ``AI_CONTEXT_TOKENS``
+(and ``AI_CONTEXT_MESSAGES``), so building a prompt never re-reads history or
+re-counts tokens. The rendered persona/theme preamble is cached per persona
+and only re-rendered when the persona or the room's theme changes.
+
+Contexts are built from the history cache or the database the first time a
+persona speaks in a room; like the history cache, they are only kept while
+this worker sees all of the room's messages.
+"""
+from collections import OrderedDict, deque
+from typing import Deque, Dict, Hashable, Iterable, Optional, Set, Tuple
+import os
+import re
+
+from app import models
+from app.ai.providers import AI_MAX_TOKENS, GenerationRequest
+
+AI_CONTEXT_TOKENS = int(os.getenv("AI_CONTEXT_TOKENS", "2000"))
+AI_CONTEXT_MESSAGES = int(os.getenv("AI_CONTEXT_MESSAGES", "50"))
+AI_CONTEXT_ROOMS = int(os.getenv("AI_CONTEXT_ROOMS", "1000"))
+
+TOKEN_PATTERN = re.compile(r"\w+|[^\w\s]")
+
+
+def count_tokens(text: str) -> int:
+    # Words and punctuation marks: close enough to BPE counts for budgeting.
+    return len(TOKEN_PATTERN.findall(text))
+
+
+class RoomContext:
+    def __init__(
+        self,
+        room_id: Hashable,
+        theme: Optional[str] = None,
+        theme_description: Optional[str] = None,
+        budget: int = AI_CONTEXT_TOKENS,
+        max_turns: int = AI_CONTEXT_MESSAGES
+    ):
+        self.room_id = room_id
+        self.budget = budget
+        self.max_turns = max_turns
+        self.turns: Deque[dict] = deque()
+        self.tokens = 0
+        self._ids: Set[int] = set()
+        self.theme = theme
+        self.theme_description = theme_description
+        # persona id -> (persona fields it was rendered from, text, tokens)
+        self._preambles: Dict[int, Tuple[tuple, str, int]] = {}
+        self.evicted = 0
+
+    def add(self, entry: dict) -> None:
+        if entry["id"] in self._ids:
+            return
+        turn = {
+            "id": entry["id"],
+            "username": entry.get("username"),
+            "role": entry["role"],
+            "content": entry["content"],
+            "tokens": count_tokens(entry["content"]),
+        }
+        self.turns.append(turn)
+        self._ids.add(turn["id"])
+        self.tokens += turn["tokens"]
+        # The newest turn always stays, even if it alone is over budget.
+        while len(self.turns) > 1 and (self.tokens > self.budget or len(self.turns) > self.max_turns):
+            oldest = self.turns.popleft()
+            self._ids.discard(oldest["id"])
+            self.tokens -= oldest["tokens"]
+            self.evicted += 1
+
+    def set_theme(self, theme: Optional[str], description: Optional[str] = None) -> None:
+        if (theme, description) != (self.theme, self.theme_description):
+            self.theme = theme
+            self.theme_description = description
+            self._preambles.clear()
+
+    def preamble(self, persona: models.Persona) -> Tuple[str, int]:
+        source = (persona.name, persona.system_prompt, persona.style)
+        cached = self._preambles.get(persona.id)
+        if cached is not None and cached[0] == source:
+            return cached[1], cached[2]
+        lines = [f"You are {persona.name}."]
+        if persona.system_prompt:
+            lines.append(persona.system_prompt)
+        if persona.style:
+            lines.append(f"Style: {persona.style}")
+        if self.theme:
+            lines.append(f"Room theme: {self.theme}" + (f" - {self.theme_description}" if self.theme_description else ""))
+        text = "\n".join(lines)
+        tokens = count_tokens(text)
+        self._preambles[persona.id] = (source, text, tokens)
+        return text, tokens
+
+    def request(self, persona: models.Persona, max_tokens: int = AI_MAX_TOKENS) -> GenerationRequest:
+        preamble, preamble_tokens = self.preamble(persona)
+        return GenerationRequest(
+            self.room_id, persona.id, persona.name, preamble, list(self.turns), max_tokens,
+            preamble_tokens + self.tokens
+        )
+
+
+class ContextStore:
+    """LRU-bounded ``RoomContext`` per room, fed by every delivered message."""
+
+    def __init__(
+        self,
+        max_rooms: int = AI_CONTEXT_ROOMS,
+        budget: int = AI_CONTEXT_TOKENS,
+        max_turns: int = AI_CONTEXT_MESSAGES
+    ):
+        self.max_rooms = max_rooms
+        self.budget = budget
+        self.max_turns = max_turns
+        self._rooms: "OrderedDict[Hashable, RoomContext]" = OrderedDict()
+        self.builds = 0
+        self.hits = 0
+
+    def get(self, room_id: Hashable) -> Optional[RoomContext]:
+        context = self._rooms.get(room_id)
+        if context is not None:
+            self._rooms.move_to_end(room_id)
+            self.hits += 1
+        return context
+
+    def seed(
+        self,
+        room_id: Hashable,
+        theme: Optional[str],
+        theme_description: Optional[str],
+        entries: Iterable[dict]
+    ) -> RoomContext:
+        """Build a room's context from its recent messages, oldest first."""
+        context = RoomContext(room_id, theme, theme_description, self.budget, self.max_turns)
+        for entry in entries:
+            self._add(context, entry)
+        self._rooms[room_id] = context
+        self._rooms.move_to_end(room_id)
+        self.builds += 1
+        while len(self._rooms) > self.max_rooms:
+            self._rooms.popitem(last=False)
+        return context
+
+    def observe(self, room_id: Hashable, entry: dict) -> None:
+        context = self._rooms.get(room_id)
+        if context is not None:
+            self._add(context, entry)
+
+    def discard(self, room_id: Hashable) -> None:
+        self._rooms.pop(room_id, None)
+
+    def clear(self) -> None:
+        self._rooms.clear()
+
+    def stats(self) -> dict:
+        return {
+            "rooms": len(self._rooms),
+            "turns": sum(len(c.turns) for c in self._rooms.values()),
+            "tokens": sum(c.tokens for c in self._rooms.values()),
+            "builds": self.builds,
+            "hits": self.hits,
+        }
+
+    def _add(self, context: RoomContext, entry: dict) -> None:
+        # Join/leave notices are not part of the conversation.
+        if entry["role"] != "system":
+            context.add(entry)
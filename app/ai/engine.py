@@ -0,0 +1,317 @@
+"""Persona generation engine.
+
+Generations run on a fixed pool of ``AI_WORKERS`` worker tasks, so the number
+of concurrent provider calls is bounded no matter how many rooms are active.
+Each room has its own FIFO queue and workers take rooms round-robin: a hot
+room with a long queue gets one turn per cycle like every other room, so it
+cannot starve quiet ones. On top of that, each room is limited to
+``AI_ROOM_CONCURRENCY`` running generations and ``AI_ROOM_MAX_PENDING``
+queued ones, and may spend at most ``AI_ROOM_TOKEN_BUDGET`` tokens per minute
+(0 disables the budget). ``cancel_room`` drops a room's queue and cancels its
+running generations, e.g. when the last socket leaves.
+
+Tokens are handed to ``on_delta`` as they stream in, coalesced so that it is
+called at most once per ``AI_STREAM_INTERVAL_MS`` (the first token is passed
+on at once). Time to first token is recorded per persona, both from
+submission and from the start of the provider call.
+"""
+from collections import deque
+from typing import Awaitable, Callable, Deque, Dict, Hashable, List, Optional, Set, Tuple
+import asyncio
+import logging
+import os
+import uuid
+
+from app.ai.providers import GenerationRequest, Provider, create_provider
+from app.metrics import percentile
+
+logger = logging.getLogger(__name__)
+
+AI_WORKERS = int(os.getenv("AI_WORKERS", "4"))
+AI_ROOM_CONCURRENCY = int(os.getenv("AI_ROOM_CONCURRENCY", "1"))
+AI_ROOM_MAX_PENDING = int(os.getenv("AI_ROOM_MAX_PENDING", "8"))
+AI_ROOM_TOKEN_BUDGET = int(os.getenv("AI_ROOM_TOKEN_BUDGET", "0"))
+AI_STREAM_INTERVAL_MS = int(os.getenv("AI_STREAM_INTERVAL_MS", "50"))
+AI_BUDGET_WINDOW_SECONDS = 60
+# Recent time-to-first-token samples kept per persona for percentiles.
+AI_TTFT_SAMPLES = 256
+
+OnComplete = Callable[["Generation"], Awaitable[None]]
+OnDelta = Callable[["Generation", str], Awaitable[None]]
+
+
+class Generation:
+    """One queued or running persona reply; await it for the full text."""
+
+    def __init__(
+        self,
+        room_id: Hashable,
+        request: GenerationRequest,
+        on_complete: Optional[OnComplete] = None,
+        on_delta: Optional[OnDelta] = None
+    ):
+        loop = asyncio.get_running_loop()
+        self.id = uuid.uuid4().hex
+        self.room_id = room_id
+        self.request = request
+        self.on_complete = on_complete
+        self.on_delta = on_delta
+        self.future: asyncio.Future = loop.create_future()
+        # Nobody may await a generation that fails; don't warn about it.
+        self.future.add_done_callback(lambda f: f.cancelled() or f.exception())
+        self.task: Optional[asyncio.Task] = None
+        self.parts: List[str] = []
+        self.tokens = 0
+        self.deltas = 0
+        self.queued_at = loop.time()
+        self.started_at: Optional[float] = None
+        self.first_token_at: Optional[float] = None
+
+    @property
+    def text(self) -> str:
+        return "".join(self.parts)
+
+    def done(self) -> bool:
+        return self.future.done()
+
+    def cancel(self) -> None:
+        if self.task is not None:
+            self.task.cancel()
+        self.future.cancel()
+
+    def __await__(self):
+        return self.future.__await__()
+
+
+class PersonaEngine:
+    def __init__(
+        self,
+        provider: Optional[Provider] = None,
+        workers: int = AI_WORKERS,
+        room_concurrency: int = AI_ROOM_CONCURRENCY,
+        room_max_pending: int = AI_ROOM_MAX_PENDING,
+        room_token_budget: int = AI_ROOM_TOKEN_BUDGET,
+        budget_window: float = AI_BUDGET_WINDOW_SECONDS,
+        stream_interval: float = AI_STREAM_INTERVAL_MS / 1000
+    ):
+        self.provider = provider or create_provider()
+        self.workers = workers
+        self.room_concurrency = room_concurrency
+        self.room_max_pending = room_max_pending
+        self.room_token_budget = room_token_budget
+        self.budget_window = budget_window
+        self.stream_interval = stream_interval
+
+        self._queues: Dict[Hashable, Deque[Generation]] = {}
+        # Rooms with queued work, in the order they get their next turn.
+        self._ring: Deque[Hashable] = deque()
+        self._running: Dict[Hashable, Set[Generation]] = {}
+        self._spent: Dict[Hashable, Deque[Tuple[float, int]]] = {}
+        self._wakeup: Optional[asyncio.Event] = None
+        self._tasks: List[asyncio.Task] = []
+        # persona name -> recent (ttft from submission, ttft from provider start)
+        self._ttft: Dict[str, Deque[Tuple[float, float]]] = {}
+
+        self.submitted = 0
+        self.completed = 0
+        self.failed = 0
+        self.cancelled = 0
+        self.rejected_queue_full = 0
+        self.rejected_budget = 0
+        self.tokens = 0
+        self.deltas = 0
+
+    async def start(self) -> None:
+        # Created here, not at import time: events bind to the running loop.
+        self._wakeup = asyncio.Event()
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def stop(self) -> None:
+        for room_id in list(self._queues) + list(self._running):
+            self.cancel_room(room_id)
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        await self.provider.close()
+
+    def submit(
+        self,
+        room_id: Hashable,
+        request: GenerationRequest,
+        on_complete: Optional[OnComplete] = None,
+        on_delta: Optional[OnDelta] = None
+    ) -> Optional[Generation]:
+        """Queue a generation; None if the room's queue is full or its budget is spent."""
+        queue = self._queues.get(room_id)
+        if queue is not None and len(queue) >= self.room_max_pending:
+            self.rejected_queue_full += 1
+            return None
+        if self.room_token_budget and self.spent(room_id) >= self.room_token_budget:
+            self.rejected_budget += 1
+            return None
+
+        generation = Generation(room_id, request, on_complete, on_delta)
+        if queue is None:
+            queue = self._queues[room_id] = deque()
+            self._ring.append(room_id)
+        queue.append(generation)
+        self.submitted += 1
+        self._wakeup.set()
+        return generation
+
+    def cancel_room(self, room_id: Hashable) -> int:
+        """Drop the room's queued generations and cancel its running ones."""
+        cancelled = list(self._queues.pop(room_id, ())) + list(self._running.get(room_id, ()))
+        if room_id in self._ring:
+            self._ring.remove(room_id)
+        for generation in cancelled:
+            generation.cancel()
+        self.cancelled += len(cancelled)
+        return len(cancelled)
+
+    def spent(self, room_id: Hashable) -> int:
+        """Tokens the room generated within the budget window."""
+        spent = self._spent.get(room_id)
+        if not spent:
+            return 0
+        horizon = asyncio.get_running_loop().time() - self.budget_window
+        while spent and spent[0][0] < horizon:
+            spent.popleft()
+        if not spent:
+            del self._spent[room_id]
+            return 0
+        return sum(tokens for _, tokens in spent)
+
+    def queue_depth(self) -> int:
+        return sum(len(queue) for queue in self._queues.values())
+
+    def stats(self) -> dict:
+        return {
+            "provider": self.provider.name,
+            "workers": self.workers,
+            "queued": self.queue_depth(),
+            "running": sum(len(running) for running in self._running.values()),
+            "rooms_waiting": len(self._ring),
+            "submitted": self.submitted,
+            "completed": self.completed,
+            "failed": self.failed,
+            "cancelled": self.cancelled,
+            "rejected_queue_full": self.rejected_queue_full,
+            "rejected_budget": self.rejected_budget,
+            "tokens": self.tokens,
+            "deltas": self.deltas,
+            "ttft_ms": self.ttft_stats(),
+        }
+
+    def ttft_stats(self) -> Dict[str, dict]:
+        result = {}
+        for persona, samples in self._ttft.items():
+            total = sorted(sample[0] for sample in samples)
+            provider = sorted(sample[1] for sample in samples)
+            result[persona] = {
+                "samples": len(samples),
+                "p50": percentile(total, 0.5) * 1000,
+                "p95": percentile(total, 0.95) * 1000,
+                "provider_p50": percentile(provider, 0.5) * 1000,
+                "provider_p95": percentile(provider, 0.95) * 1000,
+            }
+        return result
+
+    def _next(self) -> Optional[Generation]:
+        # One pass around the ring; rooms at their concurrency limit keep
+        # their place and are skipped until one of their generations ends.
+        for _ in range(len(self._ring)):
+            room_id = self._ring.popleft()
+            if len(self._running.get(room_id, ())) >= self.room_concurrency:
+                self._ring.append(room_id)
+                continue
+            queue = self._queues[room_id]
+            generation = queue.popleft()
+            if queue:
+                self._ring.append(room_id)
+            else:
+                del self._queues[room_id]
+            return generation
+        return None
+
+    async def _worker(self) -> None:
+        while True:
+            generation = self._next()
+            if generation is None:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            if generation.done():
+                # Cancelled while queued.
+                continue
+            running = self._running.setdefault(generation.room_id, set())
+            running.add(generation)
+            generation.task = asyncio.create_task(self._generate(generation))
+            try:
+                await asyncio.wait([generation.task])
+            finally:
+                running.discard(generation)
+                if not running and self._running.get(generation.room_id) is running:
+                    del self._running[generation.room_id]
+                # The room may have work that was waiting on this slot.
+                self._wakeup.set()
+
+    async def _generate(self, generation: Generation) -> None:
+        loop = asyncio.get_running_loop()
+        request = generation.request
+        generation.started_at = loop.time()
+        pending: List[str] = []
+        flushed_at = None
+        try:
+            async for token in self.provider.stream(request):
+                now = loop.time()
+                if generation.first_token_at is None:
+                    generation.first_token_at = now
+                    self._record_ttft(generation)
+                generation.parts.append(token)
+                generation.tokens += 1
+                pending.append(token)
+                if flushed_at is None or now - flushed_at >= self.stream_interval:
+                    await self._flush_delta(generation, pending)
+                    flushed_at = now
+                if generation.tokens >= request.max_tokens:
+                    break
+            await self._flush_delta(generation, pending)
+            if generation.on_complete is not None:
+                await generation.on_complete(generation)
+        except asyncio.CancelledError:
+            generation.future.cancel()
+            raise
+        except Exception as e:
+            self.failed += 1
+            logger.warning(f"generation for persona {request.persona_name} in room {generation.room_id} failed: {e}")
+            if not generation.future.done():
+                generation.future.set_exception(e)
+        else:
+            self.completed += 1
+            if not generation.future.done():
+                generation.future.set_result(generation.text)
+        finally:
+            self.tokens += generation.tokens
+            if generation.tokens:
+                self._spent.setdefault(generation.room_id, deque()).append((loop.time(), generation.tokens))
+
+    async def _flush_delta(self, generation: Generation, pending: List[str]) -> None:
+        if not pending or generation.on_delta is None:
+            pending.clear()
+            return
+        delta = "".join(pending)
+        pending.clear()
+        generation.deltas += 1
+        self.deltas += 1
+        await generation.on_delta(generation, delta)
+
+    def _record_ttft(self, generation: Generation) -> None:
+        samples = self._ttft.get(generation.request.persona_name)
+        if samples is None:
+            samples = self._ttft[generation.request.persona_name] = deque(maxlen=AI_TTFT_SAMPLES)
+        samples.append((
+            generation.first_token_at - generation.queued_at,
+            generation.first_token_at - generation.started_at,
+        ))
@@ -0,0 +1,106 @@
+"""Text generation providers for personas.
+
+A provider streams a reply as a sequence of text chunks (tokens). The engine
+only depends on ``Provider.stream``, so a hosted model can be wired in by
+adding a subclass and a ``create_provider`` URL scheme.
+
+Implementations, selected by ``AI_PROVIDER_URL``:
+
+* ``stub://`` (default): ``StubProvider``, a deterministic offline generator
+  with configurable latency, for development and benchmarks.
+"""
+from typing import AsyncIterator, List, Optional
+import asyncio
+import hashlib
+import os
+import random
+
+AI_PROVIDER_URL = os.getenv("AI_PROVIDER_URL", "stub://")
+AI_MAX_TOKENS = int(os.getenv("AI_MAX_TOKENS", "256"))
+AI_STUB_FIRST_TOKEN_MS = int(os.getenv("AI_STUB_FIRST_TOKEN_MS", "200"))
+AI_STUB_TOKEN_MS = int(os.getenv("AI_STUB_TOKEN_MS", "20"))
+AI_STUB_REPLY_TOKENS = int(os.getenv("AI_STUB_REPLY_TOKENS", "40"))
+
+
+class GenerationRequest:
+    """What a persona is asked to answer.
+
+    ``messages`` are the recent turns, oldest first, as dicts with at least
+    ``username`` and ``content``. ``prompt_tokens`` is the estimated size of
+    the prompt, when known.
+    """
+
+    __slots__ = ("room_id", "persona_id", "persona_name", "system_prompt", "messages", "max_tokens", "prompt_tokens")
+
+    def __init__(
+        self,
+        room_id: int,
+        persona_id: int,
+        persona_name: str,
+        system_prompt: Optional[str],
+        messages: List[dict],
+        max_tokens: int = AI_MAX_TOKENS,
+        prompt_tokens: int = 0
+    ):
+        self.room_id = room_id
+        self.persona_id = persona_id
+        self.persona_name = persona_name
+        self.system_prompt = system_prompt
+        self.messages = messages
+        self.max_tokens = max_tokens
+        self.prompt_tokens = prompt_tokens
+
+
+class Provider:
+    """Base class: ``stream`` yields the reply one chunk at a time."""
+
+    name = "base"
+
+    def stream(self, request: GenerationRequest) -> AsyncIterator[str]:
+        raise NotImplementedError
+
+    async def close(self) -> None:
+        pass
+
+
+STUB_WORDS = (
+    "indeed", "perhaps", "the", "room", "idea", "question", "interesting", "consider",
+    "we", "could", "also", "think", "about", "that", "again", "and", "it", "seems",
+    "like", "a", "good", "point", "though", "maybe", "not", "always", "so", "here",
+)
+
+
+class StubProvider(Provider):
+    """Deterministic replies: the same request always yields the same tokens."""
+
+    name = "stub"
+
+    def __init__(
+        self,
+        first_token_delay: float = AI_STUB_FIRST_TOKEN_MS / 1000,
+        token_delay: float = AI_STUB_TOKEN_MS / 1000,
+        reply_tokens: int = AI_STUB_REPLY_TOKENS
+    ):
+        self.first_token_delay = first_token_delay
+        self.token_delay = token_delay
+        self.reply_tokens = reply_tokens
+
+    def reply(self, request: GenerationRequest) -> List[str]:
+        last = request.messages[-1]["content"] if request.messages else ""
+        seed = hashlib.sha256(f"{request.persona_id}:{request.system_prompt}:{last}".encode()).digest()
+        rng = random.Random(seed)
+        count = min(self.reply_tokens, request.max_tokens)
+        return [rng.choice(STUB_WORDS) + ("." if i == count - 1 else " ") for i in range(count)]
+
+    async def stream(self, request: GenerationRequest) -> AsyncIterator[str]:
+        await asyncio.sleep(self.first_token_delay)
+        for i, token in enumerate(self.reply(request)):
+            if i:
+                await asyncio.sleep(self.token_delay)
+            yield token
+
+
+def create_provider(url: str = AI_PROVIDER_URL) -> Provider:
+    if url.startswith("stub://"):
+        return StubProvider()
+    raise ValueError(f"unsupported AI_PROVIDER_URL: {url}")
@@ -0,0 +1,255 @@
+"""Response cache in front of the persona provider.
+
+Replies are cached under a key made of the persona, its rendered preamble
+(which includes the room theme), the reply length limit and a hash of the
+last ``AI_CACHE_CONTEXT_TURNS`` turns with their text normalized (case,
+punctuation and whitespace folded, speaker names ignored), so the many
+near-identical prompts of a busy theme share one generation.
+
+* Memory tier: LRU with ``AI_CACHE_SIZE`` entries, each valid for
+  ``AI_CACHE_TTL_SECONDS``.
+* Disk tier (optional, ``AI_CACHE_PATH``): a SQLite file that survives
+  restarts, capped at ``AI_CACHE_DISK_MAX_ENTRIES``.
+* Request coalescing: identical prompts in flight at the same time share one
+  provider call; every caller streams the same tokens as they arrive. The
+  shared call is only cancelled once all of its callers have gone.
+"""
+from collections import OrderedDict
+from typing import AsyncIterator, Dict, List, Optional, Tuple
+import asyncio
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+
+from app.ai.providers import GenerationRequest, Provider
+
+AI_CACHE_SIZE = int(os.getenv("AI_CACHE_SIZE", "1000"))
+AI_CACHE_TTL_SECONDS = int(os.getenv("AI_CACHE_TTL_SECONDS", "600"))
+AI_CACHE_PATH = os.getenv("AI_CACHE_PATH", "")
+AI_CACHE_DISK_MAX_ENTRIES = int(os.getenv("AI_CACHE_DISK_MAX_ENTRIES", "100000"))
+AI_CACHE_CONTEXT_TURNS = int(os.getenv("AI_CACHE_CONTEXT_TURNS", "3"))
+
+NORMALIZE_PATTERN = re.compile(r"[^\w]+")
+
+
+def normalize(text: str) -> str:
+    return NORMALIZE_PATTERN.sub(" ", text.lower()).strip()
+
+
+def cache_key(request: GenerationRequest, context_turns: int = AI_CACHE_CONTEXT_TURNS) -> str:
+    recent = request.messages[-context_turns:] if context_turns else []
+    material = json.dumps([
+        request.persona_id,
+        request.system_prompt,
+        request.max_tokens,
+        [normalize(turn["content"]) for turn in recent],
+    ])
+    return hashlib.sha256(material.encode()).hexdigest()
+
+
+class DiskTier:
+    """SQLite-backed key -> tokens store; called from worker threads."""
+
+    def __init__(self, path: str, max_entries: int = AI_CACHE_DISK_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            "key TEXT PRIMARY KEY, tokens TEXT NOT NULL, expires_at REAL NOT NULL)"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS ix_responses_expires_at ON responses (expires_at)")
+        self._db.commit()
+        self._writes = 0
+
+    def get(self, key: str) -> Optional[Tuple[List[str], float]]:
+        with self._lock:
+            row = self._db.execute(
+                "SELECT tokens, expires_at FROM responses WHERE key = ? AND expires_at > ?", (key, time.time())
+            ).fetchone()
+        return (json.loads(row[0]), row[1]) if row is not None else None
+
+    def put(self, key: str, tokens: List[str], expires_at: float) -> None:
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO responses (key, tokens, expires_at) VALUES (?, ?, ?)",
+                (key, json.dumps(tokens), expires_at)
+            )
+            self._writes += 1
+            if self._writes % 100 == 0:
+                self._prune()
+            self._db.commit()
+
+    def close(self) -> None:
+        with self._lock:
+            self._db.close()
+
+    def _prune(self) -> None:
+        self._db.execute("DELETE FROM responses WHERE expires_at <= ?", (time.time(),))
+        self._db.execute(
+            "DELETE FROM responses WHERE key IN ("
+            "SELECT key FROM responses ORDER BY expires_at DESC LIMIT -1 OFFSET ?)",
+            (self.max_entries,)
+        )
+
+
+class ResponseCache:
+    def __init__(
+        self,
+        maxsize: int = AI_CACHE_SIZE,
+        ttl: float = AI_CACHE_TTL_SECONDS,
+        path: Optional[str] = AI_CACHE_PATH or None,
+        disk_max_entries: int = AI_CACHE_DISK_MAX_ENTRIES
+    ):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries: "OrderedDict[str, Tuple[List[str], float]]" = OrderedDict()
+        self.disk = DiskTier(path, disk_max_entries) if path else None
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    async def get(self, key: str) -> Optional[List[str]]:
+        entry = self._entries.get(key)
+        if entry is not None:
+            if time.time() < entry[1]:
+                self._entries.move_to_end(key)
+                self.memory_hits += 1
+                return entry[0]
+            del self._entries[key]
+        if self.disk is not None:
+            stored = await asyncio.to_thread(self.disk.get, key)
+            if stored is not None:
+                self._remember(key, *stored)
+                self.disk_hits += 1
+                return stored[0]
+        self.misses += 1
+        return None
+
+    async def put(self, key: str, tokens: List[str]) -> None:
+        expires_at = time.time() + self.ttl
+        self._remember(key, tokens, expires_at)
+        if self.disk is not None:
+            await asyncio.to_thread(self.disk.put, key, tokens, expires_at)
+
+    def clear(self) -> None:
+        self._entries.clear()
+
+    def close(self) -> None:
+        if self.disk is not None:
+            self.disk.close()
+            self.disk = None
+
+    def stats(self) -> dict:
+        hits = self.memory_hits + self.disk_hits
+        lookups = hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "memory_hits": self.memory_hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "hit_rate": hits / lookups if lookups else 0.0,
+        }
+
+    def _remember(self, key: str, tokens: List[str], expires_at: float) -> None:
+        if self.maxsize <= 0:
+            return
+        self._entries[key] = (tokens, expires_at)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+
+class Flight:
+    """One provider call shared by every caller asking for the same key."""
+
+    def __init__(self):
+        self.tokens: List[str] = []
+        self.done = False
+        self.error: Optional[BaseException] = None
+        self.changed = asyncio.Event()
+        self.consumers = 0
+        self.task: Optional[asyncio.Task] = None
+
+
+class CachingProvider(Provider):
+    def __init__(self, provider: Provider, cache: Optional[ResponseCache] = None):
+        self.provider = provider
+        self.cache = cache or ResponseCache()
+        self.name = f"cached:{provider.name}"
+        self._flights: Dict[str, Flight] = {}
+        self.provider_calls = 0
+        self.coalesced = 0
+
+    async def stream(self, request: GenerationRequest) -> AsyncIterator[str]:
+        key = cache_key(request)
+        flight = self._flights.get(key)
+        if flight is None:
+            cached = await self.cache.get(key)
+            if cached is not None:
+                for token in cached:
+                    yield token
+                return
+            flight = self._flights.get(key)
+        if flight is None:
+            flight = self._flights[key] = Flight()
+            flight.task = asyncio.create_task(self._pump(key, request, flight))
+            self.provider_calls += 1
+        else:
+            self.coalesced += 1
+
+        flight.consumers += 1
+        try:
+            sent = 0
+            while True:
+                while sent < len(flight.tokens):
+                    yield flight.tokens[sent]
+                    sent += 1
+                if flight.done:
+                    if isinstance(flight.error, asyncio.CancelledError):
+                        raise RuntimeError("shared generation was cancelled")
+                    if flight.error is not None:
+                        raise flight.error
+                    return
+                flight.changed.clear()
+                await flight.changed.wait()
+        finally:
+            flight.consumers -= 1
+            if flight.consumers == 0 and not flight.done:
+                flight.task.cancel()
+
+    async def close(self) -> None:
+        for flight in list(self._flights.values()):
+            flight.task.cancel()
+        self.cache.close()
+        await self.provider.close()
+
+    def stats(self) -> dict:
+        cache = self.cache.stats()
+        return {
+            **cache,
+            "provider_calls": self.provider_calls,
+            "coalesced": self.coalesced,
+            "provider_calls_saved": cache["memory_hits"] + cache["disk_hits"] + self.coalesced,
+            "in_flight": len(self._flights),
+        }
+
+    async def _pump(self, key: str, request: GenerationRequest, flight: Flight) -> None:
+        try:
+            async for token in self.provider.stream(request):
+                flight.tokens.append(token)
+                flight.changed.set()
+            await self.cache.put(key, flight.tokens)
+        except (Exception, asyncio.CancelledError) as e:
+            flight.error = e
+            if isinstance(e, asyncio.CancelledError):
+                raise
+        finally:
+            flight.done = True
+            flight.changed.set()
+            if self._flights.get(key) is flight:
+                del self._flights[key]
@@ -0,0 +1,212 @@
+"""Relevance routing: which personas should answer a message.
+
+Messages, personas and themes are embedded locally with a signed hashing
+vectorizer (word unigrams and bigrams, plurals folded, ``AI_ROUTING_DIM`` dimensions, L2
+normalized), so no model download or network call is involved.
+
+The router keeps one NumPy matrix with a row per persona and one with a row
+per theme. A persona's score for a message in a room is
+
+    cos(message, persona) + AI_ROUTING_THEME_WEIGHT * cos(theme, persona)
+
+A batch of messages is scored against every persona with one matrix product
+and the top ``k`` are taken with ``argpartition``. Only personas whose
+similarity to the message alone reaches ``AI_ROUTING_MIN_SCORE`` are
+returned; the theme term ranks them, it cannot make a persona relevant to
+small talk. Rows are re-embedded only for personas or themes whose text
+changed.
+"""
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+import os
+import re
+import zlib
+
+import numpy as np
+
+from app import models
+
+AI_ROUTING_DIM = int(os.getenv("AI_ROUTING_DIM", "1024"))
+AI_ROUTING_TOP_K = int(os.getenv("AI_ROUTING_TOP_K", "1"))
+AI_ROUTING_MIN_SCORE = float(os.getenv("AI_ROUTING_MIN_SCORE", "0.15"))
+AI_ROUTING_THEME_WEIGHT = float(os.getenv("AI_ROUTING_THEME_WEIGHT", "0.3"))
+# Let un-mentioned human messages summon the most relevant personas.
+AI_ROUTING_AUTO = os.getenv("AI_ROUTING_AUTO", "false").lower() in ("1", "true", "yes")
+
+WORD_PATTERN = re.compile(r"\w+")
+STOP_WORDS = frozenset(
+    "a an and are as at be but by can do for from has have he her his i if in is it its me my "
+    "no not of on or our she so that the their them they this to us was we were what when "
+    "which who will with you your".split()
+)
+
+# (persona id, persona name, score)
+Match = Tuple[int, str, float]
+
+
+def stem(word: str) -> str:
+    # Fold plain plurals so "planet" matches "planets".
+    return word[:-1] if len(word) > 3 and word.endswith("s") and not word.endswith("ss") else word
+
+
+def features(text: str) -> List[str]:
+    words = [stem(w) for w in WORD_PATTERN.findall(text.lower()) if w not in STOP_WORDS]
+    return words + [f"{a} {b}" for a, b in zip(words, words[1:])]
+
+
+def embed(texts: Sequence[str], dim: int = AI_ROUTING_DIM) -> np.ndarray:
+    """Embed ``texts`` as the rows of a ``len(texts) x dim`` float32 matrix."""
+    rows, columns, signs = [], [], []
+    for i, text in enumerate(texts):
+        for feature in features(text):
+            # crc32, unlike hash(), is stable across processes.
+            h = zlib.crc32(feature.encode())
+            rows.append(i)
+            columns.append(h % dim)
+            signs.append(1.0 if h & 0x80000000 else -1.0)
+    matrix = np.zeros((len(texts), dim), dtype=np.float32)
+    np.add.at(matrix, (rows, columns), signs)
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    np.divide(matrix, norms, out=matrix, where=norms > 0)
+    return matrix
+
+
+def persona_text(persona: models.Persona) -> str:
+    return " ".join(part for part in (persona.name, persona.system_prompt, persona.style) if part)
+
+
+class RowIndex:
+    """Rows of an embedding matrix keyed by id, re-embedded only when their text changes."""
+
+    def __init__(self, dim: int):
+        self.dim = dim
+        self.matrix = np.zeros((0, dim), dtype=np.float32)
+        self.keys: List = []
+        self.labels: List[str] = []
+        self._rows: Dict = {}
+        self._texts: Dict = {}
+        self.embedded = 0
+
+    def __len__(self) -> int:
+        return len(self.keys)
+
+    def row(self, key) -> Optional[int]:
+        return self._rows.get(key)
+
+    def sync(self, items: Iterable[Tuple[object, str, str]], prune: bool = True) -> int:
+        """Bring the index up to date with ``(key, label, text)`` items; returns rows embedded."""
+        changed = []
+        seen = set()
+        for key, label, text in items:
+            seen.add(key)
+            row = self._rows.get(key)
+            if row is not None:
+                self.labels[row] = label
+            if self._texts.get(key) != text:
+                changed.append((key, label, text))
+        if prune:
+            for key in [k for k in self.keys if k not in seen]:
+                self.remove(key)
+        if not changed:
+            return 0
+
+        vectors = embed([text for _, _, text in changed], self.dim)
+        new = []
+        for (key, label, text), vector in zip(changed, vectors):
+            self._texts[key] = text
+            row = self._rows.get(key)
+            if row is not None:
+                self.matrix[row] = vector
+            else:
+                self._rows[key] = len(self.keys)
+                new.append(vector)
+                self.keys.append(key)
+                self.labels.append(label)
+        if new:
+            self.matrix = np.vstack([self.matrix, np.asarray(new, dtype=np.float32)])
+        self.embedded += len(changed)
+        return len(changed)
+
+    def remove(self, key) -> None:
+        row = self._rows.pop(key, None)
+        if row is None:
+            return
+        self._texts.pop(key, None)
+        # Move the last row into the hole instead of shifting every row after it.
+        last = len(self.keys) - 1
+        if row != last:
+            self.matrix[row] = self.matrix[last]
+            self.keys[row] = self.keys[last]
+            self.labels[row] = self.labels[last]
+            self._rows[self.keys[row]] = row
+        self.matrix = self.matrix[:last]
+        self.keys.pop()
+        self.labels.pop()
+
+
+class PersonaRouter:
+    def __init__(
+        self,
+        dim: int = AI_ROUTING_DIM,
+        top_k: int = AI_ROUTING_TOP_K,
+        min_score: float = AI_ROUTING_MIN_SCORE,
+        theme_weight: float = AI_ROUTING_THEME_WEIGHT
+    ):
+        self.dim = dim
+        self.top_k = top_k
+        self.min_score = min_score
+        self.theme_weight = theme_weight
+        self.personas = RowIndex(dim)
+        self.themes = RowIndex(dim)
+        self.routed = 0
+
+    def sync_personas(self, personas: Iterable[models.Persona], prune: bool = True) -> int:
+        """Update the persona matrix; only new or edited personas are re-embedded."""
+        return self.personas.sync(((p.id, p.name, persona_text(p)) for p in personas), prune)
+
+    def sync_themes(self, themes: Iterable[models.Theme], prune: bool = True) -> int:
+        return self.themes.sync(((t.name, t.name, f"{t.name} {t.description or ''}") for t in themes), prune)
+
+    def remove_persona(self, persona_id: int) -> None:
+        self.personas.remove(persona_id)
+
+    def route_many(
+        self,
+        contents: Sequence[str],
+        theme: Optional[str] = None,
+        k: Optional[int] = None,
+        min_score: Optional[float] = None
+    ) -> List[List[Match]]:
+        """The best personas for each message, best first."""
+        k = self.top_k if k is None else k
+        min_score = self.min_score if min_score is None else min_score
+        if not contents or not len(self.personas) or k <= 0:
+            return [[] for _ in contents]
+
+        relevance = embed(contents, self.dim) @ self.personas.matrix.T
+        scores = np.where(relevance >= min_score, relevance, -np.inf)
+        row = self.themes.row(theme) if theme is not None else None
+        if row is not None and self.theme_weight:
+            scores += self.theme_weight * (self.personas.matrix @ self.themes.matrix[row])
+        k = min(k, scores.shape[1])
+        top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        self.routed += len(contents)
+
+        results = []
+        for i, candidates in enumerate(top):
+            ranked = candidates[np.argsort(-scores[i, candidates])]
+            results.append([
+                (self.personas.keys[j], self.personas.labels[j], float(scores[i, j]))
+                for j in ranked if np.isfinite(scores[i, j])
+            ])
+        return results
+
+    def route(self, content: str, theme: Optional[str] = None, k: Optional[int] = None) -> List[Match]:
+        return self.route_many([content], theme, k)[0]
+
+    def stats(self) -> dict:
+        return {
+            "personas": len(self.personas),
+            "themes": len(self.themes),
+            "embedded": self.personas.embedded + self.themes.embedded,
+            "routed": self.routed,
+        }
@@ -0,0 +1,212 @@
+"""Debounced AI turn-taking.
+
+Messages that mention personas do not trigger generations directly. They
+open (or extend) a pending turn for the room, which fires once the room has
+been quiet for ``AI_TURN_DEBOUNCE_MS`` (or ``AI_TURN_MAX_DELAY_MS`` after
+the first message, whichever is sooner). A burst of messages therefore costs
+one turn, in which at most ``AI_TURN_MAX_SPEAKERS`` of the mentioned personas
+speak, each once.
+
+Persona replies can mention other personas and so start a turn of their
+own. Each such hop increases the chain depth; turns deeper than
+``AI_MAX_CHAIN_DEPTH`` are dropped, and a human message resets the chain.
+A room fires at most ``AI_TURNS_PER_MINUTE`` turns per minute. When a human
+writes again, generations of earlier turns that have not started yet are
+cancelled: the new turn answers the newer conversation instead.
+
+With a ``route`` callback, human messages that mention nobody are addressed
+to whichever personas it picks (see ``app.ai.routing``).
+"""
+from collections import deque
+from typing import Awaitable, Callable, Deque, Dict, Hashable, List, Optional
+import asyncio
+import logging
+import os
+import re
+
+from app.ai.engine import Generation
+
+logger = logging.getLogger(__name__)
+
+AI_TURN_DEBOUNCE_MS = int(os.getenv("AI_TURN_DEBOUNCE_MS", "750"))
+AI_TURN_MAX_DELAY_MS = int(os.getenv("AI_TURN_MAX_DELAY_MS", "3000"))
+AI_TURN_MAX_SPEAKERS = int(os.getenv("AI_TURN_MAX_SPEAKERS", "2"))
+AI_MAX_CHAIN_DEPTH = int(os.getenv("AI_MAX_CHAIN_DEPTH", "2"))
+AI_TURNS_PER_MINUTE = int(os.getenv("AI_TURNS_PER_MINUTE", "12"))
+
+# "@Name" in a message asks the persona called Name to reply.
+MENTION = re.compile(r"@(\w+)")
+
+# run_turn(room_id, persona names, depth) queues the generations of one turn.
+RunTurn = Callable[[Hashable, List[str], int], Awaitable[List[Generation]]]
+# route(room_id, content) names the personas an un-addressed message is for.
+Route = Callable[[Hashable, str], List[str]]
+
+
+def mentions(content: str) -> List[str]:
+    return MENTION.findall(content)
+
+
+class PendingTurn:
+    def __init__(self, depth: int, opened_at: float):
+        self.names: Dict[str, str] = {}
+        self.depth = depth
+        self.opened_at = opened_at
+        self.timer: Optional[asyncio.TimerHandle] = None
+
+
+class TurnScheduler:
+    def __init__(
+        self,
+        debounce: float = AI_TURN_DEBOUNCE_MS / 1000,
+        max_delay: float = AI_TURN_MAX_DELAY_MS / 1000,
+        max_speakers: int = AI_TURN_MAX_SPEAKERS,
+        max_depth: int = AI_MAX_CHAIN_DEPTH,
+        turns_per_minute: int = AI_TURNS_PER_MINUTE
+    ):
+        self.run_turn: Optional[RunTurn] = None
+        self.route: Optional[Route] = None
+        self.debounce = debounce
+        self.max_delay = max_delay
+        self.max_speakers = max_speakers
+        self.max_depth = max_depth
+        self.turns_per_minute = turns_per_minute
+
+        self._pending: Dict[Hashable, PendingTurn] = {}
+        self._fired: Dict[Hashable, Deque[float]] = {}
+        # Generations of fired turns that may still be superseded.
+        self._generations: Dict[Hashable, List[Generation]] = {}
+        self._depths: Dict[str, int] = {}
+        self._tasks = set()
+
+        self.messages = 0
+        self.debounced = 0
+        self.turns = 0
+        self.dropped_depth = 0
+        self.dropped_budget = 0
+        self.superseded = 0
+        self.routed = 0
+
+    async def start(self, run_turn: RunTurn, route: Optional[Route] = None) -> None:
+        self.run_turn = run_turn
+        self.route = route
+
+    def message(self, room_id: Hashable, content: str, depth: int = 0, author: Optional[str] = None) -> None:
+        """Note a room message; ``depth`` is 0 for humans, the chain depth for persona replies."""
+        self.messages += 1
+        if depth == 0:
+            self._supersede(room_id)
+        names = [name for name in mentions(content) if author is None or name.lower() != author.lower()]
+        if not names and depth == 0 and self.route is not None:
+            names = self.route(room_id, content)
+            self.routed += bool(names)
+        pending = self._pending.get(room_id)
+        if not names:
+            if pending is not None and depth == 0:
+                # The conversation moved on; wait for it to settle again.
+                self._schedule(room_id, pending)
+            return
+        if depth > self.max_depth:
+            self.dropped_depth += 1
+            return
+
+        loop = asyncio.get_running_loop()
+        if pending is None:
+            pending = self._pending[room_id] = PendingTurn(depth, loop.time())
+        else:
+            self.debounced += 1
+            pending.depth = min(pending.depth, depth)
+        for name in names:
+            pending.names.setdefault(name.lower(), name)
+        self._schedule(room_id, pending)
+
+    def reply(self, generation: Generation) -> None:
+        """Note a persona's finished reply, which may mention other personas."""
+        depth = self._depths.pop(generation.id, 0)
+        self.message(generation.room_id, generation.text, depth + 1, generation.request.persona_name)
+
+    def cancel_room(self, room_id: Hashable) -> None:
+        pending = self._pending.pop(room_id, None)
+        if pending is not None and pending.timer is not None:
+            pending.timer.cancel()
+        for generation in self._generations.pop(room_id, []):
+            self._depths.pop(generation.id, None)
+        self._fired.pop(room_id, None)
+
+    async def stop(self) -> None:
+        for room_id in list(self._pending):
+            self.cancel_room(room_id)
+        for task in list(self._tasks):
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    def stats(self) -> dict:
+        return {
+            "pending": len(self._pending),
+            "messages": self.messages,
+            "debounced": self.debounced,
+            "turns": self.turns,
+            "dropped_depth": self.dropped_depth,
+            "dropped_budget": self.dropped_budget,
+            "superseded": self.superseded,
+            "routed": self.routed,
+        }
+
+    def _schedule(self, room_id: Hashable, pending: PendingTurn) -> None:
+        loop = asyncio.get_running_loop()
+        if pending.timer is not None:
+            pending.timer.cancel()
+        delay = min(self.debounce, pending.opened_at + self.max_delay - loop.time())
+        pending.timer = loop.call_later(max(0.0, delay), self._fire, room_id)
+
+    def _fire(self, room_id: Hashable) -> None:
+        pending = self._pending.pop(room_id, None)
+        if pending is None:
+            return
+        task = asyncio.create_task(self._run(room_id, pending))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _run(self, room_id: Hashable, pending: PendingTurn) -> None:
+        loop = asyncio.get_running_loop()
+        fired = self._fired.setdefault(room_id, deque())
+        while fired and fired[0] < loop.time() - 60:
+            fired.popleft()
+        if len(fired) >= self.turns_per_minute:
+            self.dropped_budget += 1
+            return
+        fired.append(loop.time())
+        self.turns += 1
+
+        names = list(pending.names.values())[:self.max_speakers]
+        try:
+            generations = await self.run_turn(room_id, names, pending.depth)
+        except Exception as e:
+            logger.warning(f"AI turn in room {room_id} failed: {e}")
+            return
+        live = []
+        for generation in self._generations.get(room_id, []):
+            if generation.done():
+                self._depths.pop(generation.id, None)
+            else:
+                live.append(generation)
+        for generation in generations:
+            self._depths[generation.id] = pending.depth
+            live.append(generation)
+        self._generations[room_id] = live
+
+    def _supersede(self, room_id: Hashable) -> None:
+        generations = self._generations.get(room_id)
+        if not generations:
+            return
+        live = []
+        for generation in generations:
+            if generation.done():
+                self._depths.pop(generation.id, None)
+            elif generation.started_at is None:
+                generation.cancel()
+                self._depths.pop(generation.id, None)
+                self.superseded += 1
+            else:
+                live.append(generation)
+        self._generations[room_id] = live
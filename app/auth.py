@@ -1,27 +1,121 @@
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from functools import lru_cache
 from datetime import datetime, timedelta, timezone
-from typing import Optional
+from typing import Callable, Optional, Tuple
 from jose import JWTError, jwt
 from passlib.context import CryptContext
 from fastapi import Depends, HTTPException, status, Cookie
 from fastapi.security import HTTPBearer
-from sqlalchemy.orm import Session
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import AsyncSession
+import asyncio
 import os
 
 from app.database import get_db
 from app import crud, models
+from app.auth_cache import AuthCache
 
 AUTH_SECRET = os.getenv("AUTH_SECRET", "your-secret-key-change-in-production")
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = int(os.getenv("ACCESS_TOKEN_EXPIRE_MINUTES", "60"))
 
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+# Cost is pinned explicitly so that changing it makes existing hashes
+# "need update" and they are rehashed on the next successful login.
+BCRYPT_ROUNDS = int(os.getenv("BCRYPT_ROUNDS", "12"))
+
+# bcrypt runs off the event loop in a bounded pool: at most
+# PASSWORD_HASH_WORKERS at once, PASSWORD_HASH_MAX_PENDING waiting, and
+# anything beyond that is rejected with 429 instead of piling up.
+PASSWORD_HASH_EXECUTOR = os.getenv("PASSWORD_HASH_EXECUTOR", "thread")
+PASSWORD_HASH_WORKERS = int(os.getenv("PASSWORD_HASH_WORKERS", str(min(4, os.cpu_count() or 1))))
+PASSWORD_HASH_MAX_PENDING = int(os.getenv("PASSWORD_HASH_MAX_PENDING", "64"))
+
+pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto", bcrypt__rounds=BCRYPT_ROUNDS)
 security = HTTPBearer(auto_error=False)
+auth_cache = AuthCache()
+
+@event.listens_for(models.User, "after_update")
+@event.listens_for(models.User, "after_delete")
+def _invalidate_cached_user(mapper, connection, target: models.User) -> None:
+    auth_cache.invalidate_user(target.id)
 
 def verify_password(plain_password: str, hashed_password: str) -> bool:
     return pwd_context.verify(plain_password, hashed_password)
 
-def get_password_hash(password: str) -> str:
-    return pwd_context.hash(password)
+@lru_cache(maxsize=None)
+def _bcrypt_with_rounds(rounds: int):
+    return pwd_context.handler().using(rounds=rounds)
+
+def get_password_hash(password: str, rounds: Optional[int] = None) -> str:
+    # A cost other than BCRYPT_ROUNDS is upgraded on the next successful login.
+    if rounds is None:
+        return pwd_context.hash(password)
+    return _bcrypt_with_rounds(rounds).hash(password)
+
+def verify_and_update_password(plain_password: str, hashed_password: str) -> Tuple[bool, Optional[str]]:
+    return pwd_context.verify_and_update(plain_password, hashed_password)
+
+class PasswordHasher:
+    def __init__(
+        self,
+        executor: str = PASSWORD_HASH_EXECUTOR,
+        workers: int = PASSWORD_HASH_WORKERS,
+        max_pending: int = PASSWORD_HASH_MAX_PENDING
+    ):
+        if executor not in ("thread", "process"):
+            raise ValueError(f"unknown password hash executor: {executor}")
+        self.executor_type = executor
+        self.workers = workers
+        self.max_pending = max_pending
+        self._executor: Optional[Executor] = None
+        self.in_flight = 0
+        self.completed = 0
+        self.rejected = 0
+    
+    def _get_executor(self) -> Executor:
+        if self._executor is None:
+            if self.executor_type == "process":
+                self._executor = ProcessPoolExecutor(max_workers=self.workers)
+            else:
+                self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="bcrypt")
+        return self._executor
+    
+    async def _run(self, fn: Callable, *args):
+        if self.in_flight >= self.workers + self.max_pending:
+            self.rejected += 1
+            raise HTTPException(
+                status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+                detail="Too many password checks in progress, try again shortly",
+                headers={"Retry-After": "1"},
+            )
+        self.in_flight += 1
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self._get_executor(), fn, *args)
+        finally:
+            self.in_flight -= 1
+            self.completed += 1
+    
+    async def hash(self, password: str) -> str:
+        return await self._run(get_password_hash, password)
+    
+    async def verify_and_update(self, password: str, hashed_password: str) -> Tuple[bool, Optional[str]]:
+        return await self._run(verify_and_update_password, password, hashed_password)
+    
+    def shutdown(self) -> None:
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+    
+    def stats(self) -> dict:
+        return {
+            "executor": self.executor_type,
+            "workers": self.workers,
+            "in_flight": self.in_flight,
+            "completed": self.completed,
+            "rejected": self.rejected,
+        }
+
+password_hasher = PasswordHasher()
 
 def create_access_token(data: dict, expires_delta: Optional[timedelta] = None) -> str:
     to_encode = data.copy()
@@ -33,17 +127,38 @@ def create_access_token(data: dict, expires_delta: Optional[timedelta] = None) -
     encoded_jwt = jwt.encode(to_encode, AUTH_SECRET, algorithm=ALGORITHM)
     return encoded_jwt
 
-def authenticate_user(db: Session, username: str, password: str) -> Optional[models.User]:
-    user = crud.get_user_by_username(db, username)
+async def authenticate_user(db: AsyncSession, username: str, password: str) -> Optional[models.User]:
+    user = await crud.aget_user_by_username(db, username)
     if not user:
         return None
-    if not verify_password(password, user.hashed_password):
+    verified, new_hash = await password_hasher.verify_and_update(password, user.hashed_password)
+    if not verified:
+        return None
+    if new_hash is not None:
+        user = await crud.aupdate_user_password(db, user, new_hash)
+    return user
+
+async def resolve_token(token: str, db: AsyncSession) -> Optional[models.User]:
+    user = auth_cache.get(token)
+    if user is not None:
+        return user
+    
+    try:
+        payload = jwt.decode(token, AUTH_SECRET, algorithms=[ALGORITHM])
+    except JWTError:
+        return None
+    username: str = payload.get("sub")
+    if username is None:
         return None
+    
+    user = await crud.aget_user_by_username(db, username)
+    if user is not None:
+        auth_cache.put(token, user, payload["exp"])
     return user
 
 async def get_current_user(
     access_token: Optional[str] = Cookie(None),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_db)
 ) -> models.User:
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
@@ -54,15 +169,7 @@ async def get_current_user(
     if not access_token:
         raise credentials_exception
     
-    try:
-        payload = jwt.decode(access_token, AUTH_SECRET, algorithms=[ALGORITHM])
-        username: str = payload.get("sub")
-        if username is None:
-            raise credentials_exception
-    except JWTError:
-        raise credentials_exception
-    
-    user = crud.get_user_by_username(db, username)
+    user = await resolve_token(access_token, db)
     if user is None:
         raise credentials_exception
     
@@ -70,31 +177,15 @@ async def get_current_user(
 
 async def get_optional_current_user(
     access_token: Optional[str] = Cookie(None),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_db)
 ) -> Optional[models.User]:
     if not access_token:
         return None
     
-    try:
-        payload = jwt.decode(access_token, AUTH_SECRET, algorithms=[ALGORITHM])
-        username: str = payload.get("sub")
-        if username is None:
-            return None
-        user = crud.get_user_by_username(db, username)
-        return user
-    except JWTError:
-        return None
+    return await resolve_token(access_token, db)
 
-async def validate_websocket_auth(token: Optional[str], db: Session) -> Optional[models.User]:
+async def validate_websocket_auth(token: Optional[str], db: AsyncSession) -> Optional[models.User]:
     if not token:
         return None
     
-    try:
-        payload = jwt.decode(token, AUTH_SECRET, algorithms=[ALGORITHM])
-        username: str = payload.get("sub")
-        if username is None:
-            return None
-        user = crud.get_user_by_username(db, username)
-        return user
-    except JWTError:
-        return None
+    return await resolve_token(token, db)
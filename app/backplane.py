@@ -0,0 +1,304 @@
+"""Cross-process pub/sub backplane for room broadcasts.
+
+Every worker publishes the frames produced by its own sockets to the backplane
+and delivers frames published by other workers to its local connections. A
+worker only subscribes to rooms it currently has live sockets for.
+
+Implementations, selected by ``BACKPLANE_URL``:
+
+* ``memory://`` (default): single process, frames are only delivered locally.
+* ``postgresql://...``: Postgres LISTEN/NOTIFY, one channel per room.
+* ``unix:///path/to/broker.sock``: a small local broker (``UnixSocketBroker``),
+  started with ``python -m app.backplane /path/to/broker.sock``.
+"""
+from typing import Callable, Dict, Hashable, Optional, Set
+import asyncio
+import logging
+import os
+import uuid
+
+from sqlalchemy.engine import make_url
+
+logger = logging.getLogger(__name__)
+
+BACKPLANE_URL = os.getenv("BACKPLANE_URL", "memory://")
+
+# Postgres rejects NOTIFY payloads of 8000 bytes or more.
+PG_NOTIFY_MAX_BYTES = 7999
+# Line limit for the Unix socket protocol.
+UNIX_LINE_LIMIT = 2 ** 20
+
+# deliver(room_id, frame, message): ``message`` is the history entry behind
+# the frame when it was published by this worker, None for remote frames.
+Deliver = Callable[[Hashable, str, Optional[dict]], object]
+
+
+class Backplane:
+    """Base class: local delivery plus subscription bookkeeping.
+
+    Subclasses implement the ``_subscribe``/``_unsubscribe``/``_publish``
+    transport hooks and call ``_receive`` for frames from other workers.
+    """
+
+    # Whether other processes publish to the same rooms. If so, this worker
+    # only sees a room's messages while it is subscribed to it.
+    cross_process = True
+
+    def __init__(self):
+        self.worker_id = uuid.uuid4().hex
+        self._deliver: Optional[Deliver] = None
+        self._rooms: Dict[str, Hashable] = {}
+        self.published = 0
+        self.received = 0
+
+    async def start(self, deliver: Deliver) -> None:
+        self._deliver = deliver
+
+    async def stop(self) -> None:
+        self._rooms.clear()
+
+    async def subscribe(self, room_id: Hashable) -> None:
+        key = str(room_id)
+        if key in self._rooms:
+            return
+        self._rooms[key] = room_id
+        await self._subscribe(key)
+
+    async def unsubscribe(self, room_id: Hashable) -> None:
+        key = str(room_id)
+        if self._rooms.pop(key, None) is None:
+            return
+        await self._unsubscribe(key)
+
+    async def publish(self, room_id: Hashable, frame: str, message: Optional[dict] = None) -> None:
+        # Local connections get the frame straight away; other workers get it
+        # through the transport and never echo it back to us.
+        self._deliver(room_id, frame, message)
+        self.published += 1
+        await self._publish(str(room_id), frame)
+
+    def stats(self) -> dict:
+        return {
+            "type": type(self).__name__,
+            "subscribed_rooms": len(self._rooms),
+            "published": self.published,
+            "received": self.received,
+        }
+
+    def _receive(self, key: str, frame: str) -> None:
+        room_id = self._rooms.get(key)
+        if room_id is None:
+            return
+        self.received += 1
+        self._deliver(room_id, frame, None)
+
+    async def _subscribe(self, key: str) -> None:
+        pass
+
+    async def _unsubscribe(self, key: str) -> None:
+        pass
+
+    async def _publish(self, key: str, frame: str) -> None:
+        pass
+
+
+class InProcessBackplane(Backplane):
+    """Single-process default: there are no other workers to reach."""
+
+    cross_process = False
+
+
+class PostgresBackplane(Backplane):
+    def __init__(self, url: str):
+        super().__init__()
+        self.dsn = make_url(url).set(drivername="postgresql").render_as_string(hide_password=False)
+        self._connection = None
+        self._lock: Optional[asyncio.Lock] = None
+        self.oversized = 0
+
+    async def start(self, deliver: Deliver) -> None:
+        import asyncpg
+
+        await super().start(deliver)
+        self._lock = asyncio.Lock()
+        self._connection = await asyncpg.connect(self.dsn)
+
+    async def stop(self) -> None:
+        await super().stop()
+        if self._connection is not None:
+            await self._connection.close()
+            self._connection = None
+
+    def stats(self) -> dict:
+        return {**super().stats(), "oversized": self.oversized}
+
+    @staticmethod
+    def _channel(key: str) -> str:
+        return f"chat_room_{key}"
+
+    def _on_notify(self, connection, pid, channel: str, payload: str) -> None:
+        origin, _, frame = payload.partition(":")
+        if origin == self.worker_id:
+            return
+        self._receive(channel[len("chat_room_"):], frame)
+
+    async def _subscribe(self, key: str) -> None:
+        async with self._lock:
+            await self._connection.add_listener(self._channel(key), self._on_notify)
+
+    async def _unsubscribe(self, key: str) -> None:
+        async with self._lock:
+            await self._connection.remove_listener(self._channel(key), self._on_notify)
+
+    async def _publish(self, key: str, frame: str) -> None:
+        payload = f"{self.worker_id}:{frame}"
+        if len(payload.encode()) > PG_NOTIFY_MAX_BYTES:
+            self.oversized += 1
+            logger.warning(f"frame for room {key} too large for NOTIFY, delivered locally only")
+            return
+        async with self._lock:
+            await self._connection.execute("SELECT pg_notify($1, $2)", self._channel(key), payload)
+
+
+class UnixSocketBackplane(Backplane):
+    """Client for ``UnixSocketBroker``.
+
+    The protocol is line based: ``SUB <room>``, ``UNSUB <room>`` and
+    ``PUB <room> <frame>`` from workers, ``MSG <room> <frame>`` from the broker.
+    Frames are compact JSON, so they never contain a newline.
+    """
+
+    def __init__(self, path: str):
+        super().__init__()
+        self.path = path
+        self._reader: Optional[asyncio.StreamReader] = None
+        self._writer: Optional[asyncio.StreamWriter] = None
+        self._task: Optional[asyncio.Task] = None
+
+    async def start(self, deliver: Deliver) -> None:
+        await super().start(deliver)
+        self._reader, self._writer = await asyncio.open_unix_connection(self.path, limit=UNIX_LINE_LIMIT)
+        self._task = asyncio.create_task(self._read())
+
+    async def stop(self) -> None:
+        await super().stop()
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+
+    async def _send(self, line: str) -> None:
+        self._writer.write(line.encode() + b"\n")
+        await self._writer.drain()
+
+    async def _subscribe(self, key: str) -> None:
+        await self._send(f"SUB {key}")
+
+    async def _unsubscribe(self, key: str) -> None:
+        await self._send(f"UNSUB {key}")
+
+    async def _publish(self, key: str, frame: str) -> None:
+        if "\n" in frame:
+            raise ValueError("backplane frames must not contain newlines")
+        await self._send(f"PUB {key} {frame}")
+
+    async def _read(self) -> None:
+        while True:
+            line = await self._reader.readline()
+            if not line:
+                logger.error("backplane broker closed the connection")
+                return
+            command, key, frame = line.decode().rstrip("\n").split(" ", 2)
+            if command == "MSG":
+                self._receive(key, frame)
+
+
+class UnixSocketBroker:
+    """Minimal fan-out broker for ``UnixSocketBackplane`` workers on one host."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._server: Optional[asyncio.AbstractServer] = None
+        self._subscribers: Dict[str, Set[asyncio.StreamWriter]] = {}
+
+    async def start(self) -> None:
+        self._server = await asyncio.start_unix_server(self._handle, self.path, limit=UNIX_LINE_LIMIT)
+
+    async def stop(self) -> None:
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        rooms: Set[str] = set()
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                command, _, rest = line.decode().rstrip("\n").partition(" ")
+                if command == "SUB":
+                    rooms.add(rest)
+                    self._subscribers.setdefault(rest, set()).add(writer)
+                elif command == "UNSUB":
+                    rooms.discard(rest)
+                    self._unsubscribe(rest, writer)
+                elif command == "PUB":
+                    key, _, frame = rest.partition(" ")
+                    out = f"MSG {key} {frame}\n".encode()
+                    for subscriber in self._subscribers.get(key, ()):
+                        if subscriber is not writer:
+                            subscriber.write(out)
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            for key in rooms:
+                self._unsubscribe(key, writer)
+            writer.close()
+
+    def _unsubscribe(self, key: str, writer: asyncio.StreamWriter) -> None:
+        subscribers = self._subscribers.get(key)
+        if subscribers is None:
+            return
+        subscribers.discard(writer)
+        if not subscribers:
+            del self._subscribers[key]
+
+
+def create_backplane(url: str = BACKPLANE_URL) -> Backplane:
+    if url.startswith("memory://"):
+        return InProcessBackplane()
+    if url.startswith("unix://"):
+        return UnixSocketBackplane(url[len("unix://"):])
+    if url.startswith("postgresql"):
+        return PostgresBackplane(url)
+    raise ValueError(f"unsupported backplane url: {url}")
+
+
+async def run_broker(path: str) -> None:
+    broker = UnixSocketBroker(path)
+    await broker.start()
+    logger.info(f"backplane broker listening on {path}")
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await broker.stop()
+
+
+if __name__ == "__main__":
+    import sys
+
+    logging.basicConfig(level=logging.INFO)
+    try:
+        asyncio.run(run_broker(sys.argv[1] if len(sys.argv) > 1 else "/tmp/chat-backplane.sock"))
+    except KeyboardInterrupt:
+        pass
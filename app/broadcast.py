@@ -0,0 +1,394 @@
+"""Room fan-out with one bounded outbound queue and writer task per connection.
+
+Broadcasting only enqueues, so a slow socket never delays delivery to the rest
+of the room. When a connection's queue is full the slow-consumer policy decides
+what happens:
+
+* ``drop_oldest``: discard the oldest queued frame to make room.
+* ``coalesce``: a frame sent with a ``key`` replaces the queued frame with the
+  same key, so a slow socket gets the latest state rather than a backlog of
+  updates; otherwise the oldest frame is dropped. Keyed frames: heartbeat
+  pings, rate-limit notices and presence (``app.presence`` turns a pending
+  delta into a full snapshot, since deltas cannot replace each other).
+* ``disconnect``: close the connection; the client can reconnect and refetch.
+
+A connection with a ``wire`` (see ``app.wire``) converts each JSON text frame
+to its negotiated format as it is queued.
+
+``ConnectionRegistry`` adds indexes by user and connection id on top of the
+rooms, so a user can have several connections (one per device or tab) and
+frames can be sent to one user, one user in one room, or a room minus the
+sender. Kicks and mutes look the user up directly instead of walking rooms.
+"""
+from collections import deque
+from typing import Any, Awaitable, Callable, Deque, Dict, Hashable, List, Optional, Set, Tuple
+import asyncio
+import itertools
+import logging
+import os
+
+from app import codec
+from app.wire import Wire
+
+logger = logging.getLogger(__name__)
+
+DROP_OLDEST = "drop_oldest"
+COALESCE = "coalesce"
+DISCONNECT = "disconnect"
+POLICIES = (DROP_OLDEST, COALESCE, DISCONNECT)
+
+SEND_QUEUE_SIZE = int(os.getenv("SEND_QUEUE_SIZE", "256"))
+SLOW_CONSUMER_POLICY = os.getenv("SLOW_CONSUMER_POLICY", DROP_OLDEST)
+
+# Close code used for the disconnect policy ("try again later").
+WS_1013_TRY_AGAIN_LATER = 1013
+# Close code for kicked connections.
+WS_1008_POLICY_VIOLATION = 1008
+
+MODERATION_PREFIX = '{"type":"moderation"'
+KICK = "kick"
+MUTE = "mute"
+UNMUTE = "unmute"
+MODERATION_ACTIONS = (KICK, MUTE, UNMUTE)
+
+_connection_ids = itertools.count(1)
+
+
+class Connection:
+    def __init__(
+        self,
+        send: Callable[[Any], Awaitable[None]],
+        close: Optional[Callable[[int], Awaitable[None]]] = None,
+        maxsize: int = SEND_QUEUE_SIZE,
+        policy: str = SLOW_CONSUMER_POLICY,
+        wire: Optional[Wire] = None,
+    ):
+        if policy not in POLICIES:
+            raise ValueError(f"unknown slow consumer policy: {policy}")
+        self._send = send
+        self._close = close
+        self.maxsize = maxsize
+        self.policy = policy
+        self.wire = wire
+        # Set by ConnectionRegistry.join.
+        self.id = next(_connection_ids)
+        self.user_id: Optional[Hashable] = None
+        self.room_id: Optional[Hashable] = None
+
+        # (coalesce key, frame, message id) per queued frame
+        self._queue: Deque[Tuple[Optional[Hashable], Any, Optional[int]]] = deque()
+        self._ready: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+        self.closed = False
+
+        self.sent = 0
+        self.dropped = 0
+        self.coalesced = 0
+
+    @classmethod
+    def for_websocket(cls, websocket, **kwargs) -> "Connection":
+        async def send(frame: Any) -> None:
+            if isinstance(frame, bytes):
+                await websocket.send_bytes(frame)
+            else:
+                await websocket.send_text(frame)
+
+        async def close(code: int) -> None:
+            await websocket.close(code=code)
+        return cls(send, close, **kwargs)
+
+    def start(self) -> None:
+        self._ready = asyncio.Event()
+        if self._queue:
+            self._ready.set()
+        self._task = asyncio.create_task(self._run())
+
+    def enqueue(self, frame: Any, key: Optional[Hashable] = None, seq: Optional[int] = None) -> bool:
+        """Queue a frame for delivery. Returns False if the connection is (now) closed.
+
+        ``seq`` is the id of the message the frame carries, if any; it lets
+        ``replay`` drop live frames that the replay already covers.
+        """
+        if self.closed:
+            return False
+        if self.wire is not None:
+            frame = self.wire.encode(frame)
+
+        if self.policy == COALESCE and key is not None and self._replace(key, frame):
+            self.coalesced += 1
+            return True
+
+        if len(self._queue) >= self.maxsize:
+            if self.policy == DISCONNECT:
+                self.dropped += len(self._queue) + 1
+                self._queue.clear()
+                self._shutdown(WS_1013_TRY_AGAIN_LATER)
+                return False
+            self._queue.popleft()
+            self.dropped += 1
+
+        self._queue.append((key, frame, seq))
+        if self._ready is not None:
+            self._ready.set()
+        return True
+
+    def replay(self, frames: List[Tuple[int, Any]], extra: Optional[Any] = None) -> None:
+        """Put missed frames ``(message id, frame)``, oldest first, ahead of the live queue.
+
+        Call before ``start``. Live frames queued meanwhile for messages the
+        replay already contains are dropped, so nothing is delivered twice.
+        ``extra`` is an optional frame sent right after the replayed ones.
+        """
+        if frames:
+            last_id = frames[-1][0]
+            self._queue = deque(item for item in self._queue if item[2] is None or item[2] > last_id)
+        encode = self.wire.encode if self.wire is not None else (lambda frame: frame)
+        if extra is not None:
+            self._queue.appendleft((None, encode(extra), None))
+        for seq, frame in reversed(frames):
+            self._queue.appendleft((None, encode(frame), seq))
+
+    def pending(self, key: Hashable) -> bool:
+        """Whether a frame queued with ``key`` is still waiting and would be replaced by the next one."""
+        return self.policy == COALESCE and any(queued_key == key for queued_key, _, _ in self._queue)
+
+    def disconnect(self, code: int) -> None:
+        """Close the connection from the server side; queued frames are dropped."""
+        if self.closed:
+            return
+        self.dropped += len(self._queue)
+        self._queue.clear()
+        self._shutdown(code)
+
+    def queue_depth(self) -> int:
+        return len(self._queue)
+
+    async def close(self) -> None:
+        """Stop the writer task; anything still queued is discarded."""
+        self.closed = True
+        self._queue.clear()
+        if self._task is not None and self._task is not asyncio.current_task():
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        self._task = None
+
+    def _replace(self, key: Hashable, frame: Any) -> bool:
+        for i, (queued_key, _, seq) in enumerate(self._queue):
+            if queued_key == key:
+                self._queue[i] = (key, frame, seq)
+                return True
+        return False
+
+    def _shutdown(self, code: int) -> None:
+        self.closed = True
+        if self._ready is not None:
+            self._ready.set()
+        if self._close is not None:
+            asyncio.get_running_loop().create_task(self._close_quietly(code))
+
+    async def _close_quietly(self, code: int) -> None:
+        try:
+            await self._close(code)
+        except Exception:
+            pass
+
+    async def _run(self) -> None:
+        try:
+            while not self.closed:
+                if not self._queue:
+                    self._ready.clear()
+                    await self._ready.wait()
+                    continue
+                _, frame, _ = self._queue.popleft()
+                await self._send(frame)
+                self.sent += 1
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.info(f"send failed, closing connection: {e}")
+            self.closed = True
+            self._queue.clear()
+
+
+class Broadcaster:
+    def __init__(self):
+        self.rooms: Dict[Hashable, Set[Connection]] = {}
+        self.disconnected = 0
+
+    def join(self, room_id: Hashable, connection: Connection) -> bool:
+        """Add a connection; returns True if it is the first one in the room."""
+        members = self.rooms.setdefault(room_id, set())
+        members.add(connection)
+        return len(members) == 1
+
+    def leave(self, room_id: Hashable, connection: Connection) -> None:
+        members = self.rooms.get(room_id)
+        if members is None:
+            return
+        members.discard(connection)
+        if not members:
+            del self.rooms[room_id]
+
+    def broadcast(
+        self,
+        room_id: Hashable,
+        frame: Any,
+        key: Optional[Hashable] = None,
+        seq: Optional[int] = None,
+        exclude: Optional[Connection] = None
+    ) -> int:
+        """Enqueue ``frame`` for every connection in the room but ``exclude``; returns how many accepted it."""
+        delivered = 0
+        for connection in list(self.rooms.get(room_id, ())):
+            if connection is exclude:
+                continue
+            if self._enqueue(room_id, connection, frame, key, seq):
+                delivered += 1
+        return delivered
+
+    def stats(self) -> dict:
+        connections = [c for members in self.rooms.values() for c in members]
+        return {
+            "rooms": len(self.rooms),
+            "connections": len(connections),
+            "queued": sum(c.queue_depth() for c in connections),
+            "dropped": sum(c.dropped for c in connections),
+            "coalesced": sum(c.coalesced for c in connections),
+            "disconnected": self.disconnected,
+        }
+
+    def _enqueue(
+        self, room_id: Hashable, connection: Connection, frame: Any, key: Optional[Hashable] = None, seq: Optional[int] = None
+    ) -> bool:
+        if connection.enqueue(frame, key, seq):
+            return True
+        self.disconnected += 1
+        self.leave(room_id, connection)
+        return False
+
+
+class ConnectionRegistry(Broadcaster):
+    """Connections indexed by room, by user (and user within a room) and by id.
+
+    Adding and removing a connection, finding a user's connections and
+    checking a mute are all O(1). Mutes are kept per worker; ``moderation``
+    frames published on a room's channel carry kicks and mutes to the other
+    workers serving the room (see ``receive``).
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.connections: Dict[int, Connection] = {}
+        # user id -> room id -> that user's connections in the room
+        self.users: Dict[Hashable, Dict[Hashable, Set[Connection]]] = {}
+        # (user id, room id); room id None mutes the user everywhere
+        self._muted: Set[Tuple[Hashable, Optional[Hashable]]] = set()
+
+        self.targeted = 0
+        self.kicked = 0
+
+    def join(self, room_id: Hashable, connection: Connection, user_id: Optional[Hashable] = None) -> bool:
+        connection.room_id = room_id
+        connection.user_id = user_id
+        self.connections[connection.id] = connection
+        if user_id is not None:
+            self.users.setdefault(user_id, {}).setdefault(room_id, set()).add(connection)
+        return super().join(room_id, connection)
+
+    def leave(self, room_id: Hashable, connection: Connection) -> None:
+        super().leave(room_id, connection)
+        if self.connections.get(connection.id) is not connection:
+            return
+        del self.connections[connection.id]
+        rooms = self.users.get(connection.user_id)
+        if rooms is None:
+            return
+        members = rooms.get(room_id)
+        if members is not None:
+            members.discard(connection)
+            if not members:
+                del rooms[room_id]
+        if not rooms:
+            del self.users[connection.user_id]
+
+    def remove(self, connection: Connection) -> None:
+        self.leave(connection.room_id, connection)
+
+    def get(self, connection_id: int) -> Optional[Connection]:
+        return self.connections.get(connection_id)
+
+    def user_connections(self, user_id: Hashable, room_id: Optional[Hashable] = None) -> List[Connection]:
+        """The user's connections in ``room_id``, or in every room when it is None."""
+        rooms = self.users.get(user_id)
+        if not rooms:
+            return []
+        if room_id is not None:
+            return list(rooms.get(room_id, ()))
+        return [connection for members in rooms.values() for connection in members]
+
+    def send_to_connection(self, connection_id: int, frame: Any, key: Optional[Hashable] = None) -> bool:
+        connection = self.connections.get(connection_id)
+        if connection is None:
+            return False
+        self.targeted += 1
+        return self._enqueue(connection.room_id, connection, frame, key)
+
+    def send_to_user(
+        self, user_id: Hashable, frame: Any, room_id: Optional[Hashable] = None, key: Optional[Hashable] = None
+    ) -> int:
+        """Enqueue ``frame`` for the user's connections (in ``room_id`` only, if given)."""
+        self.targeted += 1
+        return sum(self._enqueue(c.room_id, c, frame, key) for c in self.user_connections(user_id, room_id))
+
+    def kick(self, user_id: Hashable, room_id: Optional[Hashable] = None, code: int = WS_1008_POLICY_VIOLATION) -> int:
+        """Close the user's connections (in ``room_id`` only, if given); returns how many."""
+        connections = self.user_connections(user_id, room_id)
+        for connection in connections:
+            self.remove(connection)
+            connection.disconnect(code)
+        self.kicked += len(connections)
+        return len(connections)
+
+    def mute(self, user_id: Hashable, room_id: Optional[Hashable] = None) -> None:
+        self._muted.add((user_id, room_id))
+
+    def unmute(self, user_id: Hashable, room_id: Optional[Hashable] = None) -> None:
+        self._muted.discard((user_id, room_id))
+
+    def is_muted(self, user_id: Hashable, room_id: Hashable) -> bool:
+        return (user_id, room_id) in self._muted or (user_id, None) in self._muted
+
+    def is_moderation(self, frame: str) -> bool:
+        return frame.startswith(MODERATION_PREFIX)
+
+    def moderation(self, action: str, user_id: Hashable) -> str:
+        """The frame that applies ``action`` to a user in the room it is published to."""
+        if action not in MODERATION_ACTIONS:
+            raise ValueError(f"unknown moderation action: {action}")
+        return codec.dumps({"type": "moderation", "action": action, "user_id": user_id})
+
+    def receive(self, room_id: Hashable, frame: str) -> None:
+        """Apply a ``moderation`` frame from the room's channel."""
+        data = codec.loads(frame)
+        action, user_id = data["action"], data["user_id"]
+        if action == KICK:
+            self.kick(user_id, room_id)
+            return
+        if action == MUTE:
+            self.mute(user_id, room_id)
+        else:
+            self.unmute(user_id, room_id)
+        # Every device of the user in the room learns about it.
+        self.send_to_user(user_id, codec.dumps({"type": "muted", "room_id": room_id, "muted": action == MUTE}), room_id)
+
+    def stats(self) -> dict:
+        return {
+            **super().stats(),
+            "users": len(self.users),
+            "muted": len(self._muted),
+            "targeted": self.targeted,
+            "kicked": self.kicked,
+        }
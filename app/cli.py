@@ -0,0 +1,113 @@
+"""Command line entry points.
+
+    python -m app.cli export ROOM_ID [-o FILE] [--gzip]
+    python -m app.cli archive [--archive-dir DIR]
+    python -m app.cli partitions [--months-ahead N]
+    python -m app.cli provision FILE [--format csv|ndjson] [--workers N]
+"""
+import argparse
+import json
+import sys
+
+from app.database import SessionLocal
+from app.export import EXPORT_BATCH_SIZE, gzip_chunks, iter_export
+from app.provisioning import (
+    PROVISION_BATCH_SIZE,
+    PROVISION_BCRYPT_ROUNDS,
+    PROVISION_HASH_EXECUTOR,
+    PROVISION_HASH_WORKERS,
+    UserProvisioner,
+    format_for,
+    parse_records,
+)
+from app.retention import ARCHIVE_DIR, PARTITION_MONTHS_AHEAD, archive_expired, ensure_partitions
+
+
+def export_command(args: argparse.Namespace) -> int:
+    out = open(args.output, "wb") if args.output != "-" else sys.stdout.buffer
+    db = SessionLocal()
+    try:
+        chunks = iter_export(db, args.room_id, args.batch_size)
+        if args.gzip:
+            chunks = gzip_chunks(chunks)
+        for chunk in chunks:
+            out.write(chunk)
+    finally:
+        db.close()
+        if out is not sys.stdout.buffer:
+            out.close()
+    return 0
+
+
+def archive_command(args: argparse.Namespace) -> int:
+    db = SessionLocal()
+    try:
+        result = archive_expired(db, args.archive_dir)
+    finally:
+        db.close()
+    print(json.dumps(result))
+    return 0
+
+
+def partitions_command(args: argparse.Namespace) -> int:
+    db = SessionLocal()
+    try:
+        created = ensure_partitions(db, args.months_ahead)
+    finally:
+        db.close()
+    print(json.dumps({"partitions_created": created}))
+    return 0
+
+
+def provision_command(args: argparse.Namespace) -> int:
+    source = open(args.file, encoding="utf-8") if args.file != "-" else sys.stdin
+    try:
+        data = source.read()
+    finally:
+        if source is not sys.stdin:
+            source.close()
+    provisioner = UserProvisioner(args.executor, args.workers, args.rounds, args.batch_size)
+    db = SessionLocal()
+    try:
+        report = provisioner.provision(db, parse_records(data, args.format or format_for(args.file)))
+    finally:
+        db.close()
+        provisioner.shutdown()
+    print(json.dumps(report))
+    return 1 if report["errors"] else 0
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(prog="python -m app.cli")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    export = commands.add_parser("export", help="stream a room's history as NDJSON")
+    export.add_argument("room_id", type=int)
+    export.add_argument("-o", "--output", default="-", help="output file (default: stdout)")
+    export.add_argument("--gzip", action="store_true", help="gzip-compress the output")
+    export.add_argument("--batch-size", type=int, default=EXPORT_BATCH_SIZE, help="rows fetched per round trip")
+    export.set_defaults(handler=export_command)
+
+    archive = commands.add_parser("archive", help="move messages past their room's retention into compressed archive files")
+    archive.add_argument("--archive-dir", default=ARCHIVE_DIR, help=f"archive root (default: {ARCHIVE_DIR})")
+    archive.set_defaults(handler=archive_command)
+
+    partitions = commands.add_parser("partitions", help="create upcoming monthly message partitions (Postgres)")
+    partitions.add_argument("--months-ahead", type=int, default=PARTITION_MONTHS_AHEAD)
+    partitions.set_defaults(handler=partitions_command)
+
+    provision = commands.add_parser("provision", help="create users in bulk from CSV or NDJSON")
+    provision.add_argument("file", help="input file, '-' for stdin (CSV if it ends in .csv)")
+    provision.add_argument("--format", choices=("csv", "ndjson"))
+    provision.add_argument("--executor", choices=("thread", "process"), default=PROVISION_HASH_EXECUTOR)
+    provision.add_argument("--workers", type=int, default=PROVISION_HASH_WORKERS, help="parallel password hashers")
+    provision.add_argument("--rounds", type=int, default=PROVISION_BCRYPT_ROUNDS, help="bcrypt cost for imported passwords")
+    provision.add_argument("--batch-size", type=int, default=PROVISION_BATCH_SIZE, help="users deduplicated and inserted per batch")
+    provision.set_defaults(handler=provision_command)
+
+    args = parser.parse_args(argv)
+    return args.handler(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,30 @@
+"""JSON encoding for WebSocket frames.
+
+Uses orjson when it is installed and falls back to the stdlib ``json`` module
+otherwise. Both produce compact text frames that can be built once and sent to
+every client in a room.
+"""
+from typing import Any, Union
+import json
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover - depends on the environment
+    orjson = None
+
+CODEC = "orjson" if orjson is not None else "json"
+
+
+def dumps_stdlib(obj: Any) -> str:
+    return json.dumps(obj, separators=(",", ":"), ensure_ascii=False)
+
+
+if orjson is not None:
+    def dumps(obj: Any) -> str:
+        return orjson.dumps(obj).decode()
+
+    def loads(data: Union[str, bytes]) -> Any:
+        return orjson.loads(data)
+else:
+    dumps = dumps_stdlib
+    loads = json.loads
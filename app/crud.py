@@ -1,7 +1,9 @@
+from sqlalchemy import func, insert, text
 from sqlalchemy.orm import Session
-from typing import List, Optional
+from sqlalchemy.ext.asyncio import AsyncSession
+from typing import Dict, Iterable, List, Optional, Tuple
 from datetime import datetime
-from app import models
+from app import models, search
 
 def create_user(db: Session, username: str, email: str, hashed_password: str) -> models.User:
     db_user = models.User(username=username, email=email, hashed_password=hashed_password)
@@ -10,6 +12,12 @@ def create_user(db: Session, username: str, email: str, hashed_password: str) ->
     db.refresh(db_user)
     return db_user
 
+def update_user_password(db: Session, user: models.User, hashed_password: str) -> models.User:
+    user.hashed_password = hashed_password
+    db.commit()
+    db.refresh(user)
+    return user
+
 def get_user_by_username(db: Session, username: str) -> Optional[models.User]:
     return db.query(models.User).filter(models.User.username == username).first()
 
@@ -19,8 +27,20 @@ def get_user_by_email(db: Session, email: str) -> Optional[models.User]:
 def get_user_by_id(db: Session, user_id: int) -> Optional[models.User]:
     return db.query(models.User).filter(models.User.id == user_id).first()
 
-def create_chatroom(db: Session, name: str, theme: str = None) -> models.Chatroom:
-    db_chatroom = models.Chatroom(name=name, theme=theme)
+def get_usernames(db: Session, user_ids: Iterable[int]) -> Dict[int, str]:
+    ids = set(user_ids)
+    if not ids:
+        return {}
+    return dict(db.query(models.User.id, models.User.username).filter(models.User.id.in_(ids)).all())
+
+def get_persona_names(db: Session, persona_ids: Iterable[int]) -> Dict[int, str]:
+    ids = set(persona_ids)
+    if not ids:
+        return {}
+    return dict(db.query(models.Persona.id, models.Persona.name).filter(models.Persona.id.in_(ids)).all())
+
+def create_chatroom(db: Session, name: str, theme: str = None, retention_days: Optional[int] = None) -> models.Chatroom:
+    db_chatroom = models.Chatroom(name=name, theme=theme, retention_days=retention_days)
     db.add(db_chatroom)
     db.commit()
     db.refresh(db_chatroom)
@@ -29,22 +49,105 @@ def create_chatroom(db: Session, name: str, theme: str = None) -> models.Chatroo
 def get_chatroom(db: Session, room_id: int) -> Optional[models.Chatroom]:
     return db.query(models.Chatroom).filter(models.Chatroom.id == room_id).first()
 
-def create_message(db: Session, room_id: int, content: str, user_id: Optional[int] = None, role: str = "user") -> models.Message:
+def set_chatroom_retention(db: Session, room: models.Chatroom, retention_days: Optional[int]) -> models.Chatroom:
+    room.retention_days = retention_days
+    db.commit()
+    db.refresh(room)
+    return room
+
+def create_persona(db: Session, name: str, system_prompt: Optional[str] = None, style: Optional[str] = None) -> models.Persona:
+    db_persona = models.Persona(name=name, system_prompt=system_prompt, style=style)
+    db.add(db_persona)
+    db.commit()
+    db.refresh(db_persona)
+    return db_persona
+
+def get_personas(db: Session) -> List[models.Persona]:
+    return db.query(models.Persona).order_by(models.Persona.id).all()
+
+def get_personas_by_names(db: Session, names: Iterable[str]) -> List[models.Persona]:
+    lowered = {name.lower() for name in names}
+    if not lowered:
+        return []
+    return db.query(models.Persona).filter(func.lower(models.Persona.name).in_(lowered)).order_by(models.Persona.id).all()
+
+def get_theme_by_name(db: Session, name: str) -> Optional[models.Theme]:
+    return db.query(models.Theme).filter(models.Theme.name == name).first()
+
+def get_themes(db: Session) -> List[models.Theme]:
+    return db.query(models.Theme).order_by(models.Theme.id).all()
+
+def create_message(
+    db: Session, room_id: int, content: str, user_id: Optional[int] = None, role: str = "user", persona_id: Optional[int] = None
+) -> models.Message:
     db_message = models.Message(
         room_id=room_id,
         user_id=user_id,
+        persona_id=persona_id,
         content=content,
         role=role
     )
     db.add(db_message)
+    db.flush()
+    search.index_messages(db, [(db_message.id, content)])
     db.commit()
     db.refresh(db_message)
     return db_message
 
-def get_messages(db: Session, room_id: int, limit: int = 50) -> List[models.Message]:
-    return db.query(models.Message).filter(
-        models.Message.room_id == room_id
-    ).order_by(models.Message.created_at.desc()).limit(limit).all()
+def create_messages(db: Session, rows: List[dict]) -> int:
+    if not rows:
+        return 0
+    ids = db.execute(
+        insert(models.Message).returning(models.Message.id, sort_by_parameter_order=True), rows
+    ).scalars().all()
+    search.index_messages(db, zip(ids, (row["content"] for row in rows)))
+    db.commit()
+    return len(rows)
+
+def reserve_message_ids(db: Session, count: int, floor: int = 0) -> List[int]:
+    if db.get_bind().dialect.name == "postgresql":
+        ids = db.execute(
+            text("SELECT nextval('messages_id_seq') FROM generate_series(1, :n)"), {"n": count}
+        ).scalars().all()
+    else:
+        # No sequences here: hand out ids above both the stored maximum and the
+        # last id already handed out (``floor``) but possibly not yet flushed.
+        # Only safe with a single writer process, which is all SQLite supports.
+        # sqlite_sequence remembers ids of rows since deleted by archival.
+        stored = db.execute(text(
+            "SELECT max(coalesce((SELECT max(id) FROM messages), 0), "
+            "coalesce((SELECT seq FROM sqlite_sequence WHERE name = 'messages'), 0))"
+        )).scalar_one()
+        start = max(stored, floor) + 1
+        ids = list(range(start, start + count))
+    db.commit()
+    return list(ids)
+
+def get_messages(
+    db: Session,
+    room_id: int,
+    limit: int = 50,
+    before_id: Optional[int] = None,
+    after_id: Optional[int] = None
+) -> List[models.Message]:
+    # Keyset pagination: ids are unique and increase with time, so each page
+    # is one range scan on ix_messages_room_id_id. Results are newest first.
+    query = db.query(models.Message).filter(models.Message.room_id == room_id)
+    if before_id is not None:
+        query = query.filter(models.Message.id < before_id)
+    if after_id is not None:
+        query = query.filter(models.Message.id > after_id)
+        return list(reversed(query.order_by(models.Message.id.asc()).limit(limit).all()))
+    return query.order_by(models.Message.id.desc()).limit(limit).all()
+
+def search_messages(
+    db: Session,
+    q: str,
+    room_id: Optional[int] = None,
+    limit: int = 20,
+    cursor: Optional[str] = None
+) -> Tuple[List[Tuple[models.Message, float]], Optional[str]]:
+    return search.search_messages(db, q, room_id, limit, cursor)
 
 def create_session(db: Session, user_id: int, expires_at: datetime) -> models.Session:
     db_session = models.Session(user_id=user_id, expires_at=expires_at)
@@ -58,3 +161,87 @@ def delete_session(db: Session, session_id: int) -> None:
     if db_session:
         db.delete(db_session)
         db.commit()
+
+# Async variants for the request handlers. Each one runs the sync query above
+# on the AsyncSession's greenlet bridge, so database I/O never blocks the event
+# loop and both paths share a single implementation.
+
+async def acreate_user(db: AsyncSession, username: str, email: str, hashed_password: str) -> models.User:
+    return await db.run_sync(create_user, username, email, hashed_password)
+
+async def aupdate_user_password(db: AsyncSession, user: models.User, hashed_password: str) -> models.User:
+    return await db.run_sync(update_user_password, user, hashed_password)
+
+async def aget_user_by_username(db: AsyncSession, username: str) -> Optional[models.User]:
+    return await db.run_sync(get_user_by_username, username)
+
+async def aget_user_by_email(db: AsyncSession, email: str) -> Optional[models.User]:
+    return await db.run_sync(get_user_by_email, email)
+
+async def aget_user_by_id(db: AsyncSession, user_id: int) -> Optional[models.User]:
+    return await db.run_sync(get_user_by_id, user_id)
+
+async def aget_usernames(db: AsyncSession, user_ids: Iterable[int]) -> Dict[int, str]:
+    return await db.run_sync(get_usernames, user_ids)
+
+async def aget_persona_names(db: AsyncSession, persona_ids: Iterable[int]) -> Dict[int, str]:
+    return await db.run_sync(get_persona_names, persona_ids)
+
+async def acreate_chatroom(db: AsyncSession, name: str, theme: str = None, retention_days: Optional[int] = None) -> models.Chatroom:
+    return await db.run_sync(create_chatroom, name, theme, retention_days)
+
+async def aget_chatroom(db: AsyncSession, room_id: int) -> Optional[models.Chatroom]:
+    return await db.run_sync(get_chatroom, room_id)
+
+async def aset_chatroom_retention(db: AsyncSession, room: models.Chatroom, retention_days: Optional[int]) -> models.Chatroom:
+    return await db.run_sync(set_chatroom_retention, room, retention_days)
+
+async def acreate_persona(db: AsyncSession, name: str, system_prompt: Optional[str] = None, style: Optional[str] = None) -> models.Persona:
+    return await db.run_sync(create_persona, name, system_prompt, style)
+
+async def aget_personas(db: AsyncSession) -> List[models.Persona]:
+    return await db.run_sync(get_personas)
+
+async def aget_personas_by_names(db: AsyncSession, names: Iterable[str]) -> List[models.Persona]:
+    return await db.run_sync(get_personas_by_names, names)
+
+async def aget_theme_by_name(db: AsyncSession, name: str) -> Optional[models.Theme]:
+    return await db.run_sync(get_theme_by_name, name)
+
+async def aget_themes(db: AsyncSession) -> List[models.Theme]:
+    return await db.run_sync(get_themes)
+
+async def acreate_message(
+    db: AsyncSession, room_id: int, content: str, user_id: Optional[int] = None, role: str = "user", persona_id: Optional[int] = None
+) -> models.Message:
+    return await db.run_sync(create_message, room_id, content, user_id, role, persona_id)
+
+async def acreate_messages(db: AsyncSession, rows: List[dict]) -> int:
+    return await db.run_sync(create_messages, rows)
+
+async def areserve_message_ids(db: AsyncSession, count: int, floor: int = 0) -> List[int]:
+    return await db.run_sync(reserve_message_ids, count, floor)
+
+async def aget_messages(
+    db: AsyncSession,
+    room_id: int,
+    limit: int = 50,
+    before_id: Optional[int] = None,
+    after_id: Optional[int] = None
+) -> List[models.Message]:
+    return await db.run_sync(get_messages, room_id, limit, before_id, after_id)
+
+async def asearch_messages(
+    db: AsyncSession,
+    q: str,
+    room_id: Optional[int] = None,
+    limit: int = 20,
+    cursor: Optional[str] = None
+) -> Tuple[List[Tuple[models.Message, float]], Optional[str]]:
+    return await db.run_sync(search_messages, q, room_id, limit, cursor)
+
+async def acreate_session(db: AsyncSession, user_id: int, expires_at: datetime) -> models.Session:
+    return await db.run_sync(create_session, user_id, expires_at)
+
+async def adelete_session(db: AsyncSession, session_id: int) -> None:
+    await db.run_sync(delete_session, session_id)
@@ -0,0 +1,79 @@
+"""Streaming NDJSON export of a room's full message history.
+
+Rows are read through a server-side cursor in ``EXPORT_BATCH_SIZE`` batches
+and encoded one line at a time, optionally gzip-compressed on the fly, so
+memory use does not depend on the size of the room.
+"""
+from typing import AsyncIterator, Iterable, Iterator
+import os
+import zlib
+
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session
+
+from app import codec, models
+
+EXPORT_BATCH_SIZE = int(os.getenv("EXPORT_BATCH_SIZE", "1000"))
+
+EXPORT_COLUMNS = (
+    models.Message.id,
+    models.Message.room_id,
+    models.Message.user_id,
+    models.Message.persona_id,
+    models.Message.role,
+    models.Message.content,
+    models.Message.created_at,
+)
+
+
+def export_statement(room_id: int, batch_size: int = EXPORT_BATCH_SIZE):
+    # Plain column rows rather than ORM objects: nothing lands in the
+    # identity map, and yield_per streams from a server-side cursor.
+    return (
+        select(*EXPORT_COLUMNS)
+        .where(models.Message.room_id == room_id)
+        .order_by(models.Message.id)
+        .execution_options(yield_per=batch_size)
+    )
+
+
+def export_line(row) -> str:
+    return codec.dumps({
+        "id": row.id,
+        "room_id": row.room_id,
+        "user_id": row.user_id,
+        "persona_id": row.persona_id,
+        "role": row.role,
+        "content": row.content,
+        "created_at": row.created_at.isoformat() if row.created_at is not None else None,
+    }) + "\n"
+
+
+def iter_export(db: Session, room_id: int, batch_size: int = EXPORT_BATCH_SIZE) -> Iterator[bytes]:
+    for row in db.execute(export_statement(room_id, batch_size)):
+        yield export_line(row).encode()
+
+
+async def aiter_export(db: AsyncSession, room_id: int, batch_size: int = EXPORT_BATCH_SIZE) -> AsyncIterator[bytes]:
+    result = await db.stream(export_statement(room_id, batch_size))
+    async for rows in result.partitions():
+        yield "".join(export_line(row) for row in rows).encode()
+
+
+def gzip_chunks(chunks: Iterable[bytes]) -> Iterator[bytes]:
+    compressor = zlib.compressobj(wbits=31)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+async def agzip_chunks(chunks: AsyncIterator[bytes]) -> AsyncIterator[bytes]:
+    compressor = zlib.compressobj(wbits=31)
+    async for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
@@ -0,0 +1,169 @@
+"""Server-driven heartbeats and reaping of dead WebSocket connections.
+
+Every tracked connection records when the client was last heard from; any
+frame counts, including the ``{"type": "pong"}`` reply to a ping. A single
+sweeper task runs every half ``HEARTBEAT_INTERVAL_SECONDS`` (no timer per
+socket) and
+
+* sends ``{"type": "ping", "ts": <ms>}`` to connections that have been quiet
+  for ``HEARTBEAT_INTERVAL_SECONDS``,
+* reaps connections quiet for ``HEARTBEAT_TIMEOUT_SECONDS``: they are closed,
+  so the next broadcast skips and forgets them and their receive loop ends
+  and cleans up,
+* releases the state of rooms that have had no connections for
+  ``ROOM_IDLE_SECONDS``.
+
+Pings are queued like any other frame; only an answer (or any other frame
+from the client) proves the connection alive.
+"""
+from typing import Any, Callable, Dict, Hashable, Optional
+import asyncio
+import logging
+import os
+import time
+
+from app import codec
+from app.metrics import percentile
+
+logger = logging.getLogger(__name__)
+
+HEARTBEAT_INTERVAL_SECONDS = float(os.getenv("HEARTBEAT_INTERVAL_SECONDS", "20"))
+HEARTBEAT_TIMEOUT_SECONDS = float(os.getenv("HEARTBEAT_TIMEOUT_SECONDS", "60"))
+ROOM_IDLE_SECONDS = float(os.getenv("ROOM_IDLE_SECONDS", "300"))
+
+# Close code for reaped connections ("going away").
+WS_1001_GOING_AWAY = 1001
+
+
+def is_pong(data: Any) -> bool:
+    if isinstance(data, dict):
+        return data.get("type") == "pong"
+    if isinstance(data, str) and '"pong"' in data:
+        try:
+            return codec.loads(data).get("type") == "pong"
+        except (ValueError, AttributeError):
+            return False
+    return False
+
+
+class Tracked:
+    __slots__ = ("connection", "room_id", "connected_at", "last_seen")
+
+    def __init__(self, connection: Any, room_id: Hashable, now: float):
+        self.connection = connection
+        self.room_id = room_id
+        self.connected_at = now
+        self.last_seen = now
+
+
+class Heartbeat:
+    def __init__(
+        self,
+        interval: float = HEARTBEAT_INTERVAL_SECONDS,
+        timeout: float = HEARTBEAT_TIMEOUT_SECONDS,
+        room_idle: float = ROOM_IDLE_SECONDS
+    ):
+        self.interval = interval
+        self.timeout = timeout
+        self.room_idle = room_idle
+        self._tracked: Dict[Any, Tracked] = {}
+        self._room_sizes: Dict[Hashable, int] = {}
+        # room id -> when its last connection went away
+        self._idle_since: Dict[Hashable, float] = {}
+        self._release_room: Optional[Callable[[Hashable], None]] = None
+        self._task: Optional[asyncio.Task] = None
+
+        self.pings = 0
+        self.pongs = 0
+        self.reaped = 0
+        self.rooms_released = 0
+
+    async def start(self, release_room: Optional[Callable[[Hashable], None]] = None) -> None:
+        """``release_room(room_id)`` frees whatever is kept for a room that stayed empty."""
+        self._release_room = release_room
+        self._task = asyncio.create_task(self._sweep_forever())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        self._tracked.clear()
+        self._room_sizes.clear()
+        self._idle_since.clear()
+
+    def track(self, connection: Any, room_id: Hashable) -> None:
+        self._tracked[connection] = Tracked(connection, room_id, time.monotonic())
+        self._room_sizes[room_id] = self._room_sizes.get(room_id, 0) + 1
+        self._idle_since.pop(room_id, None)
+
+    def untrack(self, connection: Any) -> None:
+        tracked = self._tracked.pop(connection, None)
+        if tracked is None:
+            return
+        room_id = tracked.room_id
+        self._room_sizes[room_id] -= 1
+        if self._room_sizes[room_id] == 0:
+            del self._room_sizes[room_id]
+            self._idle_since[room_id] = time.monotonic()
+
+    def seen(self, connection: Any, pong: bool = False, now: Optional[float] = None) -> None:
+        tracked = self._tracked.get(connection)
+        if tracked is not None:
+            tracked.last_seen = time.monotonic() if now is None else now
+        if pong:
+            self.pongs += 1
+
+    def sweep(self, now: Optional[float] = None) -> None:
+        now = time.monotonic() if now is None else now
+        ping = None
+        for connection, tracked in list(self._tracked.items()):
+            quiet = now - tracked.last_seen
+            if quiet >= self.timeout:
+                self._reap(connection)
+            elif quiet >= self.interval:
+                if ping is None:
+                    # One frame object for every socket, so it is encoded once per format.
+                    ping = codec.dumps({"type": "ping", "ts": int(time.time() * 1000)})
+                connection.enqueue(ping, "ping")
+                self.pings += 1
+        for room_id, since in list(self._idle_since.items()):
+            if now - since >= self.room_idle:
+                del self._idle_since[room_id]
+                self.rooms_released += 1
+                if self._release_room is not None:
+                    self._release_room(room_id)
+
+    def stats(self) -> dict:
+        now = time.monotonic()
+        ages = sorted(now - t.connected_at for t in self._tracked.values())
+        return {
+            "connections": len(ages),
+            "rooms": len(self._room_sizes),
+            "idle_rooms": len(self._idle_since),
+            "pings": self.pings,
+            "pongs": self.pongs,
+            "reaped": self.reaped,
+            "rooms_released": self.rooms_released,
+            "connection_age_seconds": {
+                "p50": percentile(ages, 0.5),
+                "p99": percentile(ages, 0.99),
+                "max": ages[-1] if ages else 0.0,
+            },
+        }
+
+    def _reap(self, connection: Any) -> None:
+        self.reaped += 1
+        self.untrack(connection)
+        connection.disconnect(WS_1001_GOING_AWAY)
+
+    async def _sweep_forever(self) -> None:
+        while True:
+            await asyncio.sleep(min(self.interval, self.timeout) / 2)
+            try:
+                self.sweep()
+            except Exception as e:
+                logger.exception(f"heartbeat sweep failed: {e}")
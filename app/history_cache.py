@@ -0,0 +1,183 @@
+"""In-memory cache of the most recent messages of each room.
+
+Written by the broadcast path, read by the history endpoint. Each room keeps a
+bounded buffer of its newest messages ordered by id together with a ``floor``:
+every message of the room with an id above the floor is in the buffer. A read
+is answered from memory only when the requested window lies entirely above the
+floor, otherwise it is a miss and the caller falls back to the database.
+
+Rooms are evicted least recently used first once the estimated size of all
+buffers exceeds ``HISTORY_CACHE_MAX_BYTES``.
+"""
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict
+from typing import Hashable, Iterable, List, Optional
+import os
+
+from app import codec, models
+
+HISTORY_CACHE_ROOM_SIZE = int(os.getenv("HISTORY_CACHE_ROOM_SIZE", "500"))
+HISTORY_CACHE_MAX_BYTES = int(os.getenv("HISTORY_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+
+# Rough per-entry overhead of the dict and its values, on top of the content.
+ENTRY_OVERHEAD_BYTES = 400
+
+
+def entry_from_message(message: models.Message, username: Optional[str] = None) -> dict:
+    return {
+        "id": message.id,
+        "room_id": message.room_id,
+        "user_id": message.user_id,
+        "persona_id": message.persona_id,
+        "username": username,
+        "role": message.role,
+        "content": message.content,
+        "created_at": message.created_at,
+    }
+
+
+def entry_size(entry: dict) -> int:
+    content = entry["content"]
+    if isinstance(content, str):
+        return ENTRY_OVERHEAD_BYTES + len(content)
+    # Entries relayed from other workers carry whatever the frame held.
+    return ENTRY_OVERHEAD_BYTES + (len(codec.dumps(content)) if content is not None else 0)
+
+
+class RoomBuffer:
+    def __init__(self, floor: int):
+        self.ids: List[int] = []
+        self.entries: List[dict] = []
+        self.floor = floor
+        self.size = 0
+
+    def add(self, entry: dict) -> int:
+        """Insert an entry in id order; returns the change in size."""
+        message_id = entry["id"]
+        if message_id <= self.floor:
+            return 0
+        i = bisect_left(self.ids, message_id)
+        if i < len(self.ids) and self.ids[i] == message_id:
+            return 0
+        self.ids.insert(i, message_id)
+        self.entries.insert(i, entry)
+        size = entry_size(entry)
+        self.size += size
+        return size
+
+    def trim(self, capacity: int) -> int:
+        """Drop the oldest entries beyond capacity; returns the change in size."""
+        excess = len(self.ids) - capacity
+        if excess <= 0:
+            return 0
+        freed = sum(entry_size(entry) for entry in self.entries[:excess])
+        self.floor = self.ids[excess - 1]
+        del self.ids[:excess]
+        del self.entries[:excess]
+        self.size -= freed
+        return -freed
+
+    def window(self, limit: int, before_id: Optional[int], after_id: Optional[int]) -> Optional[List[dict]]:
+        """Newest-first page matching crud.get_messages, or None if not fully cached."""
+        end = len(self.ids) if before_id is None else bisect_left(self.ids, before_id)
+        if after_id is not None:
+            if after_id < self.floor:
+                return None
+            start = bisect_right(self.ids, after_id)
+            return self.entries[start:min(end, start + limit)][::-1]
+        start = max(0, end - limit)
+        if end - start < limit and self.floor != 0:
+            return None
+        return self.entries[start:end][::-1]
+
+
+class HistoryCache:
+    def __init__(self, room_size: int = HISTORY_CACHE_ROOM_SIZE, max_bytes: int = HISTORY_CACHE_MAX_BYTES):
+        self.room_size = room_size
+        self.max_bytes = max_bytes
+        self._rooms: "OrderedDict[Hashable, RoomBuffer]" = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def clear(self) -> None:
+        self._rooms.clear()
+        self.size = 0
+
+    def discard(self, room_id: Hashable) -> None:
+        """Forget a room whose new messages will no longer pass through this process."""
+        buffer = self._rooms.pop(room_id, None)
+        if buffer is not None:
+            self.size -= buffer.size
+
+    def append(self, room_id: Hashable, entry: dict) -> None:
+        buffer = self._rooms.get(room_id)
+        if buffer is None:
+            # Nothing is known about older messages yet, so the buffer only
+            # vouches for messages from this one on.
+            buffer = self._rooms[room_id] = RoomBuffer(floor=entry["id"] - 1)
+        self._rooms.move_to_end(room_id)
+        self.size += buffer.add(entry)
+        self.size += buffer.trim(self.room_size)
+        self._evict()
+
+    def seed(self, room_id: Hashable, messages: Iterable[models.Message], complete: bool) -> None:
+        """Merge a newest-first database page into the room buffer.
+
+        ``complete`` means the page reached the start of the room's history.
+        """
+        entries = [entry_from_message(m) for m in messages]
+        buffer = self._rooms.get(room_id)
+        if buffer is None:
+            buffer = self._rooms[room_id] = RoomBuffer(floor=0)
+        if complete:
+            buffer.floor = 0
+        elif entries:
+            buffer.floor = min(buffer.floor, entries[-1]["id"] - 1) if buffer.ids else entries[-1]["id"] - 1
+        for entry in entries:
+            self.size += buffer.add(entry)
+        self.size += buffer.trim(self.room_size)
+        self._rooms.move_to_end(room_id)
+        self._evict()
+
+    def get(
+        self,
+        room_id: Hashable,
+        limit: int,
+        before_id: Optional[int] = None,
+        after_id: Optional[int] = None
+    ) -> Optional[List[dict]]:
+        buffer = self._rooms.get(room_id)
+        page = buffer.window(limit, before_id, after_id) if buffer is not None else None
+        if page is None:
+            self.misses += 1
+            return None
+        self._rooms.move_to_end(room_id)
+        self.hits += 1
+        return page
+
+    def buffered_after(self, room_id: Hashable, after_id: int) -> List[dict]:
+        """Whatever is buffered after ``after_id``, newest first, complete or not."""
+        buffer = self._rooms.get(room_id)
+        if buffer is None:
+            return []
+        return buffer.entries[bisect_right(buffer.ids, after_id):][::-1]
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "rooms": len(self._rooms),
+            "messages": sum(len(b.ids) for b in self._rooms.values()),
+            "bytes": self.size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "evictions": self.evictions,
+        }
+
+    def _evict(self) -> None:
+        while self.size > self.max_bytes and len(self._rooms) > 1:
+            _, buffer = self._rooms.popitem(last=False)
+            self.size -= buffer.size
+            self.evictions += 1
@@ -1,30 +1,113 @@
-from fastapi import FastAPI, WebSocket, Depends, HTTPException, status, Response, Query
-from fastapi.responses import HTMLResponse
+from fastapi import FastAPI, WebSocket, WebSocketDisconnect, Depends, HTTPException, status, Request, Response, Query
+from fastapi.responses import HTMLResponse, StreamingResponse
+from fastapi.concurrency import run_in_threadpool
 from fastapi.security import HTTPBearer
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session
 from datetime import timedelta
-from typing import List, Optional
-import json
+from typing import Dict, List, Optional
+import asyncio
+import os
 
-from app.database import create_db_and_tables, get_db
+from app.database import create_db_and_tables, get_db, get_sync_db, async_engine, AsyncSessionLocal
 from app.auth import (
     get_current_user,
     authenticate_user,
     create_access_token,
-    get_password_hash,
     validate_websocket_auth,
+    auth_cache,
+    password_hasher,
     ACCESS_TOKEN_EXPIRE_MINUTES
 )
-from app import crud, schemas, models
+from app import codec, crud, schemas, models
+from app.persistence import MessageWriter
+from app.broadcast import KICK, MUTE, UNMUTE, Connection, ConnectionRegistry
+from app.heartbeat import Heartbeat, is_pong
+from app.presence import PRESENCE_KEY, Presence
+from app.ratelimit import DISCONNECT, DROP, NOTICE_KEY, RateLimiter, notice
+from app.wire import ENCODINGS, JSON, WireRegistry
+from app.backplane import create_backplane
+from app.history_cache import HistoryCache, entry_from_message
+from app.export import aiter_export, agzip_chunks
+from app.retention import read_archived
+from app.provisioning import UserProvisioner, format_for, parse_records
+from app.ai import CachingProvider, ContextStore, Generation, PersonaEngine, PersonaRouter, RoomContext, TurnScheduler, create_provider
+from app.ai.context import AI_CONTEXT_MESSAGES
+from app.ai.routing import AI_ROUTING_AUTO
 
 app = FastAPI()
 security = HTTPBearer()
 
-connected_clients = {}
+# Most messages replayed to a reconnecting socket; beyond that it is told to
+# refetch history over HTTP instead.
+RESUME_MAX_MESSAGES = int(os.getenv("RESUME_MAX_MESSAGES", "500"))
+# Longest message content (in characters) accepted over a socket.
+MESSAGE_MAX_LENGTH = int(os.getenv("MESSAGE_MAX_LENGTH", "4000"))
+# There are no roles yet: these usernames may kick and mute in every room,
+# and these may bulk-import users.
+MODERATOR_USERNAMES = {name for name in os.getenv("MODERATOR_USERNAMES", "").split(",") if name}
+OPERATOR_USERNAMES = {name for name in os.getenv("OPERATOR_USERNAMES", "").split(",") if name}
+
+broadcaster = ConnectionRegistry()
+backplane = create_backplane()
+history = HistoryCache()
+presence = Presence()
+heartbeat = Heartbeat()
+message_writer = MessageWriter()
+user_provisioner = UserProvisioner()
+rate_limiter = RateLimiter()
+wires = WireRegistry()
+persona_provider = CachingProvider(create_provider())
+persona_engine = PersonaEngine(persona_provider)
+contexts = ContextStore()
+turns = TurnScheduler()
+persona_router = PersonaRouter()
+# Theme of every room with sockets here, for routing un-addressed messages.
+room_themes: Dict[int, Optional[str]] = {}
+
+def get_moderator(current_user: models.User = Depends(get_current_user)) -> models.User:
+    if current_user.username not in MODERATOR_USERNAMES:
+        raise HTTPException(status_code=403, detail="Not a moderator")
+    return current_user
+
+def get_operator(current_user: models.User = Depends(get_current_user)) -> models.User:
+    if current_user.username not in OPERATOR_USERNAMES:
+        raise HTTPException(status_code=403, detail="Not an operator")
+    return current_user
 
 @app.on_event("startup")
 async def startup():
     create_db_and_tables()
+    history.clear()
+    contexts.clear()
+    auth_cache.clear()
+    await message_writer.start()
+    await backplane.start(deliver)
+    await presence.start(
+        lambda room_id: broadcaster.rooms.get(room_id, ()),
+        backplane.publish if backplane.cross_process else None,
+        backplane.worker_id
+    )
+    if backplane.cross_process:
+        await backplane.subscribe(presence.reply_channel)
+    async with AsyncSessionLocal() as db:
+        persona_router.sync_personas(await crud.aget_personas(db))
+        persona_router.sync_themes(await crud.aget_themes(db))
+    await heartbeat.start(release_room)
+    await persona_engine.start()
+    await turns.start(run_turn, route_message if AI_ROUTING_AUTO else None)
+
+@app.on_event("shutdown")
+async def shutdown():
+    await turns.stop()
+    await persona_engine.stop()
+    await presence.stop()
+    await heartbeat.stop()
+    await backplane.stop()
+    await message_writer.stop()
+    await async_engine.dispose()
+    password_hasher.shutdown()
+    user_provisioner.shutdown()
 
 @app.get("/")
 async def home():
@@ -35,22 +118,35 @@ async def home():
         return HTMLResponse("<h1>Chat Application</h1><p>WebSocket chat is available at /ws/{room_id}</p>")
 
 @app.post("/auth/signup", response_model=schemas.UserResponse, status_code=status.HTTP_201_CREATED)
-async def signup(user_data: schemas.UserCreate, db: Session = Depends(get_db)):
-    db_user = crud.get_user_by_username(db, user_data.username)
+async def signup(user_data: schemas.UserCreate, db: AsyncSession = Depends(get_db)):
+    db_user = await crud.aget_user_by_username(db, user_data.username)
     if db_user:
         raise HTTPException(status_code=400, detail="Username already registered")
     
-    db_user = crud.get_user_by_email(db, user_data.email)
+    db_user = await crud.aget_user_by_email(db, user_data.email)
     if db_user:
         raise HTTPException(status_code=400, detail="Email already registered")
     
-    hashed_password = get_password_hash(user_data.password)
-    user = crud.create_user(db, user_data.username, user_data.email, hashed_password)
+    hashed_password = await password_hasher.hash(user_data.password)
+    user = await crud.acreate_user(db, user_data.username, user_data.email, hashed_password)
     return user
 
+@app.post("/users/bulk", response_model=schemas.ProvisionReport)
+async def provision_users(
+    request: Request,
+    format: Optional[str] = Query(default=None, pattern="^(csv|ndjson)$"),
+    db: Session = Depends(get_sync_db),
+    operator: models.User = Depends(get_operator)
+):
+    """Create users from a CSV (username,email,password) or NDJSON body; operators only."""
+    data = (await request.body()).decode()
+    records = parse_records(data, format or format_for("", request.headers.get("content-type")))
+    # Hashing and the batched inserts block; run() keeps them off the event loop.
+    return await user_provisioner.run(db, records)
+
 @app.post("/auth/login", response_model=schemas.Token)
-async def login(response: Response, user_data: schemas.UserLogin, db: Session = Depends(get_db)):
-    user = authenticate_user(db, user_data.username, user_data.password)
+async def login(response: Response, user_data: schemas.UserLogin, db: AsyncSession = Depends(get_db)):
+    user = await authenticate_user(db, user_data.username, user_data.password)
     if not user:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
@@ -85,118 +181,495 @@ async def get_me(current_user: models.User = Depends(get_current_user)):
 @app.post("/rooms", response_model=schemas.ChatroomResponse)
 async def create_room(
     room_data: schemas.ChatroomCreate,
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_db),
     current_user: models.User = Depends(get_current_user)
 ):
-    room = crud.create_chatroom(db, room_data.name, room_data.theme)
+    room = await crud.acreate_chatroom(db, room_data.name, room_data.theme, room_data.retention_days)
     return room
 
+@app.put("/rooms/{room_id}/retention", response_model=schemas.ChatroomResponse)
+async def set_room_retention(
+    room_id: int,
+    retention: schemas.RetentionUpdate,
+    db: AsyncSession = Depends(get_db),
+    current_user: models.User = Depends(get_current_user)
+):
+    room = await crud.aget_chatroom(db, room_id)
+    if not room:
+        raise HTTPException(status_code=404, detail="Room not found")
+    return await crud.aset_chatroom_retention(db, room, retention.retention_days)
+
+@app.post("/personas", response_model=schemas.PersonaResponse, status_code=status.HTTP_201_CREATED)
+async def create_persona(
+    persona_data: schemas.PersonaCreate,
+    db: AsyncSession = Depends(get_db),
+    current_user: models.User = Depends(get_current_user)
+):
+    persona = await crud.acreate_persona(db, persona_data.name, persona_data.system_prompt, persona_data.style)
+    persona_router.sync_personas([persona], prune=False)
+    return persona
+
+@app.get("/personas", response_model=List[schemas.PersonaResponse])
+async def list_personas(db: AsyncSession = Depends(get_db)):
+    return await crud.aget_personas(db)
+
+@app.get("/personas/route", response_model=List[schemas.PersonaMatch])
+async def route_personas(
+    content: str = Query(min_length=1),
+    room_id: Optional[int] = Query(default=None),
+    k: int = Query(default=3, ge=1, le=20),
+    db: AsyncSession = Depends(get_db)
+):
+    """The personas most relevant to ``content``, best first, as the router ranks them."""
+    room = await crud.aget_chatroom(db, room_id) if room_id is not None else None
+    matches = persona_router.route(content, room.theme if room else None, k)
+    return [{"id": persona_id, "name": name, "score": score} for persona_id, name, score in matches]
+
+@app.get("/rooms/{room_id}/members", response_model=schemas.RoomPresence)
+async def get_room_members(room_id: int):
+    if backplane.cross_process and room_id not in broadcaster.rooms:
+        # Nobody here follows the room; ask the workers that do.
+        return await presence.lookup(room_id)
+    return presence.snapshot(room_id)
+
+async def moderate(room_id: int, action: str, user_id: int) -> dict:
+    # Published on the room's channel so workers holding the user's sockets apply it too.
+    await backplane.publish(room_id, broadcaster.moderation(action, user_id))
+    return {"room_id": room_id, "user_id": user_id, "action": action}
+
+@app.post("/rooms/{room_id}/members/{user_id}/kick")
+async def kick_member(room_id: int, user_id: int, moderator: models.User = Depends(get_moderator)):
+    return await moderate(room_id, KICK, user_id)
+
+@app.post("/rooms/{room_id}/members/{user_id}/mute")
+async def mute_member(room_id: int, user_id: int, moderator: models.User = Depends(get_moderator)):
+    return await moderate(room_id, MUTE, user_id)
+
+@app.delete("/rooms/{room_id}/members/{user_id}/mute")
+async def unmute_member(room_id: int, user_id: int, moderator: models.User = Depends(get_moderator)):
+    return await moderate(room_id, UNMUTE, user_id)
+
 @app.get("/rooms/{room_id}/messages", response_model=List[schemas.MessageResponse])
 async def get_room_messages(
     room_id: int,
-    limit: int = Query(default=50, le=100),
-    db: Session = Depends(get_db)
+    limit: int = Query(default=50, ge=1, le=100),
+    before_id: Optional[int] = Query(default=None),
+    after_id: Optional[int] = Query(default=None),
+    include_archived: bool = Query(default=False),
+    db: AsyncSession = Depends(get_db)
+):
+    page = await recent_messages(db, room_id, limit, before_id, after_id)
+    if include_archived and after_id is None and len(page) < limit:
+        # Older than anything left in the database: continue from the archive.
+        oldest = page[-1] if page else None
+        if oldest is not None:
+            before_id = oldest["id"] if isinstance(oldest, dict) else oldest.id
+        page = page + await run_in_threadpool(read_archived, room_id, limit - len(page), before_id)
+    return list(reversed(page))
+
+async def recent_messages(
+    db: AsyncSession,
+    room_id: int,
+    limit: int,
+    before_id: Optional[int],
+    after_id: Optional[int]
+) -> list:
+    """Newest-first page from the history cache or the database."""
+    cached = history.get(room_id, limit, before_id, after_id)
+    if cached is not None:
+        return cached
+    
+    room = await crud.aget_chatroom(db, room_id)
+    if not room:
+        raise HTTPException(status_code=404, detail="Room not found")
+    
+    messages = await crud.aget_messages(db, room_id, limit, before_id, after_id)
+    if before_id is None and after_id is None and history_tracks(room_id):
+        # Seed the cache with the newest page; merged with messages not yet
+        # flushed by the writer, it answers this and later reads.
+        history.seed(room_id, messages, complete=len(messages) < limit)
+        cached = history.get(room_id, limit)
+        if cached is not None:
+            return cached
+    return messages
+
+def search_response(results, next_cursor: Optional[str]) -> schemas.SearchResponse:
+    return schemas.SearchResponse(
+        results=[
+            schemas.SearchResult(**schemas.MessageResponse.model_validate(message).model_dump(), score=score)
+            for message, score in results
+        ],
+        next_cursor=next_cursor
+    )
+
+@app.get("/rooms/{room_id}/search", response_model=schemas.SearchResponse)
+async def search_room_messages(
+    room_id: int,
+    q: str = Query(min_length=1),
+    limit: int = Query(default=20, ge=1, le=100),
+    cursor: Optional[str] = Query(default=None),
+    db: AsyncSession = Depends(get_db)
+):
+    room = await crud.aget_chatroom(db, room_id)
+    if not room:
+        raise HTTPException(status_code=404, detail="Room not found")
+    
+    try:
+        results, next_cursor = await crud.asearch_messages(db, q, room_id, limit, cursor)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    return search_response(results, next_cursor)
+
+@app.get("/search", response_model=schemas.SearchResponse)
+async def search_all_messages(
+    q: str = Query(min_length=1),
+    limit: int = Query(default=20, ge=1, le=100),
+    cursor: Optional[str] = Query(default=None),
+    db: AsyncSession = Depends(get_db),
+    current_user: models.User = Depends(get_current_user)
+):
+    try:
+        results, next_cursor = await crud.asearch_messages(db, q, None, limit, cursor)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    return search_response(results, next_cursor)
+
+@app.get("/rooms/{room_id}/export")
+async def export_room_messages(
+    room_id: int,
+    gzip: bool = Query(default=False),
+    db: AsyncSession = Depends(get_db),
+    current_user: models.User = Depends(get_current_user)
 ):
-    room = crud.get_chatroom(db, room_id)
+    room = await crud.aget_chatroom(db, room_id)
     if not room:
         raise HTTPException(status_code=404, detail="Room not found")
     
-    messages = crud.get_messages(db, room_id, limit)
-    return list(reversed(messages))
+    async def body():
+        # The request's session is closed once the handler returns, so the
+        # export streams from a session of its own.
+        async with AsyncSessionLocal() as export_db:
+            chunks = aiter_export(export_db, room_id)
+            if gzip:
+                chunks = agzip_chunks(chunks)
+            async for chunk in chunks:
+                yield chunk
+    
+    filename = f"room-{room_id}.ndjson" + (".gz" if gzip else "")
+    return StreamingResponse(
+        body(),
+        media_type="application/gzip" if gzip else "application/x-ndjson",
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'}
+    )
+
+@app.get("/metrics")
+async def metrics():
+    return {
+        "persistence": message_writer.stats(),
+        "broadcast": broadcaster.stats(),
+        "presence": presence.stats(),
+        "heartbeat": heartbeat.stats(),
+        "rate_limit": rate_limiter.stats(),
+        "wire": wires.stats(),
+        "backplane": backplane.stats(),
+        "history": history.stats(),
+        "auth": auth_cache.stats(),
+        "password_hashing": password_hasher.stats(),
+        "provisioning": user_provisioner.stats(),
+        "ai": persona_engine.stats(),
+        "ai_context": contexts.stats(),
+        "ai_cache": persona_provider.stats(),
+        "ai_turns": turns.stats(),
+        "ai_routing": persona_router.stats(),
+    }
+
+def deliver(room_id: int, frame: str, message: Optional[dict] = None):
+    if message is None and presence.is_sync(frame):
+        presence.receive(room_id, frame)
+        return
+    if message is None and broadcaster.is_moderation(frame):
+        broadcaster.receive(room_id, frame)
+        return
+    if message is None:
+        message = history_entry(room_id, frame)
+    broadcaster.broadcast(room_id, frame, seq=message["id"] if message is not None else None)
+    if message is not None:
+        history.append(room_id, message)
+        contexts.observe(room_id, message)
+
+def history_entry(room_id: int, frame: str) -> Optional[dict]:
+    # Frames from other workers only carry the wire payload.
+    data = codec.loads(frame)
+    if "id" not in data or "role" not in data:
+        return None
+    return {
+        "id": data["id"],
+        "room_id": room_id,
+        "user_id": data.get("user_id"),
+        "persona_id": data.get("persona_id"),
+        "username": data.get("username"),
+        "role": data["role"],
+        "content": data["content"],
+        "created_at": data["created_at"]
+    }
+
+def release_room(room_id: int) -> None:
+    """Drop cached state of a room that has had no sockets here for a while."""
+    if room_id in broadcaster.rooms:
+        return
+    history.discard(room_id)
+    contexts.discard(room_id)
+
+def history_tracks(room_id: int) -> bool:
+    # With other workers publishing, this process only sees a room's messages
+    # while it has sockets in it; otherwise every message passes through here.
+    return not backplane.cross_process or room_id in broadcaster.rooms
+
+# Frames are encoded once per message and the same text is queued for every
+# connection in the room.
+
+def message_frame(entry: dict, stream_id: Optional[str] = None) -> str:
+    if entry["user_id"] is None and entry["role"] == "system":
+        return codec.dumps({
+            "id": entry["id"],
+            "user": None,
+            "username": "System",
+            "content": entry["content"],
+            "role": entry["role"],
+            "created_at": str(entry["created_at"])
+        })
+    frame = {
+        "id": entry["id"],
+        "user_id": entry["user_id"],
+        "username": entry["username"],
+        "content": entry["content"],
+        "role": entry["role"],
+        "created_at": str(entry["created_at"])
+    }
+    if entry.get("persona_id") is not None:
+        frame["persona_id"] = entry["persona_id"]
+    if stream_id is not None:
+        frame["stream_id"] = stream_id
+    return codec.dumps(frame)
+
+async def publish_message(room_id: int, message: models.Message, username: Optional[str] = None):
+    entry = entry_from_message(message, username)
+    await backplane.publish(room_id, message_frame(entry), entry)
+
+# A persona reply reaches the room as "ai_delta" frames while it is generated,
+# then as the persisted message; all of them carry the same stream_id so
+# clients can replace the partial reply with the final one.
+
+async def stream_delta(generation: Generation, delta: str) -> None:
+    frame = codec.dumps({
+        "type": "ai_delta",
+        "stream_id": generation.id,
+        "persona_id": generation.request.persona_id,
+        "username": generation.request.persona_name,
+        "delta": delta
+    })
+    await backplane.publish(generation.room_id, frame)
+
+async def run_turn(room_id: int, names: List[str], depth: int) -> List[Generation]:
+    """Queue one reply from each named persona; called by the turn scheduler."""
+    async with AsyncSessionLocal() as db:
+        personas = await crud.aget_personas_by_names(db, names)
+        if not personas:
+            return []
+        context = contexts.get(room_id) or await build_context(db, room_id)
+    generations = [
+        persona_engine.submit(room_id, context.request(persona), post_reply, stream_delta)
+        for persona in personas
+    ]
+    return [g for g in generations if g is not None]
+
+def route_message(room_id: int, content: str) -> List[str]:
+    return [name for _, name, _ in persona_router.route(content, room_themes.get(room_id))]
+
+async def build_context(db: AsyncSession, room_id: int) -> RoomContext:
+    room = await crud.aget_chatroom(db, room_id)
+    theme = await crud.aget_theme_by_name(db, room.theme) if room is not None and room.theme else None
+    entries = await recent_entries(db, room_id, AI_CONTEXT_MESSAGES)
+    context = contexts.seed(room_id, room.theme if room else None, theme.description if theme else None, entries)
+    if not history_tracks(room_id):
+        # Nothing would keep it current; use it for this turn only.
+        contexts.discard(room_id)
+    return context
+
+async def post_reply(generation: Generation) -> None:
+    message = await message_writer.submit(
+        generation.room_id, generation.text, None, "ai", generation.request.persona_id
+    )
+    entry = entry_from_message(message, generation.request.persona_name)
+    await backplane.publish(generation.room_id, message_frame(entry, generation.id), entry)
+    turns.reply(generation)
+
+async def missed_messages(db: AsyncSession, room_id: int, last_seen_id: int) -> Optional[List[dict]]:
+    """Messages after ``last_seen_id``, oldest first, or None if there are more than RESUME_MAX_MESSAGES."""
+    entries = history.get(room_id, RESUME_MAX_MESSAGES + 1, after_id=last_seen_id)
+    if entries is None:
+        rows = await crud.aget_messages(db, room_id, RESUME_MAX_MESSAGES + 1, after_id=last_seen_id)
+        # The newest messages may not be flushed yet; those are in the cache.
+        merged = {m.id: entry_from_message(m) for m in rows}
+        for entry in history.buffered_after(room_id, last_seen_id):
+            merged.setdefault(entry["id"], entry)
+        entries = sorted(merged.values(), key=lambda e: e["id"], reverse=True)
+    if len(entries) > RESUME_MAX_MESSAGES:
+        return None
+    return list(reversed(await with_usernames(db, entries)))
+
+async def recent_entries(db: AsyncSession, room_id: int, limit: int) -> List[dict]:
+    """The room's newest ``limit`` messages as history entries, oldest first."""
+    entries = history.get(room_id, limit)
+    if entries is None:
+        rows = await crud.aget_messages(db, room_id, limit)
+        merged = {m.id: entry_from_message(m) for m in rows}
+        for entry in history.buffered_after(room_id, rows[0].id if rows else 0):
+            merged.setdefault(entry["id"], entry)
+        entries = sorted(merged.values(), key=lambda e: e["id"], reverse=True)[:limit]
+    return list(reversed(await with_usernames(db, entries)))
+
+async def with_usernames(db: AsyncSession, entries: List[dict]) -> List[dict]:
+    """Fill in the username of entries read from the database: the user's, or the persona's for AI replies."""
+    missing = {e["user_id"] for e in entries if e["user_id"] is not None and e["username"] is None}
+    personas = {
+        e["persona_id"] for e in entries
+        if e["user_id"] is None and e.get("persona_id") is not None and e["username"] is None
+    }
+    if not missing and not personas:
+        return entries
+    usernames = await crud.aget_usernames(db, missing)
+    persona_names = await crud.aget_persona_names(db, personas)
+    return [
+        {**e, "username": usernames.get(e["user_id"])} if e["user_id"] in missing
+        else {**e, "username": persona_names.get(e["persona_id"])} if e["user_id"] is None and e.get("persona_id") in personas
+        else e
+        for e in entries
+    ]
+
+async def receive_frame(websocket: WebSocket):
+    """The next text (str) or binary (bytes) frame from the client."""
+    message = await websocket.receive()
+    if message["type"] == "websocket.disconnect":
+        raise WebSocketDisconnect(message.get("code", status.WS_1000_NORMAL_CLOSURE))
+    return message["text"] if message.get("text") is not None else message["bytes"]
+
+def message_content(message_data) -> Optional[str]:
+    """The frame's ``content`` if it is a usable message, else None."""
+    content = message_data.get("content") if isinstance(message_data, dict) else None
+    if not isinstance(content, str) or not content.strip() or len(content) > MESSAGE_MAX_LENGTH:
+        return None
+    return content
 
 @app.websocket("/ws/{room_id}")
 async def websocket_endpoint(
     websocket: WebSocket,
     room_id: int,
-    token: Optional[str] = Query(None)
+    token: Optional[str] = Query(None),
+    last_seen_id: Optional[int] = Query(None),
+    encoding: str = Query(JSON),
+    compress: bool = Query(False),
+    db: AsyncSession = Depends(get_db)
 ):
-    db = next(get_db())
+    if encoding not in ENCODINGS:
+        await websocket.close(code=status.WS_1003_UNSUPPORTED_DATA)
+        return
+    
+    user = await validate_websocket_auth(token, db)
+    
+    if not user:
+        await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
+        return
+    
+    room = await crud.aget_chatroom(db, room_id)
+    if not room:
+        room = await crud.acreate_chatroom(db, f"Room {room_id}")
     
+    await websocket.accept()
+    
+    wire = wires.get(encoding, compress)
+    connection = Connection.for_websocket(websocket, wire=wire)
+    present = False
+    # Everything from joining on is undone by the finally block, including
+    # when a step of the setup (subscribing, the replay lookup) fails.
     try:
-        user = await validate_websocket_auth(token, db)
-        
-        if not user:
-            await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
-            return
-        
-        room = crud.get_chatroom(db, room_id)
-        if not room:
-            room = crud.create_chatroom(db, f"Room {room_id}")
-        
-        await websocket.accept()
-        
-        if room_id not in connected_clients:
-            connected_clients[room_id] = []
-        connected_clients[room_id].append(websocket)
-        
-        join_message = crud.create_message(
-            db, room_id, f"{user.username} joined the room", None, "system"
-        )
-        
-        for client in connected_clients[room_id]:
-            try:
-                await client.send_json({
-                    "id": join_message.id,
-                    "user": None,
-                    "username": "System",
-                    "content": join_message.content,
-                    "role": join_message.role,
-                    "created_at": str(join_message.created_at)
-                })
-            except:
-                pass
-        
-        try:
-            while True:
-                data = await websocket.receive_text()
-                
-                message_data = json.loads(data)
-                content = message_data.get("content", data)
-                
-                db_message = crud.create_message(
-                    db, room_id, content, user.id, "user"
-                )
-                
-                message_payload = {
-                    "id": db_message.id,
-                    "user_id": user.id,
-                    "username": user.username,
-                    "content": db_message.content,
-                    "role": db_message.role,
-                    "created_at": str(db_message.created_at)
-                }
-                
-                for client in connected_clients[room_id]:
-                    try:
-                        await client.send_json(message_payload)
-                    except:
-                        connected_clients[room_id].remove(client)
-        
-        except Exception as e:
-            print(f"WebSocket error: {e}")
-        finally:
-            if websocket in connected_clients.get(room_id, []):
-                connected_clients[room_id].remove(websocket)
+        # Join before looking up missed messages so nothing published in between
+        # is lost; live frames the replay already covers are dropped by replay().
+        if broadcaster.join(room_id, connection, user.id):
+            await backplane.subscribe(room_id)
+            presence.request_snapshot(room_id)
+        room_themes[room_id] = room.theme
+        # Everyone else hears about us from the next presence delta; this socket
+        # gets the full member list, after any replayed messages.
+        presence.join(room_id, user.id, user.username, connection)
+        present = True
+        connection.enqueue(codec.dumps(presence.snapshot(room_id)), PRESENCE_KEY)
+    
+        if last_seen_id is not None:
+            missed = await missed_messages(db, room_id, last_seen_id)
+            if missed is None:
+                connection.replay([], codec.dumps({"type": "resync", "reason": "too_far_behind"}))
+            else:
+                connection.replay([(e["id"], message_frame(e)) for e in missed])
+        connection.start()
+        heartbeat.track(connection, room_id)
+    
+        # Messages are persisted by the writer from here on; release the
+        # connection instead of holding it for the lifetime of the socket.
+        await db.close()
+    
+        limits = rate_limiter.connection_bucket()
+        while True:
+            data = await receive_frame(websocket)
+            message_data = wire.decode(data)
+            if is_pong(message_data):
+                heartbeat.seen(connection, pong=True)
+                continue
+            heartbeat.seen(connection)
             
-            leave_message = crud.create_message(
-                db, room_id, f"{user.username} left the room", None, "system"
-            )
+            verdict, retry_after = await rate_limiter.acquire(user.id, room_id, limits)
+            if verdict == DROP:
+                connection.enqueue(codec.dumps(notice(retry_after)), NOTICE_KEY)
+                continue
+            if verdict == DISCONNECT:
+                await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
+                break
+            if broadcaster.is_muted(user.id, room_id):
+                connection.enqueue(codec.dumps({"type": "muted", "room_id": room_id, "muted": True}))
+                continue
             
-            for client in connected_clients.get(room_id, []):
-                try:
-                    await client.send_json({
-                        "id": leave_message.id,
-                        "user": None,
-                        "username": "System",
-                        "content": leave_message.content,
-                        "role": leave_message.role,
-                        "created_at": str(leave_message.created_at)
-                    })
-                except:
-                    pass
+            content = message_content(message_data)
+            if content is None:
+                connection.enqueue(codec.dumps({
+                    "type": "error",
+                    "detail": f"content must be a non-empty string of at most {MESSAGE_MAX_LENGTH} characters"
+                }))
+                continue
             
-            if room_id in connected_clients and not connected_clients[room_id]:
-                del connected_clients[room_id]
+            db_message = await message_writer.submit(
+                room_id, content, user.id, "user"
+            )
+            
+            await publish_message(room_id, db_message, user.username)
+            turns.message(room_id, content)
     
+    except Exception as e:
+        print(f"WebSocket error: {e}")
     finally:
-        db.close()
+        broadcaster.leave(room_id, connection)
+        heartbeat.untrack(connection)
+        if present:
+            presence.leave(room_id, user.id, connection)
+        if room_id not in broadcaster.rooms:
+            room_themes.pop(room_id, None)
+            turns.cancel_room(room_id)
+            persona_engine.cancel_room(room_id)
+            try:
+                await backplane.unsubscribe(room_id)
+            except Exception as e:
+                print(f"WebSocket cleanup error: {e}")
+            presence.discard(room_id)
+            if not history_tracks(room_id):
+                history.discard(room_id)
+                contexts.discard(room_id)
+        await connection.close()
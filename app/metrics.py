@@ -0,0 +1,7 @@
+"""Small helpers shared by the ``stats()`` methods behind ``/metrics``."""
+from typing import List
+
+
+def percentile(ordered: List[float], q: float) -> float:
+    """The ``q`` quantile (0..1) of an already sorted list; 0 when it is empty."""
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))] if ordered else 0.0
@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, ForeignKey, DateTime, Text
+from sqlalchemy import Column, Integer, String, ForeignKey, DateTime, Text, Index
 from sqlalchemy.orm import relationship
 from sqlalchemy.sql import func
 from app.database import Base
@@ -18,6 +18,7 @@ class Chatroom(Base):
     id = Column(Integer, primary_key=True, index=True)
     name = Column(String)
     theme = Column(String)
+    retention_days = Column(Integer, nullable=True)
     
     messages = relationship("Message", back_populates="room")
 
@@ -26,12 +27,20 @@ class Message(Base):
     id = Column(Integer, primary_key=True, index=True)
     room_id = Column(Integer, ForeignKey("chatrooms.id"), nullable=False)
     user_id = Column(Integer, ForeignKey("users.id"), nullable=True)
+    # The persona that wrote an "ai" message.
+    persona_id = Column(Integer, ForeignKey("personas.id"), nullable=True)
     role = Column(String, default="user")
     content = Column(Text, nullable=False)
     created_at = Column(DateTime(timezone=True), server_default=func.now())
     
     room = relationship("Chatroom", back_populates="messages")
     user = relationship("User", back_populates="messages")
+    
+    __table_args__ = (
+        Index("ix_messages_room_id_id", "room_id", "id"),
+        # Never reuse the ids of archived (deleted) messages.
+        {"sqlite_autoincrement": True},
+    )
 
 class Session(Base):
     __tablename__ = "sessions"
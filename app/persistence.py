@@ -0,0 +1,219 @@
+"""Write-behind message persistence.
+
+Messages get their id and timestamp when they are submitted, so they can be
+broadcast immediately, and are written to the ``messages`` table in batches
+(one multi-row INSERT and one commit per batch) when either the batch size or
+the flush interval is reached.
+
+A batch that fails with a connection-level error is retried up to
+``MESSAGE_FLUSH_RETRIES`` times with exponential backoff. After that, or
+straight away for any other error (a bad row), it is written row by row and
+the rows that still fail are moved to ``dead_letters`` so the rest of the
+stream keeps getting through.
+"""
+from collections import deque
+from datetime import datetime, timezone
+from typing import Callable, Deque, List, Optional
+import asyncio
+import logging
+import os
+
+from sqlalchemy import exc
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.database import AsyncSessionLocal
+from app import crud, models
+
+logger = logging.getLogger(__name__)
+
+MESSAGE_BATCH_SIZE = int(os.getenv("MESSAGE_BATCH_SIZE", "500"))
+MESSAGE_FLUSH_INTERVAL_MS = int(os.getenv("MESSAGE_FLUSH_INTERVAL_MS", "50"))
+MESSAGE_MAX_PENDING = int(os.getenv("MESSAGE_MAX_PENDING", "50000"))
+MESSAGE_ID_BLOCK = int(os.getenv("MESSAGE_ID_BLOCK", "100"))
+# Unused ids older than this are discarded, so that with several workers a
+# quiet worker cannot insert messages far behind the newest ids of a room.
+MESSAGE_ID_BLOCK_TTL_MS = int(os.getenv("MESSAGE_ID_BLOCK_TTL_MS", "1000"))
+MESSAGE_RETRY_DELAY_MS = int(os.getenv("MESSAGE_RETRY_DELAY_MS", "500"))
+MESSAGE_FLUSH_RETRIES = int(os.getenv("MESSAGE_FLUSH_RETRIES", "5"))
+# Most rows kept in ``dead_letters``; older ones are only counted.
+MESSAGE_DEAD_LETTER_SIZE = int(os.getenv("MESSAGE_DEAD_LETTER_SIZE", "1000"))
+
+# Errors worth retrying the same batch for: the database, not the rows.
+TRANSIENT_ERRORS = (exc.OperationalError, exc.InterfaceError, exc.TimeoutError, OSError)
+
+
+class MessageWriter:
+    def __init__(
+        self,
+        session_factory: Callable[[], AsyncSession] = AsyncSessionLocal,
+        batch_size: int = MESSAGE_BATCH_SIZE,
+        flush_interval: float = MESSAGE_FLUSH_INTERVAL_MS / 1000,
+        max_pending: int = MESSAGE_MAX_PENDING,
+        id_block: int = MESSAGE_ID_BLOCK,
+        id_block_ttl: float = MESSAGE_ID_BLOCK_TTL_MS / 1000,
+        retries: int = MESSAGE_FLUSH_RETRIES,
+        retry_delay: float = MESSAGE_RETRY_DELAY_MS / 1000,
+        dead_letter_size: int = MESSAGE_DEAD_LETTER_SIZE,
+    ):
+        self.session_factory = session_factory
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.id_block = id_block
+        self.id_block_ttl = id_block_ttl
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.dead_letters: Deque[dict] = deque(maxlen=dead_letter_size)
+
+        self._pending: List[dict] = []
+        self._in_flight = 0
+        self._ids: List[int] = []
+        self._ids_reserved_at = 0.0
+        self._last_id = 0
+        self._id_lock: Optional[asyncio.Lock] = None
+        self._wakeup: Optional[asyncio.Event] = None
+        self._drained: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+        self._closing = False
+
+        self.submitted = 0
+        self.flushed = 0
+        self.batches = 0
+        self.failures = 0
+        self.dead_lettered = 0
+
+    async def start(self) -> None:
+        # Synchronisation primitives bind to the running loop, so they are
+        # created here rather than at import time.
+        self._id_lock = asyncio.Lock()
+        self._wakeup = asyncio.Event()
+        self._drained = asyncio.Event()
+        self._drained.set()
+        self._closing = False
+        self._ids.clear()
+        self._last_id = 0
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        """Flush everything still pending and stop the background task."""
+        self._closing = True
+        self._wakeup.set()
+        if self._task is not None:
+            await self._task
+            self._task = None
+
+    async def submit(
+        self, room_id: int, content: str, user_id: Optional[int] = None, role: str = "user", persona_id: Optional[int] = None
+    ) -> models.Message:
+        while len(self._pending) >= self.max_pending and not self._closing:
+            self._drained.clear()
+            await self._drained.wait()
+
+        message = models.Message(
+            id=await self._next_id(),
+            room_id=room_id,
+            user_id=user_id,
+            persona_id=persona_id,
+            content=content,
+            role=role,
+            created_at=datetime.now(timezone.utc),
+        )
+        self._pending.append({
+            "id": message.id,
+            "room_id": room_id,
+            "user_id": user_id,
+            "persona_id": persona_id,
+            "content": content,
+            "role": role,
+            "created_at": message.created_at,
+        })
+        self.submitted += 1
+        if len(self._pending) >= self.batch_size or self._closing:
+            self._wakeup.set()
+        return message
+
+    def queue_depth(self) -> int:
+        return len(self._pending) + self._in_flight
+
+    def stats(self) -> dict:
+        return {
+            "queue_depth": self.queue_depth(),
+            "submitted": self.submitted,
+            "flushed": self.flushed,
+            "batches": self.batches,
+            "failures": self.failures,
+            "dead_lettered": self.dead_lettered,
+        }
+
+    async def _next_id(self) -> int:
+        loop = asyncio.get_running_loop()
+        if self._ids and loop.time() - self._ids_reserved_at > self.id_block_ttl:
+            self._ids.clear()
+        if not self._ids:
+            async with self._id_lock:
+                if not self._ids:
+                    async with self.session_factory() as db:
+                        self._ids = await crud.areserve_message_ids(db, self.id_block, self._last_id)
+                    self._ids_reserved_at = loop.time()
+        self._last_id = self._ids.pop(0)
+        return self._last_id
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+
+            while self._pending:
+                batch = self._pending[:self.batch_size]
+                del self._pending[:self.batch_size]
+                await self._flush(batch)
+            self._drained.set()
+
+            if self._closing:
+                return
+
+    async def _flush(self, batch: List[dict]) -> None:
+        self._in_flight = len(batch)
+        try:
+            try:
+                await self._insert_retrying(batch)
+                self.batches += 1
+                return
+            except Exception as e:
+                logger.warning(f"flush of {len(batch)} messages failed, writing them one by one: {e}")
+            for row in batch:
+                try:
+                    await self._insert([row])
+                except Exception as e:
+                    self.failures += 1
+                    self.dead_lettered += 1
+                    self.dead_letters.append(row)
+                    logger.error(f"dead-lettered message {row['id']} in room {row['room_id']}: {e}")
+        finally:
+            self._in_flight = 0
+
+    async def _insert_retrying(self, rows: List[dict]) -> None:
+        attempt = 0
+        while True:
+            try:
+                await self._insert(rows)
+                return
+            except TRANSIENT_ERRORS as e:
+                self.failures += 1
+                if self._closing or attempt >= self.retries:
+                    raise
+                delay = self.retry_delay * 2 ** attempt
+                attempt += 1
+                logger.warning(f"message flush failed, retry {attempt} in {delay:.2f}s: {e}")
+                await asyncio.sleep(delay)
+            except Exception:
+                self.failures += 1
+                raise
+
+    async def _insert(self, rows: List[dict]) -> None:
+        async with self.session_factory() as db:
+            await crud.acreate_messages(db, rows)
+        self.flushed += len(rows)
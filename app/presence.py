@@ -0,0 +1,368 @@
+"""Who is in each room, across connections and workers.
+
+Each room keeps a dict of present users with a reference count: one per
+local connection of the user plus one per other worker that reports the user.
+Joining and leaving are O(1) and so is a room's head count; only the first
+connection of a user makes them appear and only the last one makes them go.
+
+Clients learn about changes from ``presence_delta`` frames. Changes are
+collected for ``PRESENCE_FLUSH_MS`` and sent as one delta per room, and a
+user who leaves and comes back within the window (a reconnect) produces no
+delta at all. Nothing is persisted. A socket that joins gets a ``presence``
+snapshot instead, and later deltas only carry what it has not seen yet.
+Presence frames are queued with ``PRESENCE_KEY``: when a socket under the
+``coalesce`` policy still has one waiting, it gets a fresh snapshot that
+replaces it instead of another delta.
+
+With a cross-process backplane, workers exchange ``presence_sync`` frames on
+the room's channel: their own users' joins and leaves (coalesced the same
+way), and a snapshot of their local users whenever another worker asks for
+one, which a worker does when it starts serving a room. These frames are
+consumed by ``receive`` and never reach clients. A worker that stops reports
+its users as gone; one that crashes is only forgotten once the room is idle
+on the other workers.
+
+A worker without sockets in a room answers a members lookup with ``lookup``:
+it asks on the room's channel without subscribing to it, and the workers
+serving the room reply on the asking worker's own channel
+(``reply_channel``), so the lookup touches no room state.
+"""
+from typing import Awaitable, Callable, Dict, Hashable, Iterable, List, Optional, Tuple
+import asyncio
+import logging
+import os
+import uuid
+
+from app import codec
+
+logger = logging.getLogger(__name__)
+
+PRESENCE_FLUSH_MS = int(os.getenv("PRESENCE_FLUSH_MS", "250"))
+# How long a members lookup for a room with no local sockets waits for the
+# other workers' snapshots.
+PRESENCE_SNAPSHOT_WAIT_MS = int(os.getenv("PRESENCE_SNAPSHOT_WAIT_MS", "200"))
+
+SYNC_PREFIX = '{"type":"presence_sync"'
+# Coalescing key of every presence frame sent to clients.
+PRESENCE_KEY = "presence"
+
+# connections(room_id) -> the local connections that receive deltas
+Connections = Callable[[Hashable], Iterable]
+# publish(room_id, frame) -> send a frame to the other workers
+Publish = Callable[[Hashable, str], Awaitable[None]]
+
+
+def net_changes(changes: Iterable[Tuple[int, Hashable, Optional[str]]]) -> Dict[Hashable, Optional[str]]:
+    """Collapse ``(version, user, username or None for a leave)`` changes to each user's net change."""
+    first: Dict[Hashable, Optional[str]] = {}
+    last: Dict[Hashable, Optional[str]] = {}
+    for _, user_id, username in changes:
+        first.setdefault(user_id, username)
+        last[user_id] = username
+    # Joined then left (or left then came back): nothing for clients to see.
+    return {
+        user_id: username for user_id, username in last.items()
+        if (first[user_id] is None) == (username is None)
+    }
+
+
+class RoomPresence:
+    def __init__(self):
+        # user id -> [username, references]
+        self.members: Dict[Hashable, list] = {}
+        self.local: Dict[Hashable, int] = {}
+        self.remote: Dict[str, Dict[Hashable, str]] = {}
+        self.version = 0
+        self.changes: List[Tuple[int, Hashable, Optional[str]]] = []
+        # Local users whose presence changed since the last sync; None = left.
+        self.sync: Dict[Hashable, Optional[str]] = {}
+        # Connections that joined since the last flush -> version they saw.
+        self.fresh: Dict[object, int] = {}
+        self.timer: Optional[asyncio.TimerHandle] = None
+
+    def idle(self) -> bool:
+        return not self.members and not self.changes and not self.sync
+
+
+class Presence:
+    def __init__(self, flush_interval: float = PRESENCE_FLUSH_MS / 1000, worker_id: str = ""):
+        self.flush_interval = flush_interval
+        self.worker_id = worker_id
+        self._rooms: Dict[Hashable, RoomPresence] = {}
+        self._connections: Optional[Connections] = None
+        self._publish: Optional[Publish] = None
+        self._tasks = set()
+        # lookup request id -> worker id -> the users it reported
+        self._lookups: Dict[str, Dict[str, list]] = {}
+
+        self.joins = 0
+        self.leaves = 0
+        self.deltas = 0
+        self.coalesced = 0
+        self.syncs_sent = 0
+        self.syncs_received = 0
+        self.lookups = 0
+
+    async def start(self, connections: Connections, publish: Optional[Publish] = None, worker_id: str = "") -> None:
+        """``publish`` is only needed when other workers serve the same rooms."""
+        self._connections = connections
+        self._publish = publish
+        self.worker_id = worker_id or self.worker_id
+
+    async def stop(self) -> None:
+        # Tell the other workers our users are gone.
+        for room_id, room in list(self._rooms.items()):
+            if room.local:
+                self._send_sync(room_id, {"snapshot": []})
+        for room in self._rooms.values():
+            if room.timer is not None:
+                room.timer.cancel()
+        self._rooms.clear()
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    def join(self, room_id: Hashable, user_id: Hashable, username: str, connection: object = None) -> None:
+        room = self._rooms.get(room_id)
+        if room is None:
+            room = self._rooms[room_id] = RoomPresence()
+        self.joins += 1
+        room.local[user_id] = room.local.get(user_id, 0) + 1
+        if room.local[user_id] == 1 and self._publish is not None:
+            room.sync[user_id] = username
+            self._schedule(room_id, room)
+        self._add(room_id, room, user_id, username)
+        if connection is not None:
+            room.fresh[connection] = room.version
+
+    def leave(self, room_id: Hashable, user_id: Hashable, connection: object = None) -> None:
+        room = self._rooms.get(room_id)
+        if room is None or user_id not in room.local:
+            return
+        self.leaves += 1
+        room.fresh.pop(connection, None)
+        room.local[user_id] -= 1
+        if room.local[user_id] == 0:
+            del room.local[user_id]
+            if self._publish is not None:
+                room.sync[user_id] = None
+                self._schedule(room_id, room)
+        self._drop(room_id, room, user_id)
+        if room.idle() and room.timer is None:
+            del self._rooms[room_id]
+
+    def snapshot(self, room_id: Hashable) -> dict:
+        """The frame a joining socket gets: everyone currently in the room."""
+        return {"type": "presence", "room_id": room_id, "count": self.count(room_id), "members": self.members(room_id)}
+
+    def count(self, room_id: Hashable) -> int:
+        room = self._rooms.get(room_id)
+        return len(room.members) if room is not None else 0
+
+    def members(self, room_id: Hashable) -> List[dict]:
+        room = self._rooms.get(room_id)
+        if room is None:
+            return []
+        return [{"user_id": user_id, "username": entry[0]} for user_id, entry in room.members.items()]
+
+    @property
+    def reply_channel(self) -> str:
+        """The backplane channel this worker receives lookup replies on."""
+        return f"presence_{self.worker_id}"
+
+    async def lookup(self, room_id: Hashable, wait: float = PRESENCE_SNAPSHOT_WAIT_MS / 1000) -> dict:
+        """A snapshot of a room this worker does not serve, from the workers that do."""
+        self.lookups += 1
+        if self._publish is None:
+            return self.snapshot(room_id)
+        request = uuid.uuid4().hex
+        replies = self._lookups[request] = {}
+        try:
+            self._send_sync(room_id, {"want_snapshot": True, "reply_to": self.worker_id, "request": request})
+            await asyncio.sleep(wait)
+        finally:
+            del self._lookups[request]
+        members = {user_id: username for users in replies.values() for user_id, username in users}
+        return {
+            "type": "presence",
+            "room_id": room_id,
+            "count": len(members),
+            "members": [{"user_id": user_id, "username": username} for user_id, username in members.items()],
+        }
+
+    def request_snapshot(self, room_id: Hashable) -> None:
+        """Ask the other workers which of their users are in the room."""
+        if self._publish is not None:
+            self._send_sync(room_id, {"want_snapshot": True})
+
+    def discard(self, room_id: Hashable) -> None:
+        """Forget a room this worker no longer serves, after telling the others about our leaves."""
+        room = self._rooms.get(room_id)
+        if room is None:
+            return
+        if room.timer is not None:
+            room.timer.cancel()
+            room.timer = None
+        self._flush_sync(room_id, room)
+        if not room.local:
+            del self._rooms[room_id]
+
+    def is_sync(self, frame: str) -> bool:
+        return frame.startswith(SYNC_PREFIX)
+
+    def receive(self, room_id: Hashable, frame: str) -> None:
+        """Apply a ``presence_sync`` frame from the backplane."""
+        data = codec.loads(frame)
+        worker = data["worker"]
+        if worker == self.worker_id:
+            return
+        self.syncs_received += 1
+        if "request" in data and "snapshot" in data:
+            # A reply to a lookup, on our reply channel.
+            replies = self._lookups.get(data["request"])
+            if replies is not None:
+                replies[worker] = data["snapshot"]
+            return
+        if "reply_to" in data:
+            self._reply(room_id, data)
+            return
+        room = self._rooms.get(room_id)
+        if room is None:
+            room = self._rooms[room_id] = RoomPresence()
+        users = room.remote.setdefault(worker, {})
+        if "snapshot" in data:
+            reported = {user_id: username for user_id, username in data["snapshot"]}
+            for user_id in [u for u in users if u not in reported]:
+                del users[user_id]
+                self._drop(room_id, room, user_id)
+            joined = [(u, n) for u, n in reported.items() if u not in users]
+        else:
+            joined = data.get("joined", [])
+            for user_id in data.get("left", []):
+                if users.pop(user_id, None) is not None:
+                    self._drop(room_id, room, user_id)
+        for user_id, username in joined:
+            if user_id not in users:
+                users[user_id] = username
+                self._add(room_id, room, user_id, username)
+        if not users:
+            del room.remote[worker]
+        if data.get("want_snapshot") and room.local:
+            self._send_sync(room_id, {"snapshot": [[u, room.members[u][0]] for u in room.local]})
+        if room.idle() and room.timer is None:
+            del self._rooms[room_id]
+
+    def stats(self) -> dict:
+        return {
+            "rooms": len(self._rooms),
+            "members": sum(len(room.members) for room in self._rooms.values()),
+            "joins": self.joins,
+            "leaves": self.leaves,
+            "deltas": self.deltas,
+            "coalesced": self.coalesced,
+            "syncs_sent": self.syncs_sent,
+            "syncs_received": self.syncs_received,
+            "lookups": self.lookups,
+        }
+
+    def _add(self, room_id: Hashable, room: RoomPresence, user_id: Hashable, username: str) -> None:
+        entry = room.members.get(user_id)
+        if entry is not None:
+            entry[1] += 1
+            return
+        room.members[user_id] = [username, 1]
+        self._changed(room_id, room, user_id, username)
+
+    def _drop(self, room_id: Hashable, room: RoomPresence, user_id: Hashable) -> None:
+        entry = room.members.get(user_id)
+        if entry is None:
+            return
+        entry[1] -= 1
+        if entry[1] == 0:
+            del room.members[user_id]
+            self._changed(room_id, room, user_id, None)
+
+    def _changed(self, room_id: Hashable, room: RoomPresence, user_id: Hashable, username: Optional[str]) -> None:
+        room.version += 1
+        if self._connections is None:
+            # Not started: membership only, nobody to send deltas to.
+            return
+        room.changes.append((room.version, user_id, username))
+        self._schedule(room_id, room)
+
+    def _schedule(self, room_id: Hashable, room: RoomPresence) -> None:
+        if room.timer is None and self._connections is not None:
+            room.timer = asyncio.get_running_loop().call_later(self.flush_interval, self._flush, room_id)
+
+    def _flush(self, room_id: Hashable) -> None:
+        room = self._rooms.get(room_id)
+        if room is None:
+            return
+        room.timer = None
+        changes, room.changes = room.changes, []
+        fresh, room.fresh = room.fresh, {}
+        self._flush_sync(room_id, room)
+
+        net = net_changes(changes)
+        self.coalesced += len(changes) - len(net)
+        frame = self._delta(room_id, room, net) if net else None
+        snapshot = None
+        for connection in list(self._connections(room_id)):
+            seen = fresh.get(connection)
+            if seen is None:
+                delta = frame
+            else:
+                newer = net_changes(c for c in changes if c[0] > seen)
+                delta = self._delta(room_id, room, newer) if newer else None
+            if delta is None:
+                continue
+            if connection.pending(PRESENCE_KEY):
+                # The queued presence frame has not gone out yet; replace it
+                # with the whole current state rather than stacking deltas.
+                if snapshot is None:
+                    snapshot = codec.dumps(self.snapshot(room_id))
+                connection.enqueue(snapshot, PRESENCE_KEY)
+            else:
+                connection.enqueue(delta, PRESENCE_KEY)
+        if room.idle():
+            del self._rooms[room_id]
+
+    def _delta(self, room_id: Hashable, room: RoomPresence, net: Dict[Hashable, Optional[str]]) -> str:
+        self.deltas += 1
+        return codec.dumps({
+            "type": "presence_delta",
+            "room_id": room_id,
+            "count": len(room.members),
+            "joined": [{"user_id": u, "username": n} for u, n in net.items() if n is not None],
+            "left": [u for u, n in net.items() if n is None],
+        })
+
+    def _flush_sync(self, room_id: Hashable, room: RoomPresence) -> None:
+        sync, room.sync = room.sync, {}
+        if not sync or self._publish is None:
+            return
+        self._send_sync(room_id, {
+            "joined": [[u, n] for u, n in sync.items() if n is not None],
+            "left": [u for u, n in sync.items() if n is None],
+        })
+
+    def _reply(self, room_id: Hashable, data: dict) -> None:
+        room = self._rooms.get(room_id)
+        if room is None or not room.local:
+            return
+        snapshot = [[u, room.members[u][0]] for u in room.local]
+        self._send_sync(f"presence_{data['reply_to']}", {"request": data["request"], "snapshot": snapshot})
+
+    def _send_sync(self, room_id: Hashable, payload: dict) -> None:
+        if self._publish is None:
+            return
+        self.syncs_sent += 1
+        frame = codec.dumps({"type": "presence_sync", "worker": self.worker_id, **payload})
+        task = asyncio.get_running_loop().create_task(self._publish_quietly(room_id, frame))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _publish_quietly(self, room_id: Hashable, frame: str) -> None:
+        try:
+            await self._publish(room_id, frame)
+        except Exception as e:
+            logger.warning(f"presence sync for room {room_id} failed: {e}")
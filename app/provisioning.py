@@ -0,0 +1,222 @@
+"""Bulk user provisioning from CSV or NDJSON.
+
+Records go through in batches of ``PROVISION_BATCH_SIZE``. Each batch is
+deduplicated against ``users`` with one set-based query; its passwords are
+hashed across ``PROVISION_HASH_WORKERS`` workers and it is inserted with a
+single executemany. Rows that cannot be created land in a per-row error
+report instead of failing the import.
+
+``PROVISION_BCRYPT_ROUNDS`` may be set below ``BCRYPT_ROUNDS`` to make large
+imports cheaper: those hashes are upgraded on the user's first login.
+
+The hashing pool is created once and shared by every import. Over HTTP
+(``run``) at most ``PROVISION_MAX_CONCURRENT`` imports run at a time; more
+are rejected with 429 rather than queued.
+"""
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
+from itertools import islice
+from typing import Iterable, Iterator, List, Optional, Set, Tuple
+import csv
+import io
+import os
+
+from fastapi import HTTPException, status
+from fastapi.concurrency import run_in_threadpool
+from pydantic import ValidationError
+from sqlalchemy import insert, or_, select
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+
+from app import codec, models, schemas
+from app.auth import BCRYPT_ROUNDS, get_password_hash
+
+PROVISION_BATCH_SIZE = int(os.getenv("PROVISION_BATCH_SIZE", "5000"))
+PROVISION_HASH_EXECUTOR = os.getenv("PROVISION_HASH_EXECUTOR", "thread")
+PROVISION_HASH_WORKERS = int(os.getenv("PROVISION_HASH_WORKERS", str(os.cpu_count() or 1)))
+PROVISION_BCRYPT_ROUNDS = int(os.getenv("PROVISION_BCRYPT_ROUNDS", str(BCRYPT_ROUNDS)))
+PROVISION_MAX_CONCURRENT = int(os.getenv("PROVISION_MAX_CONCURRENT", "1"))
+
+# Concurrent signups can take a name between the dedupe query and the insert;
+# the batch is re-checked and retried this many times.
+INSERT_ATTEMPTS = 3
+
+Record = Tuple[int, Optional[dict]]
+
+
+def parse_records(data: str, fmt: str) -> Iterator[Record]:
+    """Yield ``(row, record)`` with 1-based row numbers; unparseable rows yield ``None``."""
+    if fmt == "csv":
+        for row, record in enumerate(csv.DictReader(io.StringIO(data)), start=1):
+            yield row, record
+    elif fmt == "ndjson":
+        row = 0
+        for line in data.splitlines():
+            if not line.strip():
+                continue
+            row += 1
+            try:
+                record = codec.loads(line)
+            except ValueError:
+                record = None
+            yield row, record if isinstance(record, dict) else None
+    else:
+        raise ValueError(f"unknown provisioning format: {fmt}")
+
+
+def format_for(filename: str, content_type: Optional[str] = None) -> str:
+    if (content_type or "").startswith("text/csv") or filename.endswith(".csv"):
+        return "csv"
+    return "ndjson"
+
+
+def describe(error: ValidationError) -> str:
+    return "; ".join(
+        f"{'.'.join(str(part) for part in e['loc']) or 'record'}: {e['msg']}" for e in error.errors()
+    )
+
+
+def batched(records: Iterable[Record], size: int) -> Iterator[List[Record]]:
+    iterator = iter(records)
+    while batch := list(islice(iterator, size)):
+        yield batch
+
+
+class UserProvisioner:
+    def __init__(
+        self,
+        executor: str = PROVISION_HASH_EXECUTOR,
+        workers: int = PROVISION_HASH_WORKERS,
+        rounds: int = PROVISION_BCRYPT_ROUNDS,
+        batch_size: int = PROVISION_BATCH_SIZE,
+        max_concurrent: int = PROVISION_MAX_CONCURRENT
+    ):
+        if executor not in ("thread", "process"):
+            raise ValueError(f"unknown password hash executor: {executor}")
+        self.executor_type = executor
+        self.workers = workers
+        self.rounds = rounds
+        self.batch_size = batch_size
+        self.max_concurrent = max_concurrent
+        self._executor: Optional[Executor] = None
+        self.in_progress = 0
+        self.completed = 0
+        self.rejected = 0
+
+    async def run(self, db: Session, records: Iterable[Record]) -> dict:
+        """``provision`` off the event loop, or 429 if enough imports are running already."""
+        if self.in_progress >= self.max_concurrent:
+            self.rejected += 1
+            raise HTTPException(
+                status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+                detail="An import is already in progress, try again later",
+                headers={"Retry-After": "5"},
+            )
+        self.in_progress += 1
+        try:
+            return await run_in_threadpool(self.provision, db, records)
+        finally:
+            self.in_progress -= 1
+            self.completed += 1
+
+    def provision(self, db: Session, records: Iterable[Record]) -> dict:
+        """Create every valid, unused record; returns ``{"created": n, "errors": [...]}``."""
+        report = {"created": 0, "errors": []}
+        seen_usernames: Set[str] = set()
+        seen_emails: Set[str] = set()
+        executor = self._get_executor()
+        for batch in batched(records, self.batch_size):
+            users = []
+            for row, record in batch:
+                user = self._validate(row, record, report)
+                if user is None:
+                    continue
+                if user.username in seen_usernames:
+                    self._error(report, row, user.username, "Duplicate username in input")
+                elif user.email in seen_emails:
+                    self._error(report, row, user.username, "Duplicate email in input")
+                else:
+                    seen_usernames.add(user.username)
+                    seen_emails.add(user.email)
+                    users.append((row, user))
+            self._insert_batch(db, executor, users, report)
+        return report
+
+    def shutdown(self) -> None:
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+
+    def stats(self) -> dict:
+        return {
+            "in_progress": self.in_progress,
+            "completed": self.completed,
+            "rejected": self.rejected,
+        }
+
+    def _get_executor(self) -> Executor:
+        if self._executor is None:
+            if self.executor_type == "process":
+                self._executor = ProcessPoolExecutor(max_workers=self.workers)
+            else:
+                self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="bcrypt-bulk")
+        return self._executor
+
+    def _validate(self, row: int, record: Optional[dict], report: dict) -> Optional[schemas.UserCreate]:
+        if record is None:
+            self._error(report, row, None, "Malformed record")
+            return None
+        try:
+            return schemas.UserCreate.model_validate(record)
+        except ValidationError as e:
+            self._error(report, row, record.get("username"), describe(e))
+            return None
+
+    def _error(self, report: dict, row: int, username: Optional[str], error: str) -> None:
+        report["errors"].append({"row": row, "username": username, "error": error})
+
+    def _unused(self, db: Session, users: List[Tuple[int, schemas.UserCreate]], report: dict) -> list:
+        usernames = [user.username for _, user in users]
+        emails = [user.email for _, user in users]
+        taken = db.execute(
+            select(models.User.username, models.User.email)
+            .where(or_(models.User.username.in_(usernames), models.User.email.in_(emails)))
+        ).all()
+        taken_usernames = {username for username, _ in taken}
+        taken_emails = {email for _, email in taken}
+        unused = []
+        for row, user in users:
+            if user.username in taken_usernames:
+                self._error(report, row, user.username, "Username already registered")
+            elif user.email in taken_emails:
+                self._error(report, row, user.username, "Email already registered")
+            else:
+                unused.append((row, user))
+        return unused
+
+    def _insert_batch(self, db: Session, executor: Executor, users: list, report: dict) -> None:
+        users = self._unused(db, users, report) if users else []
+        if not users:
+            return
+        hash_password = partial(get_password_hash, rounds=self.rounds)
+        chunksize = max(1, len(users) // (self.workers * 4))
+        hashes = list(executor.map(hash_password, [user.password for _, user in users], chunksize=chunksize))
+        rows = [
+            {"username": user.username, "email": user.email, "hashed_password": hashed}
+            for (_, user), hashed in zip(users, hashes)
+        ]
+        for attempt in range(INSERT_ATTEMPTS):
+            try:
+                db.execute(insert(models.User), rows)
+                db.commit()
+                report["created"] += len(rows)
+                return
+            except IntegrityError:
+                db.rollback()
+                if attempt == INSERT_ATTEMPTS - 1:
+                    raise
+            unused = {row for row, _ in self._unused(db, users, report)}
+            rows = [r for (row, _), r in zip(users, rows) if row in unused]
+            users = [(row, user) for row, user in users if row in unused]
+            if not rows:
+                return
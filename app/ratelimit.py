@@ -0,0 +1,178 @@
+"""Token-bucket rate limits for messages received over WebSockets.
+
+Each incoming message takes one token from three buckets: its connection's,
+its user's (shared by all of the user's connections) and its room's. A
+bucket holds up to ``burst`` tokens and refills at ``rate`` tokens per
+second; checking one is O(1) and needs no timers. A message is only admitted
+when all three buckets have a token, and then takes one from each.
+
+What happens to a message over the limit depends on ``RATE_LIMIT_POLICY``:
+
+* ``throttle``: wait until the buckets refill before handling it. The
+  receive loop stops reading meanwhile, so the backlog stays in the client's
+  socket instead of the database and the room.
+* ``drop``: discard it and send the client a ``rate_limited`` notice frame.
+* ``disconnect``: close the connection.
+"""
+from typing import Dict, Hashable, Optional, Tuple
+import asyncio
+import os
+import time
+
+THROTTLE = "throttle"
+DROP = "drop"
+DISCONNECT = "disconnect"
+POLICIES = (THROTTLE, DROP, DISCONNECT)
+
+# acquire() verdicts
+ALLOW = "allow"
+
+RATE_LIMIT_POLICY = os.getenv("RATE_LIMIT_POLICY", THROTTLE)
+RATE_LIMIT_CONNECTION_RATE = float(os.getenv("RATE_LIMIT_CONNECTION_RATE", "5"))
+RATE_LIMIT_CONNECTION_BURST = int(os.getenv("RATE_LIMIT_CONNECTION_BURST", "10"))
+RATE_LIMIT_USER_RATE = float(os.getenv("RATE_LIMIT_USER_RATE", "8"))
+RATE_LIMIT_USER_BURST = int(os.getenv("RATE_LIMIT_USER_BURST", "20"))
+RATE_LIMIT_ROOM_RATE = float(os.getenv("RATE_LIMIT_ROOM_RATE", "50"))
+RATE_LIMIT_ROOM_BURST = int(os.getenv("RATE_LIMIT_ROOM_BURST", "100"))
+
+# Buckets that have refilled completely are forgotten every this many checks.
+PRUNE_INTERVAL = 1024
+
+
+class TokenBucket:
+    __slots__ = ("rate", "burst", "tokens", "updated")
+
+    def __init__(self, rate: float, burst: int, now: Optional[float] = None):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic() if now is None else now
+
+    def wait(self, now: float) -> float:
+        """Seconds until a token is available (0 if one is)."""
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate if self.rate > 0 else float("inf")
+
+    def take(self) -> None:
+        self.tokens -= 1
+
+    def full(self, now: float) -> bool:
+        return self.tokens + (now - self.updated) * self.rate >= self.burst
+
+
+class RateLimiter:
+    def __init__(
+        self,
+        policy: str = RATE_LIMIT_POLICY,
+        connection_rate: float = RATE_LIMIT_CONNECTION_RATE,
+        connection_burst: int = RATE_LIMIT_CONNECTION_BURST,
+        user_rate: float = RATE_LIMIT_USER_RATE,
+        user_burst: int = RATE_LIMIT_USER_BURST,
+        room_rate: float = RATE_LIMIT_ROOM_RATE,
+        room_burst: int = RATE_LIMIT_ROOM_BURST
+    ):
+        if policy not in POLICIES:
+            raise ValueError(f"unknown rate limit policy: {policy}")
+        self.policy = policy
+        self.connection_limits = (connection_rate, connection_burst)
+        self.user_limits = (user_rate, user_burst)
+        self.room_limits = (room_rate, room_burst)
+        self._users: Dict[Hashable, TokenBucket] = {}
+        self._rooms: Dict[Hashable, TokenBucket] = {}
+        self._checks = 0
+
+        self.allowed = 0
+        self.limited = {"connection": 0, "user": 0, "room": 0}
+        self.throttled = 0
+        self.dropped = 0
+        self.disconnected = 0
+
+    def connection_bucket(self) -> TokenBucket:
+        """A bucket for one connection; the caller keeps it for the connection's lifetime."""
+        return TokenBucket(*self.connection_limits)
+
+    def check(self, user: Hashable, room: Hashable, connection: TokenBucket) -> Tuple[float, Optional[str]]:
+        """Take a token for one message if all buckets allow it.
+
+        Returns ``(0, None)`` when the message is admitted, otherwise the
+        seconds to wait and the scope (``connection``, ``user`` or ``room``)
+        that is out of tokens; nothing is taken then.
+        """
+        now = time.monotonic()
+        self._checks += 1
+        if self._checks % PRUNE_INTERVAL == 0:
+            self._prune(now)
+        user_bucket = self._bucket(self._users, user, self.user_limits, now)
+        room_bucket = self._bucket(self._rooms, room, self.room_limits, now)
+        wait, scope = 0.0, None
+        for name, bucket in (("connection", connection), ("user", user_bucket), ("room", room_bucket)):
+            needed = bucket.wait(now)
+            if needed > wait:
+                wait, scope = needed, name
+        if scope is None:
+            connection.take()
+            user_bucket.take()
+            room_bucket.take()
+        return wait, scope
+
+    async def acquire(self, user: Hashable, room: Hashable, connection: TokenBucket) -> Tuple[str, float]:
+        """Admit one message: returns ``ALLOW``, ``DROP`` or ``DISCONNECT`` and the retry delay.
+
+        Under the throttle policy this waits until the message fits and
+        always returns ``ALLOW``.
+        """
+        wait, scope = self.check(user, room, connection)
+        if scope is None:
+            self.allowed += 1
+            return ALLOW, 0.0
+        self.limited[scope] += 1
+        if self.policy == DROP:
+            self.dropped += 1
+            return DROP, wait
+        if self.policy == DISCONNECT:
+            self.disconnected += 1
+            return DISCONNECT, wait
+        self.throttled += 1
+        while scope is not None:
+            await asyncio.sleep(wait)
+            wait, scope = self.check(user, room, connection)
+        self.allowed += 1
+        return ALLOW, 0.0
+
+    def stats(self) -> dict:
+        return {
+            "policy": self.policy,
+            "allowed": self.allowed,
+            "limited": dict(self.limited),
+            "throttled": self.throttled,
+            "dropped": self.dropped,
+            "disconnected": self.disconnected,
+            "users": len(self._users),
+            "rooms": len(self._rooms),
+        }
+
+    def _bucket(
+        self, buckets: Dict[Hashable, TokenBucket], key: Hashable, limits: Tuple[float, int], now: float
+    ) -> TokenBucket:
+        bucket = buckets.get(key)
+        if bucket is None:
+            bucket = buckets[key] = TokenBucket(*limits, now)
+        return bucket
+
+    def _prune(self, now: float) -> None:
+        # A full bucket behaves exactly like a new one, so it can go.
+        for buckets in (self._users, self._rooms):
+            for key in [k for k, b in buckets.items() if b.full(now)]:
+                del buckets[key]
+
+
+# Coalescing key of notices: a newer one supersedes a queued one.
+NOTICE_KEY = "rate_limited"
+
+
+def notice(retry_after: float) -> dict:
+    """Frame telling a client that a message was dropped by the ``drop`` policy."""
+    return {"type": "rate_limited", "retry_after_ms": int(retry_after * 1000) + 1}
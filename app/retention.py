@@ -0,0 +1,179 @@
+"""Message retention, cold archival and monthly partition maintenance.
+
+Each room keeps messages for ``chatrooms.retention_days`` days, falling back to
+``MESSAGE_RETENTION_DAYS`` (unset means forever). ``archive_expired`` moves
+older messages into gzip-compressed NDJSON files, one per room and month:
+
+    ARCHIVE_DIR/room-<id>/<YYYY-MM>.ndjson.gz
+
+and deletes them from the database. Archived messages stay readable through
+``read_archived``, which the history API uses when asked to page past the
+database. On Postgres ``messages`` is range-partitioned by month on
+``created_at`` (see the Alembic migration); ``ensure_partitions`` creates
+upcoming partitions and ``archive_expired`` drops partitions left empty.
+"""
+from collections import deque
+from datetime import datetime, timedelta, timezone
+from typing import Dict, Iterator, List, Optional
+import gzip
+import logging
+import os
+
+from sqlalchemy import delete, select, text
+from sqlalchemy.orm import Session
+
+from app import codec, models, search
+from app.export import EXPORT_BATCH_SIZE, export_line, export_statement
+
+logger = logging.getLogger(__name__)
+
+ARCHIVE_DIR = os.getenv("ARCHIVE_DIR", "./archive")
+MESSAGE_RETENTION_DAYS = os.getenv("MESSAGE_RETENTION_DAYS")
+PARTITION_MONTHS_AHEAD = int(os.getenv("PARTITION_MONTHS_AHEAD", "3"))
+
+
+def default_retention_days() -> Optional[int]:
+    return int(MESSAGE_RETENTION_DAYS) if MESSAGE_RETENTION_DAYS else None
+
+
+def month_start(moment: datetime, offset: int = 0) -> datetime:
+    index = moment.year * 12 + moment.month - 1 + offset
+    return datetime(index // 12, index % 12 + 1, 1, tzinfo=timezone.utc)
+
+
+def partition_name(start: datetime) -> str:
+    return f"messages_{start:%Y_%m}"
+
+
+def ensure_partitions(db: Session, months_ahead: int = PARTITION_MONTHS_AHEAD, now: Optional[datetime] = None) -> List[str]:
+    """Create monthly partitions from this month up to ``months_ahead`` (Postgres only)."""
+    if db.get_bind().dialect.name != "postgresql":
+        return []
+    now = now or datetime.now(timezone.utc)
+    created = []
+    for offset in range(months_ahead + 1):
+        start, end = month_start(now, offset), month_start(now, offset + 1)
+        name = partition_name(start)
+        exists = db.execute(text("SELECT to_regclass(:name)"), {"name": name}).scalar()
+        if exists is None:
+            db.execute(text(
+                f"CREATE TABLE {name} PARTITION OF messages "
+                f"FOR VALUES FROM ('{start.isoformat()}') TO ('{end.isoformat()}')"
+            ))
+            created.append(name)
+    db.commit()
+    return created
+
+
+def room_archive_dir(room_id: int, archive_dir: str = ARCHIVE_DIR) -> str:
+    return os.path.join(archive_dir, f"room-{room_id}")
+
+
+def archive_room(db: Session, room: models.Chatroom, cutoff: datetime, archive_dir: str = ARCHIVE_DIR) -> int:
+    """Append the room's messages older than ``cutoff`` to its archive files, then delete them."""
+    statement = export_statement(room.id, EXPORT_BATCH_SIZE).where(models.Message.created_at < cutoff)
+    directory = room_archive_dir(room.id, archive_dir)
+    files: Dict[str, gzip.GzipFile] = {}
+    archived = []
+    try:
+        for row in db.execute(statement):
+            month = f"{row.created_at:%Y-%m}"
+            if month not in files:
+                os.makedirs(directory, exist_ok=True)
+                # Appending adds a new gzip member; readers see one stream.
+                files[month] = gzip.open(os.path.join(directory, f"{month}.ndjson.gz"), "ab")
+            files[month].write(export_line(row).encode())
+            archived.append((row.id, row.content))
+    finally:
+        for f in files.values():
+            f.close()
+
+    if archived:
+        search.unindex_messages(db, archived)
+        db.execute(
+            delete(models.Message)
+            .where(models.Message.room_id == room.id, models.Message.created_at < cutoff)
+        )
+        db.commit()
+    return len(archived)
+
+
+def drop_empty_partitions(db: Session, before: datetime) -> List[str]:
+    """Drop monthly partitions that end before ``before`` and hold no rows (Postgres only)."""
+    if db.get_bind().dialect.name != "postgresql":
+        return []
+    rows = db.execute(text(
+        "SELECT c.relname FROM pg_inherits i "
+        "JOIN pg_class c ON c.oid = i.inhrelid "
+        "JOIN pg_class p ON p.oid = i.inhparent "
+        "WHERE p.relname = 'messages' AND c.relname ~ '^messages_[0-9]{4}_[0-9]{2}$'"
+    )).scalars().all()
+    dropped = []
+    for name in rows:
+        year, month = int(name[9:13]), int(name[14:16])
+        end = month_start(datetime(year, month, 1, tzinfo=timezone.utc), 1)
+        if end > before:
+            continue
+        if db.execute(text(f"SELECT EXISTS (SELECT 1 FROM {name})")).scalar():
+            continue
+        db.execute(text(f"ALTER TABLE messages DETACH PARTITION {name}"))
+        db.execute(text(f"DROP TABLE {name}"))
+        dropped.append(name)
+    db.commit()
+    return dropped
+
+
+def archive_expired(db: Session, archive_dir: str = ARCHIVE_DIR, now: Optional[datetime] = None) -> dict:
+    """Run retention for every room; returns counts for logging."""
+    now = now or datetime.now(timezone.utc)
+    default_days = default_retention_days()
+    archived = {}
+    oldest_cutoff = None
+    for room in db.execute(select(models.Chatroom)).scalars().all():
+        days = room.retention_days if room.retention_days is not None else default_days
+        if days is None:
+            continue
+        cutoff = now - timedelta(days=days)
+        count = archive_room(db, room, cutoff, archive_dir)
+        if count:
+            archived[room.id] = count
+        oldest_cutoff = cutoff if oldest_cutoff is None else max(oldest_cutoff, cutoff)
+    dropped = drop_empty_partitions(db, oldest_cutoff) if oldest_cutoff is not None else []
+    created = ensure_partitions(db, now=now)
+    logger.info(f"archived {sum(archived.values())} messages from {len(archived)} rooms")
+    return {"archived": archived, "partitions_dropped": dropped, "partitions_created": created}
+
+
+def iter_archive_file(path: str) -> Iterator[dict]:
+    with gzip.open(path, "rt") as f:
+        for line in f:
+            yield codec.loads(line)
+
+
+def read_archived(
+    room_id: int,
+    limit: int,
+    before_id: Optional[int] = None,
+    archive_dir: str = ARCHIVE_DIR
+) -> List[dict]:
+    """Newest-first page of archived messages with id below ``before_id``."""
+    directory = room_archive_dir(room_id, archive_dir)
+    if limit <= 0 or not os.path.isdir(directory):
+        return []
+    page: List[dict] = []
+    seen = set()
+    for name in sorted(os.listdir(directory), reverse=True):
+        if not name.endswith(".ndjson.gz"):
+            continue
+        # Keep only the newest ``limit`` matches of each file in memory.
+        newest = deque(maxlen=limit - len(page))
+        for entry in iter_archive_file(os.path.join(directory, name)):
+            if (before_id is None or entry["id"] < before_id) and entry["id"] not in seen:
+                newest.append(entry)
+        for entry in sorted(newest, key=lambda e: e["id"], reverse=True):
+            if entry["id"] not in seen:
+                seen.add(entry["id"])
+                page.append(entry)
+        if len(page) >= limit:
+            break
+    return page[:limit]
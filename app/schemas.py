@@ -1,5 +1,5 @@
-from pydantic import BaseModel, EmailStr, ConfigDict
-from typing import Optional
+from pydantic import BaseModel, EmailStr, ConfigDict, Field
+from typing import List, Optional
 from datetime import datetime
 
 class UserCreate(BaseModel):
@@ -7,6 +7,15 @@ class UserCreate(BaseModel):
     email: EmailStr
     password: str
 
+class ProvisionError(BaseModel):
+    row: int
+    username: Optional[str] = None
+    error: str
+
+class ProvisionReport(BaseModel):
+    created: int
+    errors: List[ProvisionError]
+
 class UserLogin(BaseModel):
     username: str
     password: str
@@ -32,13 +41,25 @@ class MessageResponse(BaseModel):
     id: int
     room_id: int
     user_id: Optional[int]
+    persona_id: Optional[int] = None
     role: str
     content: str
     created_at: datetime
 
+class SearchResult(MessageResponse):
+    score: float
+
+class SearchResponse(BaseModel):
+    results: List[SearchResult]
+    next_cursor: Optional[str] = None
+
 class ChatroomCreate(BaseModel):
     name: str
     theme: Optional[str] = None
+    retention_days: Optional[int] = Field(default=None, ge=1)
+
+class RetentionUpdate(BaseModel):
+    retention_days: Optional[int] = Field(default=None, ge=1)
 
 class ChatroomResponse(BaseModel):
     model_config = ConfigDict(from_attributes=True)
@@ -46,3 +67,31 @@ class ChatroomResponse(BaseModel):
     id: int
     name: str
     theme: Optional[str]
+    retention_days: Optional[int] = None
+
+class PresenceMember(BaseModel):
+    user_id: int
+    username: str
+
+class RoomPresence(BaseModel):
+    room_id: int
+    count: int
+    members: List[PresenceMember]
+
+class PersonaCreate(BaseModel):
+    name: str = Field(pattern=r"^\w+$")
+    system_prompt: Optional[str] = None
+    style: Optional[str] = None
+
+class PersonaResponse(BaseModel):
+    model_config = ConfigDict(from_attributes=True)
+    
+    id: int
+    name: str
+    system_prompt: Optional[str]
+    style: Optional[str]
+
+class PersonaMatch(BaseModel):
+    id: int
+    name: str
+    score: float
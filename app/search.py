@@ -0,0 +1,124 @@
+"""Full-text search over message content.
+
+* Postgres: a stored generated ``content_tsv`` tsvector column with a GIN
+  index, so the index maintains itself on every insert.
+* SQLite: an FTS5 external-content table ``messages_fts`` keyed by message id,
+  filled by the crud write path (``index_messages``).
+
+Both are created by the Alembic migration and, for ``create_all`` setups, by
+the DDL hooks below. Results are ranked (higher ``score`` is better) and
+paginated by keyset on ``(score, id)``.
+"""
+from typing import Iterable, List, Optional, Tuple
+import re
+
+from sqlalchemy import DDL, event, text
+from sqlalchemy.orm import Session
+
+from app import models
+
+TS_CONFIG = "simple"
+
+POSTGRES_DDL = (
+    f"ALTER TABLE messages ADD COLUMN IF NOT EXISTS content_tsv tsvector "
+    f"GENERATED ALWAYS AS (to_tsvector('{TS_CONFIG}', content)) STORED",
+    "CREATE INDEX IF NOT EXISTS ix_messages_content_tsv ON messages USING gin (content_tsv)",
+)
+SQLITE_DDL = (
+    "CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5("
+    "content, content='messages', content_rowid='id')",
+)
+SQLITE_DROP_DDL = "DROP TABLE IF EXISTS messages_fts"
+
+for statement in POSTGRES_DDL:
+    event.listen(models.Message.__table__, "after_create", DDL(statement).execute_if(dialect="postgresql"))
+for statement in SQLITE_DDL:
+    event.listen(models.Message.__table__, "after_create", DDL(statement).execute_if(dialect="sqlite"))
+event.listen(models.Message.__table__, "before_drop", DDL(SQLITE_DROP_DDL).execute_if(dialect="sqlite"))
+
+
+def index_messages(db: Session, rows: Iterable[Tuple[int, str]]) -> None:
+    """Add ``(id, content)`` pairs to the SQLite FTS table; Postgres needs nothing."""
+    if db.get_bind().dialect.name != "sqlite":
+        return
+    params = [{"id": message_id, "content": content} for message_id, content in rows]
+    if params:
+        db.execute(text("INSERT INTO messages_fts(rowid, content) VALUES (:id, :content)"), params)
+
+
+def unindex_messages(db: Session, rows: Iterable[Tuple[int, str]]) -> None:
+    """Remove ``(id, content)`` pairs from the SQLite FTS table before the rows are deleted."""
+    if db.get_bind().dialect.name != "sqlite":
+        return
+    params = [{"id": message_id, "content": content} for message_id, content in rows]
+    if params:
+        db.execute(
+            text("INSERT INTO messages_fts(messages_fts, rowid, content) VALUES ('delete', :id, :content)"),
+            params
+        )
+
+
+def parse_cursor(cursor: Optional[str]) -> Optional[Tuple[float, int]]:
+    if not cursor:
+        return None
+    score, _, message_id = cursor.partition(":")
+    return float(score), int(message_id)
+
+
+def format_cursor(score: float, message_id: int) -> str:
+    return f"{score!r}:{message_id}"
+
+
+def fts5_query(q: str) -> str:
+    # Quote every word so user input can't inject FTS5 query syntax.
+    return " ".join(f'"{word}"' for word in re.findall(r"\w+", q))
+
+
+def search_messages(
+    db: Session,
+    q: str,
+    room_id: Optional[int] = None,
+    limit: int = 20,
+    cursor: Optional[str] = None
+) -> Tuple[List[Tuple[models.Message, float]], Optional[str]]:
+    """Return ``([(message, score), ...], next_cursor)``, best matches first."""
+    after = parse_cursor(cursor)
+    params = {"limit": limit + 1, "room_id": room_id}
+    if after is not None:
+        params["after_score"], params["after_id"] = after
+
+    if db.get_bind().dialect.name == "postgresql":
+        params["q"] = q
+        score = "ts_rank_cd(m.content_tsv, query)"
+        source = f"messages m, websearch_to_tsquery('{TS_CONFIG}', :q) query"
+        match = "m.content_tsv @@ query"
+    else:
+        params["q"] = fts5_query(q)
+        if not params["q"]:
+            return [], None
+        score = "-bm25(messages_fts)"
+        source = "messages_fts JOIN messages m ON m.id = messages_fts.rowid"
+        match = "messages_fts MATCH :q"
+
+    conditions = [match]
+    if room_id is not None:
+        conditions.append("m.room_id = :room_id")
+    if after is not None:
+        conditions.append(
+            f"({score} < :after_score OR ({score} = :after_score AND m.id < :after_id))"
+        )
+    rows = db.execute(text(
+        f"SELECT m.id, {score} AS score FROM {source} "
+        f"WHERE {' AND '.join(conditions)} "
+        f"ORDER BY score DESC, m.id DESC LIMIT :limit"
+    ), params).all()
+
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = format_cursor(rows[-1].score, rows[-1].id)
+
+    messages = {
+        m.id: m for m in db.query(models.Message).filter(models.Message.id.in_([r.id for r in rows]))
+    }
+    return [(messages[r.id], r.score) for r in rows], next_cursor
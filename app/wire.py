@@ -0,0 +1,195 @@
+"""Per-connection wire formats for WebSocket frames.
+
+Frames are built once per message as compact JSON text (see ``app.codec``).
+A socket can ask for something smaller when it connects to ``/ws/{room_id}``:
+
+* ``encoding=msgpack``: MessagePack with a compact schema. Well-known keys
+  are shortened (``KEYS``) and ``created_at`` is sent as integer
+  milliseconds since the epoch (UTC) instead of a string.
+* ``compress=true``: frames of at least ``WS_COMPRESS_THRESHOLD`` bytes are
+  deflated (zlib) when that makes them smaller.
+
+JSON without compression stays the default and is sent as text frames,
+exactly as before. Everything else is sent as binary frames whose first byte
+holds flags (``FLAG_DEFLATE``, ``FLAG_MSGPACK``) followed by the payload.
+Clients may send binary frames in the same format; a deflated one may not
+inflate to more than ``WS_MAX_FRAME_BYTES``.
+
+Each ``Wire`` remembers the last frame it encoded, and the broadcaster queues
+the same frame object for every connection in a room, so a message is encoded
+once per format rather than once per socket. The transport-level
+permessage-deflate extension, when the server negotiates it, compresses each
+socket separately on top of this.
+"""
+from datetime import datetime, timezone
+from typing import Any, Dict, Tuple, Union
+import os
+import zlib
+
+from app import codec
+
+try:
+    import msgpack
+except ImportError:  # pragma: no cover - depends on the environment
+    msgpack = None
+
+JSON = "json"
+MSGPACK = "msgpack"
+ENCODINGS = (JSON, MSGPACK) if msgpack is not None else (JSON,)
+
+WS_COMPRESS_THRESHOLD = int(os.getenv("WS_COMPRESS_THRESHOLD", "512"))
+WS_COMPRESS_LEVEL = int(os.getenv("WS_COMPRESS_LEVEL", "6"))
+WS_MAX_FRAME_BYTES = int(os.getenv("WS_MAX_FRAME_BYTES", "1048576"))
+
+FLAG_DEFLATE = 0x01
+FLAG_MSGPACK = 0x02
+
+# Long key -> short key in the msgpack schema; other keys are sent as is.
+KEYS = {
+    "id": "i",
+    "type": "y",
+    "user_id": "u",
+    "username": "n",
+    "content": "c",
+    "role": "r",
+    "created_at": "t",
+    "stream_id": "s",
+    "persona_id": "p",
+    "delta": "d",
+}
+LONG_KEYS = {short: long for long, short in KEYS.items()}
+
+
+def epoch_ms(created_at: Any) -> Any:
+    if not isinstance(created_at, str):
+        return created_at
+    try:
+        moment = datetime.fromisoformat(created_at)
+    except ValueError:
+        return created_at
+    if moment.tzinfo is None:
+        # SQLite stores CURRENT_TIMESTAMP, which is UTC, without an offset.
+        moment = moment.replace(tzinfo=timezone.utc)
+    return int(moment.timestamp() * 1000)
+
+
+def compact(frame: Any) -> Any:
+    if not isinstance(frame, dict):
+        return frame
+    if "created_at" in frame:
+        frame = {**frame, "created_at": epoch_ms(frame["created_at"])}
+    return {KEYS.get(key, key): value for key, value in frame.items()}
+
+
+def expand(frame: Any) -> Any:
+    if not isinstance(frame, dict):
+        return frame
+    return {LONG_KEYS.get(key, key): value for key, value in frame.items()}
+
+
+class Wire:
+    """One wire format; ``encode`` turns a JSON text frame into what goes on the socket."""
+
+    def __init__(
+        self,
+        encoding: str = JSON,
+        compress: bool = False,
+        threshold: int = WS_COMPRESS_THRESHOLD,
+        level: int = WS_COMPRESS_LEVEL,
+        max_frame_bytes: int = WS_MAX_FRAME_BYTES
+    ):
+        if encoding not in ENCODINGS:
+            raise ValueError(f"unsupported wire encoding: {encoding}")
+        self.encoding = encoding
+        self.compress = compress
+        self.threshold = threshold
+        self.level = level
+        self.max_frame_bytes = max_frame_bytes
+        self._last: Tuple[Any, Union[str, bytes, None]] = (None, None)
+
+        self.frames = 0
+        self.json_bytes = 0
+        self.bytes = 0
+        self.deflated = 0
+
+    @property
+    def name(self) -> str:
+        return f"{self.encoding}+deflate" if self.compress else self.encoding
+
+    def encode(self, frame: str) -> Union[str, bytes]:
+        last_frame, last_data = self._last
+        if frame is last_frame:
+            return last_data
+        data = self._encode(frame)
+        self._last = (frame, data)
+        return data
+
+    def decode(self, data: Union[str, bytes]) -> Any:
+        if isinstance(data, str):
+            return codec.loads(data)
+        if not data:
+            raise ValueError("empty binary frame")
+        flags, payload = data[0], data[1:]
+        if flags & FLAG_DEFLATE:
+            payload = self._inflate(payload)
+        if flags & FLAG_MSGPACK:
+            if msgpack is None:
+                raise ValueError("msgpack is not installed")
+            return expand(msgpack.unpackb(payload))
+        return codec.loads(payload)
+
+    def stats(self) -> dict:
+        return {
+            "frames": self.frames,
+            "bytes_per_message": self.bytes / self.frames if self.frames else 0.0,
+            "json_bytes_per_message": self.json_bytes / self.frames if self.frames else 0.0,
+            "deflated": self.deflated,
+        }
+
+    def _inflate(self, payload: bytes) -> bytes:
+        inflater = zlib.decompressobj()
+        data = inflater.decompress(payload, self.max_frame_bytes)
+        if inflater.unconsumed_tail:
+            raise ValueError(f"frame inflates to more than {self.max_frame_bytes} bytes")
+        return data
+
+    def _encode(self, frame: str) -> Union[str, bytes]:
+        text = frame.encode()
+        self.frames += 1
+        self.json_bytes += len(text)
+        flags = 0
+        payload = text
+        if self.encoding == MSGPACK:
+            flags |= FLAG_MSGPACK
+            payload = msgpack.packb(compact(codec.loads(frame)))
+        if self.compress and len(payload) >= self.threshold:
+            deflated = zlib.compress(payload, self.level)
+            if len(deflated) < len(payload):
+                flags |= FLAG_DEFLATE
+                payload = deflated
+                self.deflated += 1
+        if flags == 0:
+            self.bytes += len(text)
+            return frame
+        data = bytes([flags]) + payload
+        self.bytes += len(data)
+        return data
+
+
+class WireRegistry:
+    """One shared ``Wire`` per (encoding, compress), so frames are encoded once per format."""
+
+    def __init__(self, threshold: int = WS_COMPRESS_THRESHOLD, level: int = WS_COMPRESS_LEVEL):
+        self.threshold = threshold
+        self.level = level
+        self._wires: Dict[Tuple[str, bool], Wire] = {}
+
+    def get(self, encoding: str = JSON, compress: bool = False) -> Wire:
+        key = (encoding, compress)
+        wire = self._wires.get(key)
+        if wire is None:
+            wire = self._wires[key] = Wire(encoding, compress, self.threshold, self.level)
+        return wire
+
+    def stats(self) -> dict:
+        return {wire.name: wire.stats() for wire in self._wires.values()}
@@ -0,0 +1,61 @@
+"""Micro-benchmark: per-recipient encoding vs encode-once broadcast frames.
+
+Run from the repository root:
+
+    python benchmarks/bench_broadcast_encode.py [clients] [messages]
+"""
+from datetime import datetime, timezone
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import codec
+
+
+def per_recipient(message: dict, clients: int) -> None:
+    # What the broadcast loop used to do: send_json() re-encodes for every client.
+    queued = []
+    for _ in range(clients):
+        queued.append(json.dumps({**message, "created_at": str(message["created_at"])}))
+
+
+def encode_once(dumps, message: dict, clients: int) -> None:
+    frame = dumps({**message, "created_at": str(message["created_at"])})
+    queued = []
+    for _ in range(clients):
+        queued.append(frame)
+
+
+def run(label: str, fn, messages: int) -> float:
+    start = time.perf_counter()
+    for _ in range(messages):
+        fn()
+    elapsed = time.perf_counter() - start
+    print(f"{label:<28} {elapsed * 1000:10.1f} ms  {elapsed / messages * 1e6:10.1f} us/message")
+    return elapsed
+
+
+def main() -> None:
+    clients = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    messages = int(sys.argv[2]) if len(sys.argv) > 2 else 1000
+    message = {
+        "id": 123456,
+        "user_id": 42,
+        "username": "someone",
+        "content": "a typical short chat line, nothing fancy " * 2,
+        "role": "user",
+        "created_at": datetime.now(timezone.utc),
+    }
+
+    print(f"{clients} clients, {messages} messages, fast codec: {codec.CODEC}")
+    baseline = run("per-recipient json", lambda: per_recipient(message, clients), messages)
+    once_stdlib = run("encode-once json", lambda: encode_once(codec.dumps_stdlib, message, clients), messages)
+    once_fast = run(f"encode-once {codec.CODEC}", lambda: encode_once(codec.dumps, message, clients), messages)
+    print(f"speedup: {baseline / once_stdlib:.0f}x (json), {baseline / once_fast:.0f}x ({codec.CODEC})")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,59 @@
+"""Benchmark: persona generation latency for quiet rooms next to a hot room.
+
+One hot room submits a burst of generations while many quiet rooms submit one
+each, all against the offline stub provider. With round-robin scheduling the
+quiet rooms' queue wait stays near one generation time instead of growing
+with the hot room's backlog.
+
+Run from the repository root:
+
+    python benchmarks/bench_persona_engine.py [quiet_rooms] [hot_burst] [workers]
+"""
+import asyncio
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.ai import GenerationRequest, PersonaEngine, StubProvider
+
+
+def percentile(values, q: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+async def run(quiet_rooms: int, hot_burst: int, workers: int) -> None:
+    provider = StubProvider(first_token_delay=0.05, token_delay=0.002, reply_tokens=20)
+    engine = PersonaEngine(provider, workers=workers, room_concurrency=1, room_max_pending=hot_burst)
+    await engine.start()
+
+    def submit(room_id):
+        request = GenerationRequest(room_id, 1, "Stub", None, [{"username": "u", "content": f"hi {room_id}"}])
+        return engine.submit(room_id, request)
+
+    start = time.perf_counter()
+    hot = [submit("hot") for _ in range(hot_burst)]
+    quiet = [submit(room) for room in range(quiet_rooms)]
+    await asyncio.gather(*hot, *quiet)
+    elapsed = time.perf_counter() - start
+    await engine.stop()
+
+    waits = [(g.started_at - g.queued_at) * 1000 for g in quiet]
+    ttft = [(g.first_token_at - g.started_at) * 1000 for g in hot + quiet]
+    print(f"{quiet_rooms} quiet rooms, hot burst {hot_burst}, {workers} workers: {elapsed:.2f} s total")
+    print(f"quiet room queue wait  p50 {percentile(waits, 0.5):8.1f} ms  p99 {percentile(waits, 0.99):8.1f} ms")
+    print(f"time to first token    p50 {percentile(ttft, 0.5):8.1f} ms  p99 {percentile(ttft, 0.99):8.1f} ms")
+    print(f"stats: {engine.stats()}")
+
+
+def main() -> None:
+    quiet_rooms = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+    hot_burst = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+    workers = int(sys.argv[3]) if len(sys.argv) > 3 else 8
+    asyncio.run(run(quiet_rooms, hot_burst, workers))
+
+
+if __name__ == "__main__":
+    main()
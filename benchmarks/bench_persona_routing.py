@@ -0,0 +1,79 @@
+"""Benchmark: routing messages to personas, one by one vs. batched.
+
+Scores a batch of messages against every persona, first the naive way (embed
+each persona and compute one similarity per persona per message) and then
+with the router's precomputed matrix and single matrix product, and reports
+the time per message for each.
+
+Run from the repository root:
+
+    python benchmarks/bench_persona_routing.py [personas] [messages]
+"""
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import models
+from app.ai import PersonaRouter
+from app.ai.providers import STUB_WORDS
+from app.ai.routing import embed, persona_text
+
+TOPICS = (
+    "cooking", "astronomy", "python", "gardening", "history", "music", "finance", "football",
+    "chemistry", "poetry", "travel", "movies", "fitness", "painting", "chess", "law",
+)
+
+
+def make_personas(count: int, rng: random.Random):
+    return [
+        models.Persona(
+            id=i, name=f"P{i}",
+            system_prompt=" ".join(rng.choice(TOPICS) for _ in range(8)) + " " + " ".join(rng.sample(STUB_WORDS, 6))
+        )
+        for i in range(count)
+    ]
+
+
+def make_messages(count: int, rng: random.Random):
+    return [" ".join(rng.choice(TOPICS + STUB_WORDS) for _ in range(12)) for _ in range(count)]
+
+
+def naive(personas, messages, k: int):
+    results = []
+    for message in messages:
+        query = embed([message])[0]
+        scored = [(float(embed([persona_text(p)])[0] @ query), p.id) for p in personas]
+        results.append(sorted(scored, reverse=True)[:k])
+    return results
+
+
+def main() -> None:
+    persona_count = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+    message_count = int(sys.argv[2]) if len(sys.argv) > 2 else 500
+    rng = random.Random(0)
+    personas = make_personas(persona_count, rng)
+    messages = make_messages(message_count, rng)
+
+    start = time.perf_counter()
+    naive(personas, messages, 3)
+    naive_elapsed = time.perf_counter() - start
+
+    router = PersonaRouter(min_score=0)
+    start = time.perf_counter()
+    router.sync_personas(personas)
+    build_elapsed = time.perf_counter() - start
+    start = time.perf_counter()
+    router.route_many(messages, k=3)
+    batched_elapsed = time.perf_counter() - start
+
+    print(f"{persona_count} personas, {message_count} messages")
+    print(f"per persona  {naive_elapsed / message_count * 1e6:10.1f} us/message")
+    print(f"batched      {batched_elapsed / message_count * 1e6:10.1f} us/message "
+          f"(matrix built once in {build_elapsed * 1000:.1f} ms)")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,7 +1,11 @@
 import pytest
+import asyncio
+import json
 import os
 from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+from sqlalchemy.pool import NullPool
 from fastapi.testclient import TestClient
 
 os.environ["DATABASE_URL"] = "sqlite:///./test.db"
@@ -16,6 +20,52 @@ engine = create_engine(
 )
 TestingSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
+async_engine = create_async_engine("sqlite+aiosqlite:///./test.db", poolclass=NullPool)
+TestingAsyncSessionLocal = async_sessionmaker(async_engine, autoflush=False, expire_on_commit=False)
+
+class FakeSocket:
+    """The send/close pair a Connection writes to."""
+    
+    def __init__(self, delay: float = 0):
+        self.delay = delay
+        self.received = []
+        self.closed_with = None
+    
+    async def send(self, frame):
+        await asyncio.sleep(self.delay)
+        self.received.append(frame)
+    
+    async def close(self, code):
+        self.closed_with = code
+
+class FakeConnection:
+    """Records what would be queued on a Connection."""
+    
+    def __init__(self):
+        self.frames = []
+        self.closed_with = None
+    
+    def enqueue(self, frame, key=None):
+        self.frames.append(frame)
+        return True
+    
+    def pending(self, key):
+        return False
+    
+    def disconnect(self, code):
+        self.closed_with = code
+    
+    def decoded(self):
+        return [json.loads(frame) for frame in self.frames]
+
+@pytest.fixture
+def fake_socket():
+    return FakeSocket
+
+@pytest.fixture
+def fake_connection():
+    return FakeConnection
+
 @pytest.fixture
 def db_session():
     Base.metadata.create_all(bind=engine)
@@ -28,11 +78,9 @@ def db_session():
 
 @pytest.fixture
 def client(db_session):
-    def override_get_db():
-        try:
-            yield db_session
-        finally:
-            pass
+    async def override_get_db():
+        async with TestingAsyncSessionLocal() as session:
+            yield session
     
     app.dependency_overrides[get_db] = override_get_db
     
@@ -0,0 +1,96 @@
+from app import crud, models
+from app.ai import ContextStore, RoomContext, StubProvider, count_tokens
+
+def entry(message_id, content, role="user", username="u"):
+    return {"id": message_id, "username": username, "role": role, "content": content}
+
+def persona(**kwargs):
+    fields = {"id": 1, "name": "Sage", "system_prompt": "Be wise.", "style": None, **kwargs}
+    return models.Persona(**fields)
+
+def test_count_tokens():
+    assert count_tokens("Hello, world!") == 4
+
+def test_window_evicts_oldest_to_stay_in_budget():
+    context = RoomContext(1, budget=6)
+    for i in range(5):
+        context.add(entry(i, "two words"))
+    
+    assert [t["id"] for t in context.turns] == [2, 3, 4]
+    assert context.tokens == 6
+    assert context.evicted == 2
+    
+    context.add(entry(9, "one turn far larger than the whole budget"))
+    assert [t["id"] for t in context.turns] == [9]
+
+def test_window_ignores_duplicates_and_caps_turns():
+    context = RoomContext(1, budget=100, max_turns=2)
+    for i in (1, 2, 2, 3):
+        context.add(entry(i, "x"))
+    
+    assert [t["id"] for t in context.turns] == [2, 3]
+    assert context.tokens == 2
+
+def test_preamble_is_cached_until_persona_or_theme_changes():
+    context = RoomContext(1, theme="space", theme_description="rockets")
+    sage = persona()
+    
+    text, tokens = context.preamble(sage)
+    assert "Be wise." in text and "space - rockets" in text
+    assert context.preamble(sage)[0] is text
+    
+    assert context.preamble(persona(system_prompt="Be brief."))[0] != text
+    context.set_theme("sea")
+    assert "Room theme: sea" in context.preamble(sage)[0]
+
+def test_request_uses_window_and_preamble():
+    context = RoomContext(7)
+    context.add(entry(1, "hello there"))
+    
+    request = context.request(persona(), max_tokens=10)
+    
+    assert request.room_id == 7
+    assert request.messages[-1]["content"] == "hello there"
+    assert request.prompt_tokens == context.preamble(persona())[1] + 2
+    assert request.max_tokens == 10
+
+def test_store_observes_only_built_rooms_and_skips_system_messages():
+    store = ContextStore(max_rooms=2)
+    store.observe(1, entry(1, "ignored"))
+    assert store.get(1) is None
+    
+    context = store.seed(1, None, None, [entry(1, "a"), entry(2, "joined", role="system")])
+    store.observe(1, entry(3, "b"))
+    assert [t["id"] for t in context.turns] == [1, 3]
+    
+    store.seed(2, None, None, [])
+    store.seed(3, None, None, [])
+    assert store.get(1) is None
+
+def test_room_context_is_built_once_and_kept_current(client, db_session, monkeypatch):
+    from app import main
+    from app.auth import create_access_token
+    monkeypatch.setattr(main.persona_engine, "provider", StubProvider(0, 0, reply_tokens=2))
+    monkeypatch.setattr(main.turns, "debounce", 0)
+    crud.create_user(db_session, "wsuser", "ws@example.com", "hashedpw")
+    crud.create_persona(db_session, "Sage")
+    room = crud.create_chatroom(db_session, "AI Room")
+    crud.create_message(db_session, room.id, "earlier")
+    token = create_access_token({"sub": "wsuser"})
+    
+    def until_reply(websocket):
+        while websocket.receive_json().get("role") != "ai":
+            pass
+    
+    builds = main.contexts.builds
+    with client.websocket_connect(f"/ws/{room.id}?token={token}") as websocket:
+        websocket.send_json({"content": "@Sage one"})
+        until_reply(websocket)
+        websocket.send_json({"content": "@Sage two"})
+        until_reply(websocket)
+        context = main.contexts.get(room.id)
+    
+    contents = [t["content"] for t in context.turns]
+    assert contents[:2] == ["earlier", "@Sage one"]
+    assert "@Sage two" in contents
+    assert main.contexts.builds == builds + 1
@@ -0,0 +1,197 @@
+import asyncio
+import pytest
+from app import crud
+from app.ai import GenerationRequest, PersonaEngine, Provider, StubProvider
+
+def request(room_id, content="hello", persona_id=1, max_tokens=256):
+    return GenerationRequest(room_id, persona_id, "Sage", "be wise", [{"username": "u", "content": content}], max_tokens)
+
+class RecordingProvider(Provider):
+    name = "recording"
+    
+    def __init__(self, delay=0.01, tokens=3):
+        self.delay = delay
+        self.tokens = tokens
+        self.order = []
+    
+    async def stream(self, request):
+        self.order.append(request.messages[-1]["content"])
+        for _ in range(self.tokens):
+            await asyncio.sleep(self.delay)
+            yield "x "
+
+def test_stub_provider_is_deterministic():
+    provider = StubProvider(0, 0, reply_tokens=10)
+    
+    assert provider.reply(request(1)) == provider.reply(request(1))
+    assert provider.reply(request(1)) != provider.reply(request(1, "something else"))
+    assert len(provider.reply(request(1, max_tokens=4))) == 4
+
+@pytest.mark.asyncio
+async def test_generation_returns_text():
+    engine = PersonaEngine(StubProvider(0, 0, reply_tokens=5), workers=1)
+    await engine.start()
+    try:
+        text = await engine.submit(1, request(1))
+    finally:
+        await engine.stop()
+    
+    assert text == "".join(StubProvider(0, 0, reply_tokens=5).reply(request(1)))
+    assert engine.stats()["completed"] == 1
+    assert engine.stats()["tokens"] == 5
+
+@pytest.mark.asyncio
+async def test_rooms_are_served_round_robin():
+    provider = RecordingProvider()
+    engine = PersonaEngine(provider, workers=1, room_max_pending=20)
+    await engine.start()
+    try:
+        hot = [engine.submit("hot", request("hot", f"hot {i}")) for i in range(10)]
+        quiet = engine.submit("quiet", request("quiet", "quiet"))
+        await asyncio.gather(quiet, *hot)
+    finally:
+        await engine.stop()
+    
+    assert provider.order.index("quiet") == 1
+
+@pytest.mark.asyncio
+async def test_room_concurrency_and_global_pool_are_bounded():
+    running = {"now": 0, "peak": 0}
+    
+    class CountingProvider(Provider):
+        async def stream(self, request):
+            running["now"] += 1
+            running["peak"] = max(running["peak"], running["now"])
+            await asyncio.sleep(0.01)
+            running["now"] -= 1
+            yield "x"
+    
+    engine = PersonaEngine(CountingProvider(), workers=3, room_concurrency=1)
+    await engine.start()
+    try:
+        await asyncio.gather(*[engine.submit("room", request("room")) for _ in range(4)])
+        assert running["peak"] == 1
+        await asyncio.gather(*[engine.submit(room, request(room)) for room in range(6)])
+        assert running["peak"] == 3
+    finally:
+        await engine.stop()
+
+@pytest.mark.asyncio
+async def test_queue_and_budget_limits_reject():
+    engine = PersonaEngine(RecordingProvider(tokens=5), workers=1, room_max_pending=2, room_token_budget=5)
+    await engine.start()
+    try:
+        first = engine.submit(1, request(1))
+        await asyncio.sleep(0)
+        assert engine.submit(1, request(1)) is not None
+        assert engine.submit(1, request(1)) is not None
+        assert engine.submit(1, request(1)) is None
+        await first
+        engine.cancel_room(1)
+        assert engine.submit(1, request(1)) is None
+        assert engine.submit(2, request(2)) is not None
+    finally:
+        await engine.stop()
+    
+    assert engine.stats()["rejected_queue_full"] == 1
+    assert engine.stats()["rejected_budget"] == 1
+
+@pytest.mark.asyncio
+async def test_cancel_room_stops_running_and_queued():
+    engine = PersonaEngine(RecordingProvider(delay=1), workers=2)
+    await engine.start()
+    try:
+        running = engine.submit(1, request(1))
+        queued = engine.submit(1, request(1))
+        other = engine.submit(2, request(2))
+        await asyncio.sleep(0.01)
+        
+        assert engine.cancel_room(1) == 2
+        
+        await asyncio.sleep(0)
+        assert running.future.cancelled() and queued.future.cancelled()
+        assert not other.done()
+        assert engine.stats()["queued"] == 0
+    finally:
+        await engine.stop()
+
+def test_mentioned_persona_replies_in_room(client, db_session, monkeypatch):
+    from app import main
+    from app.auth import create_access_token
+    monkeypatch.setattr(main.persona_engine, "provider", StubProvider(0, 0, reply_tokens=3))
+    monkeypatch.setattr(main.turns, "debounce", 0)
+    crud.create_user(db_session, "wsuser", "ws@example.com", "hashedpw")
+    crud.create_persona(db_session, "Sage", "be wise")
+    room = crud.create_chatroom(db_session, "AI Room")
+    token = create_access_token({"sub": "wsuser"})
+    
+    with client.websocket_connect(f"/ws/{room.id}?token={token}") as websocket:
+        websocket.receive_json()
+        websocket.send_json({"content": "hi @sage"})
+        assert websocket.receive_json()["content"] == "hi @sage"
+        deltas = []
+        while (frame := websocket.receive_json()).get("type") == "ai_delta":
+            deltas.append(frame)
+        reply = frame
+    
+    assert deltas and all(d["stream_id"] == reply["stream_id"] for d in deltas)
+    assert "".join(d["delta"] for d in deltas) == reply["content"]
+    assert reply["role"] == "ai"
+    assert reply["username"] == "Sage"
+    assert reply["content"].endswith(".")
+
+def test_ai_replies_keep_their_persona_when_read_back_from_the_db(client, db_session, monkeypatch):
+    from app import main
+    from app.auth import create_access_token
+    from tests.conftest import TestingAsyncSessionLocal
+    monkeypatch.setattr(main.persona_engine, "provider", StubProvider(0, 0, reply_tokens=3))
+    monkeypatch.setattr(main.turns, "debounce", 0)
+    crud.create_user(db_session, "wsuser", "ws@example.com", "hashedpw")
+    sage = crud.create_persona(db_session, "Sage", "be wise")
+    room = crud.create_chatroom(db_session, "AI Room")
+    token = create_access_token({"sub": "wsuser"})
+    
+    with client.websocket_connect(f"/ws/{room.id}?token={token}") as websocket:
+        websocket.receive_json()
+        websocket.send_json({"content": "hi @sage"})
+        first = websocket.receive_json()
+        while websocket.receive_json().get("type") == "ai_delta":
+            pass
+    client.portal.call(main.message_writer.stop)
+    client.portal.call(main.message_writer.start)
+    main.history.clear()
+    main.contexts.clear()
+    
+    stored = crud.get_messages(db_session, room.id, limit=10)
+    assert [(m.role, m.persona_id) for m in stored] == [("ai", sage.id), ("user", None)]
+    assert client.get(f"/rooms/{room.id}/messages").json()[1]["persona_id"] == sage.id
+    
+    with client.websocket_connect(f"/ws/{room.id}?token={token}&last_seen_id={first['id']}") as websocket:
+        replayed = websocket.receive_json()
+    assert replayed["username"] == "Sage" and replayed["persona_id"] == sage.id
+    
+    
+    async def rebuilt_context():
+        async with TestingAsyncSessionLocal() as db:
+            return await main.build_context(db, room.id)
+    
+    assert [turn["username"] for turn in client.portal.call(rebuilt_context).turns] == ["wsuser", "Sage"]
+
+@pytest.mark.asyncio
+async def test_deltas_are_coalesced_and_ttft_recorded():
+    deltas = []
+    
+    async def on_delta(generation, delta):
+        deltas.append(delta)
+    
+    engine = PersonaEngine(StubProvider(0, 0.001, reply_tokens=30), workers=1, stream_interval=10)
+    await engine.start()
+    try:
+        text = await engine.submit(1, request(1), on_delta=on_delta)
+    finally:
+        await engine.stop()
+    
+    # The first token goes out at once, the rest within the same window.
+    assert len(deltas) == 2
+    assert "".join(deltas) == text
+    assert engine.stats()["ttft_ms"]["Sage"]["samples"] == 1
@@ -0,0 +1,130 @@
+import asyncio
+import pytest
+from app.ai import CachingProvider, GenerationRequest, PersonaEngine, Provider, ResponseCache
+from app.ai.response_cache import cache_key
+
+def request(*contents, persona_id=1, system_prompt="You are Sage."):
+    messages = [{"username": f"user{i}", "content": c} for i, c in enumerate(contents)]
+    return GenerationRequest(1, persona_id, "Sage", system_prompt, messages)
+
+class CountingProvider(Provider):
+    name = "counting"
+    
+    def __init__(self, delay=0.0, fail=False):
+        self.calls = 0
+        self.delay = delay
+        self.fail = fail
+        self.cancelled = 0
+    
+    async def stream(self, request):
+        self.calls += 1
+        try:
+            for token in ("hello ", "there."):
+                await asyncio.sleep(self.delay)
+                if self.fail:
+                    raise ValueError("provider down")
+                yield token
+        except asyncio.CancelledError:
+            self.cancelled += 1
+            raise
+
+async def collect(provider, req):
+    return [token async for token in provider.stream(req)]
+
+def test_cache_key_normalizes_recent_context():
+    assert cache_key(request("Hello,  World!")) == cache_key(request("hello world"))
+    assert cache_key(request("old", "x", "y", "hi")) == cache_key(request("other", "x", "y", "hi"))
+    assert cache_key(request("hi")) != cache_key(request("hi", persona_id=2))
+    assert cache_key(request("hi")) != cache_key(request("hi", system_prompt="Room theme: sea"))
+
+@pytest.mark.asyncio
+async def test_repeated_prompt_is_served_from_cache():
+    inner = CountingProvider()
+    provider = CachingProvider(inner, ResponseCache())
+    
+    first = await collect(provider, request("Hi!"))
+    second = await collect(provider, request("hi"))
+    
+    assert first == second == ["hello ", "there."]
+    assert inner.calls == 1
+    assert provider.stats()["memory_hits"] == 1
+    assert provider.stats()["provider_calls_saved"] == 1
+
+@pytest.mark.asyncio
+async def test_entries_expire_and_lru_is_bounded():
+    inner = CountingProvider()
+    provider = CachingProvider(inner, ResponseCache(maxsize=1, ttl=0))
+    
+    await collect(provider, request("a"))
+    await collect(provider, request("a"))
+    assert inner.calls == 2
+    
+    provider.cache.ttl = 60
+    await collect(provider, request("b"))
+    await collect(provider, request("c"))
+    assert provider.stats()["entries"] == 1
+
+@pytest.mark.asyncio
+async def test_concurrent_identical_prompts_share_one_call():
+    inner = CountingProvider(delay=0.01)
+    provider = CachingProvider(inner, ResponseCache())
+    
+    results = await asyncio.gather(*[collect(provider, request("hi")) for _ in range(5)])
+    
+    assert all(r == ["hello ", "there."] for r in results)
+    assert inner.calls == 1
+    assert provider.stats()["coalesced"] == 4
+
+@pytest.mark.asyncio
+async def test_shared_call_survives_one_caller_cancelling():
+    inner = CountingProvider(delay=0.01)
+    provider = CachingProvider(inner, ResponseCache())
+    
+    leaving = asyncio.create_task(collect(provider, request("hi")))
+    staying = asyncio.create_task(collect(provider, request("hi")))
+    await asyncio.sleep(0.005)
+    leaving.cancel()
+    
+    assert await staying == ["hello ", "there."]
+    assert inner.cancelled == 0
+
+@pytest.mark.asyncio
+async def test_shared_call_is_cancelled_when_every_caller_leaves():
+    inner = CountingProvider(delay=0.05)
+    engine = PersonaEngine(CachingProvider(inner, ResponseCache()), workers=2)
+    await engine.start()
+    try:
+        engine.submit(1, request("hi"))
+        engine.submit(1, request("hi"))
+        await asyncio.sleep(0.01)
+        engine.cancel_room(1)
+        await asyncio.sleep(0.01)
+    finally:
+        await engine.stop()
+    
+    assert inner.cancelled == 1
+
+@pytest.mark.asyncio
+async def test_failures_reach_every_caller_and_are_not_cached():
+    inner = CountingProvider(delay=0.01, fail=True)
+    provider = CachingProvider(inner, ResponseCache())
+    
+    results = await asyncio.gather(*[collect(provider, request("hi")) for _ in range(2)], return_exceptions=True)
+    
+    assert all(isinstance(r, ValueError) for r in results)
+    assert provider.stats()["entries"] == 0
+
+@pytest.mark.asyncio
+async def test_disk_tier_survives_restart(tmp_path):
+    path = str(tmp_path / "responses.db")
+    inner = CountingProvider()
+    provider = CachingProvider(inner, ResponseCache(path=path))
+    await collect(provider, request("hi"))
+    await provider.close()
+    
+    restarted = CachingProvider(inner, ResponseCache(path=path))
+    assert await collect(restarted, request("hi")) == ["hello ", "there."]
+    
+    assert inner.calls == 1
+    assert restarted.stats()["disk_hits"] == 1
+    await restarted.close()
@@ -0,0 +1,85 @@
+import numpy as np
+from app import models
+from app.ai import PersonaRouter
+from app.ai.routing import embed
+
+def persona(persona_id, name, system_prompt, style=None):
+    return models.Persona(id=persona_id, name=name, system_prompt=system_prompt, style=style)
+
+PERSONAS = [
+    persona(1, "Chef", "You cook. Recipes, baking bread, pasta sauce and kitchen knives."),
+    persona(2, "Astro", "You explain astronomy: planets, stars, telescopes and rocket launches."),
+    persona(3, "Coder", "You help with programming: python bugs, compilers and databases."),
+]
+
+def router(**kwargs):
+    r = PersonaRouter(dim=512, min_score=0.1, **kwargs)
+    r.sync_personas(PERSONAS)
+    return r
+
+def test_embeddings_are_normalized_and_deterministic():
+    vectors = embed(["Rocket launches tonight", "rocket LAUNCHES tonight!", "the and of"], 256)
+    
+    assert vectors.shape == (3, 256)
+    assert np.allclose(np.linalg.norm(vectors[:2], axis=1), 1)
+    assert np.allclose(vectors[0], vectors[1])
+    assert not vectors[2].any()
+
+def test_routes_to_the_most_relevant_persona():
+    r = router()
+    
+    assert [name for _, name, _ in r.route("what telescope should I use to see the planets?")] == ["Astro"]
+    assert [name for _, name, _ in r.route("my python bugs are driving me mad", k=3)][0] == "Coder"
+    assert r.route("ok lol") == []
+
+def test_batch_matches_single_routes():
+    r = router()
+    contents = ["baking bread at home", "rocket launches", "python compilers", "hello there"]
+    
+    assert r.route_many(contents, k=2) == [r.route(c, k=2) for c in contents]
+    assert r.stats()["routed"] == 2 * len(contents)
+
+def test_theme_ranks_relevant_personas():
+    r = router(theme_weight=1.0)
+    r.sync_themes([models.Theme(id=1, name="space", description="planets stars and rocket launches")])
+    # "launches" also matches nothing else, so the theme decides between ties.
+    plain = r.route("python rocket launches", k=2)
+    themed = r.route("python rocket launches", theme="space", k=2)
+    
+    assert {m[1] for m in plain} == {m[1] for m in themed} == {"Astro", "Coder"}
+    assert themed[0][1] == "Astro"
+    assert themed[0][2] > dict((m[1], m[2]) for m in plain)["Astro"]
+
+def test_persona_matrix_updates_incrementally():
+    r = router()
+    assert r.personas.embedded == 3
+    
+    assert r.sync_personas(PERSONAS) == 0
+    edited = persona(1, "Chef", "You are a sommelier: wine, grapes and vineyards.")
+    assert r.sync_personas([edited, *PERSONAS[1:]]) == 1
+    assert [name for _, name, _ in r.route("which wine goes with this?")] == ["Chef"]
+    
+    # Dropping a persona moves the last row into its place.
+    assert r.sync_personas([edited, PERSONAS[2]]) == 0
+    assert r.stats()["personas"] == 2
+    assert r.route("rocket launches and telescopes") == []
+    assert [name for _, name, _ in r.route("python compilers")] == ["Coder"]
+    
+    assert r.sync_personas([persona(4, "Gardener", "Tomatoes, roses and compost.")], prune=False) == 1
+    assert r.stats()["personas"] == 3
+    assert [name for _, name, _ in r.route("my roses need compost")] == ["Gardener"]
+
+def test_route_endpoint(client, db_session):
+    from app import crud
+    from app.auth import create_access_token
+    crud.create_user(db_session, "router", "router@example.com", "hashedpw")
+    client.cookies.set("access_token", create_access_token({"sub": "router"}))
+    for p in PERSONAS:
+        response = client.post("/personas", json={"name": p.name, "system_prompt": p.system_prompt})
+        assert response.status_code == 201
+    
+    response = client.get("/personas/route", params={"content": "any good pasta sauce recipes?", "k": 2})
+    
+    assert response.status_code == 200
+    assert response.json()[0]["name"] == "Chef"
+    assert client.get("/metrics").json()["ai_routing"]["personas"] == 3
@@ -0,0 +1,143 @@
+import asyncio
+import pytest
+from app.ai import GenerationRequest, PersonaEngine, Provider, TurnScheduler
+
+class SlowProvider(Provider):
+    name = "slow"
+    
+    async def stream(self, request):
+        await asyncio.sleep(0.05)
+        yield f"@{request.messages[-1]['content']}"
+
+class Recorder:
+    def __init__(self, engine=None):
+        self.engine = engine
+        self.turns = []
+    
+    async def __call__(self, room_id, names, depth):
+        self.turns.append((room_id, sorted(names), depth))
+        if self.engine is None:
+            return []
+        return [
+            self.engine.submit(room_id, GenerationRequest(room_id, i, name, None, [{"content": "hi"}]))
+            for i, name in enumerate(names)
+        ]
+
+async def scheduler(run_turn, **kwargs):
+    turns = TurnScheduler(**{"debounce": 0.02, "max_delay": 1, **kwargs})
+    await turns.start(run_turn)
+    return turns
+
+@pytest.mark.asyncio
+async def test_burst_of_mentions_is_one_turn():
+    recorder = Recorder()
+    turns = await scheduler(recorder, max_speakers=3)
+    turns.message(1, "hey @Sage")
+    turns.message(1, "and @Bard too")
+    turns.message(1, "@sage?")
+    turns.message(2, "no mentions here")
+    await asyncio.sleep(0.05)
+    await turns.stop()
+    
+    assert recorder.turns == [(1, ["Bard", "Sage"], 0)]
+    assert turns.stats()["debounced"] == 2
+
+@pytest.mark.asyncio
+async def test_max_delay_bounds_debouncing():
+    recorder = Recorder()
+    turns = await scheduler(recorder, debounce=0.03, max_delay=0.05)
+    for _ in range(6):
+        turns.message(1, "@Sage")
+        await asyncio.sleep(0.015)
+    await asyncio.sleep(0.04)
+    await turns.stop()
+    
+    assert len(recorder.turns) >= 1
+    assert recorder.turns[0][1] == ["Sage"]
+
+@pytest.mark.asyncio
+async def test_speakers_per_turn_are_capped():
+    recorder = Recorder()
+    turns = await scheduler(recorder, max_speakers=2)
+    turns.message(1, "@a @b @c @d")
+    await asyncio.sleep(0.05)
+    await turns.stop()
+    
+    assert recorder.turns == [(1, ["a", "b"], 0)]
+
+@pytest.mark.asyncio
+async def test_persona_chains_stop_at_max_depth():
+    recorder = Recorder()
+    turns = await scheduler(recorder, max_depth=1)
+    turns.message(1, "@Bard", depth=1, author="Sage")
+    turns.message(2, "@Sage", depth=2, author="Bard")
+    turns.message(3, "talking to myself, @Sage", depth=1, author="Sage")
+    await asyncio.sleep(0.05)
+    await turns.stop()
+    
+    assert recorder.turns == [(1, ["Bard"], 1)]
+    assert turns.stats()["dropped_depth"] == 1
+
+@pytest.mark.asyncio
+async def test_turns_per_minute_budget():
+    recorder = Recorder()
+    turns = await scheduler(recorder, turns_per_minute=2)
+    for _ in range(3):
+        turns.message(1, "@Sage")
+        await asyncio.sleep(0.04)
+    await turns.stop()
+    
+    assert len(recorder.turns) == 2
+    assert turns.stats()["dropped_budget"] == 1
+
+@pytest.mark.asyncio
+async def test_human_message_supersedes_queued_generations():
+    engine = PersonaEngine(SlowProvider(), workers=1, room_concurrency=1)
+    await engine.start()
+    recorder = Recorder(engine)
+    turns = await scheduler(recorder)
+    try:
+        turns.message(1, "@Sage @Bard")
+        await asyncio.sleep(0.03)
+        turns.message(1, "never mind")
+        await asyncio.sleep(0.1)
+    finally:
+        await turns.stop()
+        await engine.stop()
+    
+    assert turns.stats()["superseded"] == 1
+    assert engine.stats()["completed"] == 1
+
+@pytest.mark.asyncio
+async def test_reply_continues_the_chain():
+    engine = PersonaEngine(SlowProvider(), workers=1)
+    await engine.start()
+    recorder = Recorder(engine)
+    turns = await scheduler(recorder, max_depth=1)
+    try:
+        turns.message(1, "@Sage")
+        await asyncio.sleep(0.03)
+        generation = next(iter(turns._generations[1]))
+        await generation
+        turns.reply(generation)
+        await asyncio.sleep(0.03)
+    finally:
+        await turns.stop()
+        await engine.stop()
+    
+    # SlowProvider replies "@hi", so Sage summons "hi" one hop deeper.
+    assert recorder.turns == [(1, ["Sage"], 0), (1, ["hi"], 1)]
+
+@pytest.mark.asyncio
+async def test_unaddressed_messages_are_routed():
+    recorder = Recorder()
+    turns = TurnScheduler(debounce=0.02)
+    await turns.start(recorder, lambda room_id, content: ["Chef"] if "pasta" in content else [])
+    turns.message(1, "how long should pasta boil?")
+    turns.message(2, "nice weather")
+    turns.message(3, "pasta again", depth=1, author="Sage")
+    await asyncio.sleep(0.05)
+    await turns.stop()
+    
+    assert recorder.turns == [(1, ["Chef"], 0)]
+    assert turns.stats()["routed"] == 1
@@ -103,3 +103,74 @@ def test_get_me(client):
 def test_get_me_unauthorized(client):
     response = client.get("/auth/me")
     assert response.status_code == 401
+
+def test_get_me_uses_auth_cache_and_invalidates_on_user_change(client, db_session):
+    from app import crud
+    from app.auth import auth_cache
+    
+    client.post(
+        "/auth/signup",
+        json={
+            "username": "testuser",
+            "email": "test@example.com",
+            "password": "testpassword123"
+        }
+    )
+    client.post(
+        "/auth/login",
+        json={
+            "username": "testuser",
+            "password": "testpassword123"
+        }
+    )
+    
+    client.get("/auth/me")
+    hits = auth_cache.stats()["hits"]
+    assert client.get("/auth/me").json()["email"] == "test@example.com"
+    assert auth_cache.stats()["hits"] == hits + 1
+    
+    user = crud.get_user_by_username(db_session, "testuser")
+    user.email = "changed@example.com"
+    db_session.commit()
+    
+    assert auth_cache.stats()["entries"] == 0
+    assert client.get("/auth/me").json()["email"] == "changed@example.com"
+
+def test_login_rehashes_password_when_cost_changes(client, db_session):
+    from passlib.context import CryptContext
+    from app import crud
+    from app.auth import BCRYPT_ROUNDS
+    
+    cheap = CryptContext(schemes=["bcrypt"], bcrypt__rounds=4)
+    crud.create_user(db_session, "testuser", "test@example.com", cheap.hash("testpassword123"))
+    
+    response = client.post(
+        "/auth/login",
+        json={
+            "username": "testuser",
+            "password": "testpassword123"
+        }
+    )
+    assert response.status_code == 200
+    
+    db_session.expire_all()
+    user = crud.get_user_by_username(db_session, "testuser")
+    assert user.hashed_password.startswith(f"$2b${BCRYPT_ROUNDS:02d}$")
+
+@pytest.mark.asyncio
+async def test_password_hasher_rejects_when_saturated():
+    import asyncio
+    from fastapi import HTTPException
+    from app.auth import PasswordHasher
+    
+    hasher = PasswordHasher(workers=1, max_pending=0)
+    try:
+        results = await asyncio.gather(
+            hasher.hash("first"), hasher.hash("second"), return_exceptions=True
+        )
+    finally:
+        hasher.shutdown()
+    
+    assert isinstance(results[0], str)
+    assert isinstance(results[1], HTTPException) and results[1].status_code == 429
+    assert hasher.stats()["rejected"] == 1
@@ -0,0 +1,53 @@
+import asyncio
+import pytest
+from app.backplane import InProcessBackplane, UnixSocketBackplane, UnixSocketBroker, create_backplane
+
+class Inbox:
+    def __init__(self):
+        self.frames = []
+    
+    def __call__(self, room_id, frame, message=None):
+        self.frames.append((room_id, frame))
+
+async def wait_for(predicate, timeout=2.0):
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    while not predicate():
+        assert loop.time() < deadline, "timed out"
+        await asyncio.sleep(0.01)
+
+def test_create_backplane():
+    assert isinstance(create_backplane("memory://"), InProcessBackplane)
+    assert isinstance(create_backplane("unix:///tmp/x.sock"), UnixSocketBackplane)
+    with pytest.raises(ValueError):
+        create_backplane("carrier-pigeon://")
+
+@pytest.mark.asyncio
+async def test_unix_socket_backplane_fans_out_between_workers(tmp_path):
+    path = str(tmp_path / "broker.sock")
+    broker = UnixSocketBroker(path)
+    await broker.start()
+    
+    inbox_a, inbox_b, inbox_c = Inbox(), Inbox(), Inbox()
+    worker_a, worker_b, worker_c = (UnixSocketBackplane(path) for _ in range(3))
+    await worker_a.start(inbox_a)
+    await worker_b.start(inbox_b)
+    await worker_c.start(inbox_c)
+    try:
+        await worker_a.subscribe(1)
+        await worker_b.subscribe(1)
+        await worker_c.subscribe(2)
+        await asyncio.sleep(0.05)
+        
+        await worker_a.publish(1, '{"content":"hi"}')
+        await wait_for(lambda: inbox_b.frames)
+        await asyncio.sleep(0.05)
+        
+        assert inbox_a.frames == [(1, '{"content":"hi"}')]
+        assert inbox_b.frames == [(1, '{"content":"hi"}')]
+        assert inbox_c.frames == []
+        assert worker_b.stats()["received"] == 1
+    finally:
+        for worker in (worker_a, worker_b, worker_c):
+            await worker.stop()
+        await broker.stop()
@@ -0,0 +1,75 @@
+import asyncio
+import pytest
+from app.broadcast import Broadcaster, Connection, COALESCE, DISCONNECT, DROP_OLDEST
+
+@pytest.mark.asyncio
+async def test_slow_client_does_not_delay_others(fake_socket):
+    fast, slow = fake_socket(), fake_socket(delay=10)
+    broadcaster = Broadcaster()
+    connections = [Connection(sock.send, sock.close) for sock in (fast, slow)]
+    for connection in connections:
+        connection.start()
+        broadcaster.join(1, connection)
+    
+    for i in range(3):
+        assert broadcaster.broadcast(1, i) == 2
+    await asyncio.sleep(0.01)
+    
+    assert fast.received == [0, 1, 2]
+    assert slow.received == []
+    for connection in connections:
+        await connection.close()
+
+def test_drop_oldest_policy(fake_socket):
+    connection = Connection(fake_socket().send, maxsize=2, policy=DROP_OLDEST)
+    for i in range(4):
+        assert connection.enqueue(i)
+    
+    assert [frame for _, frame, _ in connection._queue] == [2, 3]
+    assert connection.dropped == 2
+
+def test_coalesce_policy_replaces_frames_with_same_key(fake_socket):
+    connection = Connection(fake_socket().send, maxsize=2, policy=COALESCE)
+    connection.enqueue("typing: a", key="typing")
+    connection.enqueue("hello")
+    connection.enqueue("typing: ab", key="typing")
+    
+    assert [frame for _, frame, _ in connection._queue] == ["typing: ab", "hello"]
+    assert connection.coalesced == 1
+
+@pytest.mark.asyncio
+async def test_disconnect_policy_removes_slow_client(fake_socket):
+    sock = fake_socket()
+    broadcaster = Broadcaster()
+    connection = Connection(sock.send, sock.close, maxsize=1, policy=DISCONNECT)
+    broadcaster.join(1, connection)
+    
+    broadcaster.broadcast(1, "first")
+    assert broadcaster.broadcast(1, "second") == 0
+    await asyncio.sleep(0)
+    
+    assert connection.closed
+    assert sock.closed_with == 1013
+    assert broadcaster.rooms == {}
+    assert broadcaster.stats()["disconnected"] == 1
+
+def test_codec_matches_stdlib_json():
+    import json
+    from app import codec
+    
+    payload = {"id": 1, "user": None, "username": "System", "content": "héllo \"there\""}
+    frame = codec.dumps(payload)
+    
+    assert isinstance(frame, str)
+    assert json.loads(frame) == json.loads(codec.dumps_stdlib(payload)) == payload
+    assert codec.loads(frame) == payload
+
+def test_replay_goes_first_and_drops_covered_live_frames(fake_socket):
+    connection = Connection(fake_socket().send)
+    connection.enqueue("live 5", seq=5)
+    connection.enqueue("live 6", seq=6)
+    connection.enqueue("notice")
+    
+    connection.replay([(4, "replay 4"), (5, "replay 5")])
+    
+    assert [frame for _, frame, _ in connection._queue] == ["replay 4", "replay 5", "live 6", "notice"]
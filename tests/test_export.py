@@ -0,0 +1,60 @@
+import gzip
+import json
+from app import crud
+from app.cli import main as cli_main
+
+def login(client):
+    client.post(
+        "/auth/signup",
+        json={
+            "username": "testuser",
+            "email": "test@example.com",
+            "password": "testpassword123"
+        }
+    )
+    client.post(
+        "/auth/login",
+        json={
+            "username": "testuser",
+            "password": "testpassword123"
+        }
+    )
+
+def test_export_streams_full_history_as_ndjson(client, db_session):
+    login(client)
+    room = crud.create_chatroom(db_session, "Test Room")
+    crud.create_messages(db_session, [
+        {"room_id": room.id, "content": f"Message {i}", "role": "user"} for i in range(2500)
+    ])
+    
+    response = client.get(f"/rooms/{room.id}/export")
+    
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("application/x-ndjson")
+    lines = [json.loads(line) for line in response.text.splitlines()]
+    assert [line["content"] for line in lines] == [f"Message {i}" for i in range(2500)]
+
+def test_export_gzip(client, db_session):
+    login(client)
+    room = crud.create_chatroom(db_session, "Test Room")
+    crud.create_message(db_session, room.id, "Hello")
+    
+    response = client.get(f"/rooms/{room.id}/export", params={"gzip": True})
+    
+    lines = gzip.decompress(response.content).decode().splitlines()
+    assert json.loads(lines[0])["content"] == "Hello"
+
+def test_export_requires_auth(client, db_session):
+    room = crud.create_chatroom(db_session, "Test Room")
+    assert client.get(f"/rooms/{room.id}/export").status_code == 401
+
+def test_export_cli(db_session, tmp_path, monkeypatch):
+    from tests.conftest import TestingSessionLocal
+    monkeypatch.setattr("app.cli.SessionLocal", TestingSessionLocal)
+    room = crud.create_chatroom(db_session, "Test Room")
+    crud.create_message(db_session, room.id, "Hello")
+    out = tmp_path / "export.ndjson.gz"
+    
+    assert cli_main(["export", str(room.id), "-o", str(out), "--gzip", "--batch-size", "10"]) == 0
+    
+    assert json.loads(gzip.decompress(out.read_bytes()))["content"] == "Hello"
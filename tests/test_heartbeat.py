@@ -0,0 +1,90 @@
+import time
+from app import crud
+from app.heartbeat import Heartbeat, WS_1001_GOING_AWAY, is_pong
+
+def test_is_pong():
+    assert is_pong({"type": "pong"})
+    assert is_pong('{"type": "pong"}')
+    assert not is_pong('"pong"')
+    assert not is_pong("ping pong")
+    assert not is_pong({"content": "pong"})
+
+def test_quiet_connections_are_pinged_then_reaped(fake_connection):
+    released = []
+    heartbeat = Heartbeat(interval=10, timeout=30, room_idle=60)
+    heartbeat._release_room = released.append
+    alive, dead = fake_connection(), fake_connection()
+    heartbeat.track(alive, 1)
+    heartbeat.track(dead, 1)
+    start = time.monotonic()
+    
+    heartbeat.sweep(start + 5)
+    assert alive.frames == dead.frames == []
+    
+    heartbeat.sweep(start + 11)
+    assert len(alive.frames) == 1 and alive.frames[0] is dead.frames[0]
+    assert '"ping"' in alive.frames[0]
+    
+    heartbeat.seen(alive, pong=True, now=start + 12)
+    heartbeat.sweep(start + 31)
+    assert dead.closed_with == WS_1001_GOING_AWAY
+    assert alive.closed_with is None
+    assert heartbeat.stats()["reaped"] == 1
+    assert heartbeat.stats()["connections"] == 1
+    
+    heartbeat.untrack(alive)
+    assert heartbeat.stats()["idle_rooms"] == 1
+    heartbeat.sweep(time.monotonic() + 59)
+    assert released == []
+    heartbeat.sweep(time.monotonic() + 61)
+    assert released == [1]
+    assert heartbeat.stats()["rooms_released"] == 1
+
+def test_rejoining_room_cancels_release(fake_connection):
+    released = []
+    heartbeat = Heartbeat(interval=10, timeout=30, room_idle=60)
+    heartbeat._release_room = released.append
+    first, second = fake_connection(), fake_connection()
+    heartbeat.track(first, 1)
+    heartbeat.untrack(first)
+    heartbeat.track(second, 1)
+    
+    heartbeat.sweep(time.monotonic() + 61 - 30)
+    assert released == []
+    assert heartbeat.stats()["connection_age_seconds"]["max"] >= 0
+
+def test_websocket_ping_pong(client, db_session):
+    from app import main
+    from app.auth import create_access_token
+    crud.create_user(db_session, "beat", "beat@example.com", "hashedpw")
+    room = crud.create_chatroom(db_session, "Beat Room")
+    token = create_access_token({"sub": "beat"})
+    
+    with client.websocket_connect(f"/ws/{room.id}?token={token}") as websocket:
+        websocket.receive_json()
+        later = time.monotonic() + main.heartbeat.interval
+        client.portal.call(main.heartbeat.sweep, later)
+        assert websocket.receive_json()["type"] == "ping"
+        websocket.send_json({"type": "pong"})
+        websocket.send_json({"content": "still here"})
+        assert websocket.receive_json()["content"] == "still here"
+        stats = client.get("/metrics").json()["heartbeat"]
+    
+    assert stats["pings"] >= 1 and stats["pongs"] == 1
+    assert stats["connections"] == 1
+    assert [m["content"] for m in client.get(f"/rooms/{room.id}/messages").json()] == ["still here"]
+
+def test_websocket_dead_connection_is_reaped(client, db_session):
+    from app import main
+    from app.auth import create_access_token
+    crud.create_user(db_session, "beat", "beat@example.com", "hashedpw")
+    room = crud.create_chatroom(db_session, "Beat Room")
+    token = create_access_token({"sub": "beat"})
+    
+    with client.websocket_connect(f"/ws/{room.id}?token={token}") as websocket:
+        websocket.receive_json()
+        client.portal.call(main.heartbeat.sweep, time.monotonic() + main.heartbeat.timeout)
+        message = websocket.receive()
+    
+    assert message["type"] == "websocket.close"
+    assert message["code"] == 1001
@@ -0,0 +1,69 @@
+from datetime import datetime, timezone
+from app import crud
+from app.history_cache import ENTRY_OVERHEAD_BYTES, HistoryCache, entry_size
+
+def entry(message_id, room_id=1, content="hello"):
+    return {
+        "id": message_id,
+        "room_id": room_id,
+        "user_id": None,
+        "role": "user",
+        "content": content,
+        "created_at": datetime.now(timezone.utc)
+    }
+
+def ids(page):
+    return [e["id"] for e in page]
+
+def test_serves_windows_above_floor_and_misses_below():
+    cache = HistoryCache(room_size=5)
+    for message_id in range(10, 18):
+        cache.append(1, entry(message_id))
+    
+    assert ids(cache.get(1, 3)) == [17, 16, 15]
+    assert ids(cache.get(1, 2, before_id=15)) == [14, 13]
+    assert ids(cache.get(1, 10, after_id=14)) == [17, 16, 15]
+    assert cache.get(1, 3, before_id=14) is None
+    assert cache.get(1, 3, after_id=11) is None
+    assert cache.get(2, 3) is None
+    assert cache.stats()["hits"] == 3
+    assert cache.stats()["misses"] == 3
+
+def test_seeded_complete_history_answers_short_rooms():
+    cache = HistoryCache()
+    cache.append(1, entry(5))
+    assert cache.get(1, 10) is None
+    
+    cache.seed(1, [], complete=True)
+    assert ids(cache.get(1, 10)) == [5]
+
+def test_entry_size_handles_content_that_is_not_a_string():
+    assert entry_size(entry(1, content="abc")) == ENTRY_OVERHEAD_BYTES + 3
+    assert entry_size(entry(1, content=None)) == ENTRY_OVERHEAD_BYTES
+    assert entry_size(entry(1, content=12345)) == ENTRY_OVERHEAD_BYTES + 5
+    assert entry_size(entry(1, content={"text": "x" * 100})) > ENTRY_OVERHEAD_BYTES + 100
+
+def test_evicts_least_recently_used_rooms_over_memory_cap():
+    cache = HistoryCache(max_bytes=3000)
+    cache.append(1, entry(1, room_id=1, content="x" * 1000))
+    cache.append(2, entry(2, room_id=2, content="x" * 1000))
+    cache.get(1, 1)
+    cache.append(3, entry(3, room_id=3, content="x" * 1000))
+    
+    assert cache.get(2, 1) is None
+    assert cache.get(1, 1) is not None
+    assert cache.stats()["evictions"] == 1
+    assert cache.stats()["bytes"] <= 3000
+
+def test_room_history_api_includes_unflushed_messages(client, db_session):
+    from app.main import history
+    room = crud.create_chatroom(db_session, "Test Room")
+    persisted = crud.create_message(db_session, room.id, "persisted")
+    history.append(room.id, entry(persisted.id + 1, room_id=room.id, content="not flushed yet"))
+    
+    first = client.get(f"/rooms/{room.id}/messages").json()
+    second = client.get(f"/rooms/{room.id}/messages").json()
+    
+    assert [m["content"] for m in first] == ["persisted", "not flushed yet"]
+    assert second == first
+    assert history.stats()["hits"] >= 1
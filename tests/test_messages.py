@@ -1,3 +1,4 @@
+import asyncio
 import pytest
 from app import crud, models
 
@@ -53,3 +54,109 @@ def test_get_room_messages_api(client):
     assert response.status_code == 200
     messages = response.json()
     assert isinstance(messages, list)
+
+@pytest.mark.asyncio
+async def test_async_create_and_get_messages(db_session):
+    from tests.conftest import TestingAsyncSessionLocal
+    
+    user = crud.create_user(db_session, "testuser", "test@example.com", "hashedpw")
+    room = crud.create_chatroom(db_session, "Test Room")
+    
+    async with TestingAsyncSessionLocal() as session:
+        message = await crud.acreate_message(session, room.id, "Hello, async!", user.id, "user")
+        messages = await crud.aget_messages(session, room.id, limit=10)
+    
+    assert message.id is not None
+    assert [m.content for m in messages] == ["Hello, async!"]
+
+@pytest.mark.asyncio
+async def test_message_writer_batches_and_flushes_on_stop(db_session):
+    from tests.conftest import TestingAsyncSessionLocal
+    from app.persistence import MessageWriter
+    
+    room = crud.create_chatroom(db_session, "Test Room")
+    writer = MessageWriter(TestingAsyncSessionLocal, batch_size=100, flush_interval=60)
+    await writer.start()
+    
+    sent = [await writer.submit(room.id, f"Message {i}", None, "user") for i in range(5)]
+    assert [m.id for m in sent] == sorted({m.id for m in sent})
+    assert writer.queue_depth() == 5
+    
+    await writer.stop()
+    
+    assert writer.stats()["batches"] == 1
+    assert writer.queue_depth() == 0
+    assert len(crud.get_messages(db_session, room.id, limit=10)) == 5
+
+@pytest.mark.asyncio
+async def test_message_writer_dead_letters_bad_rows(db_session):
+    from tests.conftest import TestingAsyncSessionLocal
+    from app.persistence import MessageWriter
+    
+    room = crud.create_chatroom(db_session, "Test Room")
+    writer = MessageWriter(TestingAsyncSessionLocal, batch_size=100, flush_interval=60)
+    await writer.start()
+    
+    await writer.submit(room.id, "before", None, "user")
+    bad = await writer.submit(room.id, None, None, "user")
+    await writer.submit(room.id, "after", None, "user")
+    await writer.stop()
+    
+    assert [m.content for m in crud.get_messages(db_session, room.id, limit=10)] == ["after", "before"]
+    assert writer.stats()["flushed"] == 2 and writer.stats()["dead_lettered"] == 1
+    assert [row["id"] for row in writer.dead_letters] == [bad.id]
+
+@pytest.mark.asyncio
+async def test_message_writer_retries_transient_errors_with_a_cap(db_session):
+    from sqlalchemy.exc import OperationalError
+    from tests.conftest import TestingAsyncSessionLocal
+    from app.persistence import MessageWriter
+    
+    room = crud.create_chatroom(db_session, "Test Room")
+    outages = [2]
+    
+    def flaky_session():
+        # The first session hands out ids; inserts fail while the outage lasts.
+        if writer.submitted and outages[0] > 0:
+            outages[0] -= 1
+            raise OperationalError("INSERT", {}, Exception("database is down"))
+        return TestingAsyncSessionLocal()
+    
+    writer = MessageWriter(flaky_session, batch_size=100, flush_interval=0.01, retries=3, retry_delay=0.001)
+    await writer.start()
+    await writer.submit(room.id, "survives the outage", None, "user")
+    await asyncio.sleep(0.1)
+    assert writer.stats()["flushed"] == 1 and writer.stats()["failures"] == 2
+    
+    outages[0] = 10
+    await writer.submit(room.id, "outlasts the retries", None, "user")
+    await writer.stop()
+    
+    assert writer.stats()["dead_lettered"] == 1
+    assert [m.content for m in crud.get_messages(db_session, room.id, limit=10)] == ["survives the outage"]
+
+def test_get_messages_keyset_pagination(db_session):
+    room = crud.create_chatroom(db_session, "Test Room")
+    other = crud.create_chatroom(db_session, "Other Room")
+    ids = [crud.create_message(db_session, room.id, f"Message {i}").id for i in range(7)]
+    crud.create_message(db_session, other.id, "Elsewhere")
+    
+    newest = crud.get_messages(db_session, room.id, limit=3)
+    older = crud.get_messages(db_session, room.id, limit=3, before_id=newest[-1].id)
+    oldest = crud.get_messages(db_session, room.id, limit=3, before_id=older[-1].id)
+    newer = crud.get_messages(db_session, room.id, limit=2, after_id=ids[1])
+    
+    assert [m.id for m in newest] == ids[6:3:-1]
+    assert [m.id for m in older] == ids[3:0:-1]
+    assert [m.id for m in oldest] == ids[:1]
+    assert [m.id for m in newer] == [ids[3], ids[2]]
+
+def test_get_room_messages_api_pages_with_before_id(client, db_session):
+    room = crud.create_chatroom(db_session, "Test Room")
+    ids = [crud.create_message(db_session, room.id, f"Message {i}").id for i in range(5)]
+    
+    page = client.get(f"/rooms/{room.id}/messages", params={"limit": 2}).json()
+    previous = client.get(f"/rooms/{room.id}/messages", params={"limit": 2, "before_id": page[0]["id"]}).json()
+    
+    assert [m["id"] for m in page] == ids[3:]
+    assert [m["id"] for m in previous] == ids[1:3]
@@ -0,0 +1,168 @@
+import asyncio
+import json
+import pytest
+from app import crud
+from app.presence import Presence, net_changes
+
+async def started(connections=None, publish=None, worker_id="w1"):
+    presence = Presence(flush_interval=0.01)
+    await presence.start(lambda room_id: (connections or {}).get(room_id, ()), publish, worker_id)
+    return presence
+
+def test_net_changes_cancel_out_reconnects():
+    changes = [(1, 1, "ann"), (2, 1, None), (3, 2, None), (4, 2, "bob"), (5, 3, "cy"), (6, 4, None)]
+    
+    assert net_changes(changes) == {3: "cy", 4: None}
+
+@pytest.mark.asyncio
+async def test_membership_is_reference_counted():
+    presence = await started()
+    presence.join(1, 10, "ann")
+    presence.join(1, 10, "ann")
+    presence.join(1, 11, "bob")
+    presence.join(2, 10, "ann")
+    
+    assert presence.count(1) == 2
+    presence.leave(1, 10)
+    assert presence.count(1) == 2
+    presence.leave(1, 10)
+    assert presence.members(1) == [{"user_id": 11, "username": "bob"}]
+    presence.leave(1, 99)
+    assert presence.count(2) == 1
+
+@pytest.mark.asyncio
+async def test_deltas_are_coalesced(fake_connection):
+    old, new = fake_connection(), fake_connection()
+    room = {1: [old]}
+    presence = await started(room)
+    presence.join(1, 10, "ann", old)
+    await asyncio.sleep(0.03)
+    old.frames.clear()
+    
+    # bob reconnects, cy joins, and a new socket arrives after cy.
+    presence.join(1, 11, "bob")
+    presence.leave(1, 11)
+    presence.join(1, 11, "bob")
+    presence.join(1, 12, "cy")
+    room[1].append(new)
+    presence.join(1, 13, "dee", new)
+    presence.leave(1, 12)
+    await asyncio.sleep(0.03)
+    
+    assert len(old.frames) == 1
+    delta = old.decoded()[0]
+    assert delta["type"] == "presence_delta"
+    assert [m["username"] for m in delta["joined"]] == ["bob", "dee"]
+    assert delta["left"] == [] and delta["count"] == 3
+    # The new socket's snapshot already had bob; it only hears that cy left.
+    assert new.decoded() == [{"type": "presence_delta", "room_id": 1, "count": 3, "joined": [], "left": [12]}]
+    assert presence.stats()["coalesced"] > 0
+
+@pytest.mark.asyncio
+async def test_slow_coalescing_socket_gets_one_current_snapshot():
+    from app.broadcast import COALESCE, Connection
+    from app.presence import PRESENCE_KEY
+    
+    async def never_sent(frame):
+        pass
+    
+    slow = Connection(never_sent, policy=COALESCE)
+    presence = await started({1: [slow]})
+    presence.join(1, 10, "ann", slow)
+    slow.enqueue(json.dumps(presence.snapshot(1)), PRESENCE_KEY)
+    slow.enqueue("chat message")
+    for user_id, username in ((11, "bob"), (12, "cy")):
+        presence.join(1, user_id, username)
+        await asyncio.sleep(0.03)
+    
+    frames = [frame for _, frame, _ in slow._queue]
+    assert frames[1] == "chat message" and len(frames) == 2
+    assert json.loads(frames[0]) == presence.snapshot(1)
+    assert presence.snapshot(1)["count"] == 3
+
+@pytest.mark.asyncio
+async def test_presence_is_shared_between_workers():
+    workers = {}
+    
+    def publisher(name):
+        async def publish(room_id, frame):
+            for other, presence in workers.items():
+                if other != name:
+                    presence.receive(room_id, frame)
+        return publish
+    
+    for name in ("a", "b"):
+        workers[name] = await started(publish=publisher(name), worker_id=name)
+    a, b = workers["a"], workers["b"]
+    
+    a.join(1, 10, "ann")
+    await asyncio.sleep(0.03)
+    assert b.members(1) == [{"user_id": 10, "username": "ann"}]
+    
+    # A worker that starts serving the room later asks for snapshots.
+    workers["c"] = c = await started(publish=publisher("c"), worker_id="c")
+    c.request_snapshot(1)
+    await asyncio.sleep(0.01)
+    assert c.count(1) == 1
+    
+    b.join(1, 10, "ann")
+    a.leave(1, 10)
+    await asyncio.sleep(0.03)
+    assert c.count(1) == 1
+    
+    await b.stop()
+    await asyncio.sleep(0.01)
+    assert c.count(1) == 0
+    assert a.count(1) == 0
+
+@pytest.mark.asyncio
+async def test_lookup_asks_serving_workers_without_joining_the_room():
+    workers = {}
+    
+    def publisher(name):
+        async def publish(room_id, frame):
+            for other, presence in workers.items():
+                if other != name:
+                    presence.receive(room_id, frame)
+        return publish
+    
+    for name in ("a", "b"):
+        workers[name] = await started(publish=publisher(name), worker_id=name)
+    a, b = workers["a"], workers["b"]
+    a.join(1, 10, "ann")
+    b.join(1, 11, "bob")
+    b.join(1, 10, "ann")
+    await asyncio.sleep(0.03)
+    # c does not serve the room, so it only sees the lookup traffic.
+    workers["c"] = c = await started(publish=publisher("c"), worker_id="c")
+    
+    first, second = await asyncio.gather(c.lookup(1, wait=0.02), c.lookup(1, wait=0.01))
+    
+    for snapshot in (first, second):
+        assert snapshot["count"] == 2
+        assert sorted(m["user_id"] for m in snapshot["members"]) == [10, 11]
+    assert c.stats()["rooms"] == 0 and c._lookups == {}
+    assert a.count(1) == b.count(1) == 2
+
+def test_websocket_presence(client, db_session, monkeypatch):
+    from app import main
+    from app.auth import create_access_token
+    monkeypatch.setattr(main.presence, "flush_interval", 0.01)
+    ann = crud.create_user(db_session, "ann", "ann@example.com", "hashedpw")
+    crud.create_user(db_session, "bob", "bob@example.com", "hashedpw")
+    room = crud.create_chatroom(db_session, "Presence Room")
+    
+    with client.websocket_connect(f"/ws/{room.id}?token={create_access_token({'sub': 'ann'})}") as first:
+        assert first.receive_json()["count"] == 1
+        with client.websocket_connect(f"/ws/{room.id}?token={create_access_token({'sub': 'bob'})}") as second:
+            assert second.receive_json()["count"] == 2
+            delta = first.receive_json()
+            assert delta["type"] == "presence_delta"
+            assert [m["username"] for m in delta["joined"]] == ["bob"]
+            members = client.get(f"/rooms/{room.id}/members").json()
+            assert members["count"] == 2
+        assert first.receive_json()["left"] == [members["members"][1]["user_id"]]
+        assert client.get(f"/rooms/{room.id}/members").json()["members"] == [{"user_id": ann.id, "username": "ann"}]
+    
+    assert client.get(f"/rooms/{room.id}/members").json() == {"room_id": room.id, "count": 0, "members": []}
+    assert client.get(f"/rooms/{room.id}/messages").json() == []
@@ -0,0 +1,97 @@
+import json
+from app import crud
+from app.auth import get_password_hash, pwd_context
+from app.cli import main as cli_main
+from app.provisioning import UserProvisioner, parse_records
+
+def provisioner(**kwargs):
+    return UserProvisioner(workers=2, rounds=4, **kwargs)
+
+def test_provision_creates_users_in_batches(db_session):
+    records = parse_records("\n".join(
+        json.dumps({"username": f"user{i}", "email": f"user{i}@example.com", "password": "secret"})
+        for i in range(25)
+    ), "ndjson")
+    
+    report = provisioner(batch_size=10).provision(db_session, records)
+    
+    assert report == {"created": 25, "errors": []}
+    user = crud.get_user_by_username(db_session, "user24")
+    assert pwd_context.verify("secret", user.hashed_password)
+
+def test_provision_reports_per_row_errors(db_session):
+    crud.create_user(db_session, "taken", "taken@example.com", get_password_hash("x", rounds=4))
+    data = (
+        "username,email,password\n"
+        "alice,alice@example.com,secret\n"
+        "taken,new@example.com,secret\n"
+        "bob,taken@example.com,secret\n"
+        "alice,other@example.com,secret\n"
+        "carol,not-an-email,secret\n"
+        "dave,dave@example.com,secret\n"
+    )
+    
+    report = provisioner().provision(db_session, parse_records(data, "csv"))
+    
+    assert report["created"] == 2
+    errors = {e["row"]: e["error"] for e in report["errors"]}
+    assert sorted(errors) == [2, 3, 4, 5]
+    assert errors[2] == "Username already registered"
+    assert errors[3] == "Email already registered"
+    assert errors[4] == "Duplicate username in input"
+    assert errors[5].startswith("email:")
+    assert crud.get_user_by_username(db_session, "dave") is not None
+
+def test_provision_malformed_ndjson(db_session):
+    report = provisioner().provision(db_session, parse_records('{"username": "a"\n[1]\n', "ndjson"))
+    
+    assert [e["error"] for e in report["errors"]] == ["Malformed record", "Malformed record"]
+
+def test_bulk_endpoint(client, db_session, monkeypatch):
+    monkeypatch.setattr("app.main.user_provisioner", provisioner())
+    monkeypatch.setattr("app.main.OPERATOR_USERNAMES", {"admin"})
+    client.post("/auth/signup", json={"username": "admin", "email": "admin@example.com", "password": "testpassword123"})
+    client.post("/auth/login", json={"username": "admin", "password": "testpassword123"})
+    
+    response = client.post(
+        "/users/bulk",
+        content="username,email,password\nnew,new@example.com,secret\nadmin,x@example.com,secret\n",
+        headers={"Content-Type": "text/csv"}
+    )
+    
+    assert response.status_code == 200
+    assert response.json()["created"] == 1
+    assert response.json()["errors"][0]["error"] == "Username already registered"
+    assert client.post("/auth/login", json={"username": "new", "password": "secret"}).status_code == 200
+
+def test_bulk_endpoint_requires_auth(client):
+    assert client.post("/users/bulk", content="").status_code == 401
+
+def test_bulk_endpoint_is_for_operators_one_import_at_a_time(client, db_session, monkeypatch):
+    busy = provisioner()
+    monkeypatch.setattr("app.main.user_provisioner", busy)
+    monkeypatch.setattr("app.main.OPERATOR_USERNAMES", {"admin"})
+    for username in ("admin", "someone"):
+        client.post("/auth/signup", json={"username": username, "email": f"{username}@example.com", "password": "testpassword123"})
+    
+    client.post("/auth/login", json={"username": "someone", "password": "testpassword123"})
+    assert client.post("/users/bulk", content="").status_code == 403
+    
+    client.post("/auth/login", json={"username": "admin", "password": "testpassword123"})
+    busy.in_progress = 1
+    response = client.post("/users/bulk", content="")
+    assert response.status_code == 429
+    assert response.headers["Retry-After"] == "5"
+    busy.in_progress = 0
+    assert client.post("/users/bulk", content="").json() == {"created": 0, "errors": []}
+    assert busy.stats() == {"in_progress": 0, "completed": 1, "rejected": 1}
+
+def test_provision_cli(db_session, tmp_path, monkeypatch, capsys):
+    from tests.conftest import TestingSessionLocal
+    monkeypatch.setattr("app.cli.SessionLocal", TestingSessionLocal)
+    path = tmp_path / "users.ndjson"
+    path.write_text(json.dumps({"username": "u", "email": "u@example.com", "password": "p"}) + "\n")
+    
+    assert cli_main(["provision", str(path), "--rounds", "4", "--workers", "1"]) == 0
+    
+    assert json.loads(capsys.readouterr().out) == {"created": 1, "errors": []}
@@ -0,0 +1,103 @@
+import time
+import pytest
+from app import crud
+from app.ratelimit import ALLOW, DISCONNECT, DROP, THROTTLE, RateLimiter, TokenBucket
+
+def test_bucket_allows_burst_then_refills():
+    bucket = TokenBucket(rate=10, burst=2, now=0)
+    
+    for _ in range(2):
+        assert bucket.wait(0) == 0
+        bucket.take()
+    assert bucket.wait(0) == pytest.approx(0.1)
+    assert bucket.wait(0.1) == 0
+    assert bucket.full(10)
+
+def test_check_takes_from_every_bucket_or_none():
+    limiter = RateLimiter(DROP, connection_rate=100, connection_burst=5, user_rate=0.01, user_burst=2)
+    first, second = limiter.connection_bucket(), limiter.connection_bucket()
+    
+    assert limiter.check("alice", 1, first) == (0, None)
+    assert limiter.check("alice", 2, second) == (0, None)
+    # Two connections share alice's bucket; the third message is refused
+    # without taking the connection's token.
+    wait, scope = limiter.check("alice", 1, first)
+    assert scope == "user" and wait > 0
+    assert first.tokens == pytest.approx(4, abs=0.1)
+    assert limiter.check("bob", 1, first)[1] is None
+
+def test_room_limit_applies_across_users():
+    limiter = RateLimiter(DROP, room_rate=0.01, room_burst=3)
+    
+    verdicts = [limiter.check(f"user{i}", "busy", limiter.connection_bucket())[1] for i in range(4)]
+    
+    assert verdicts == [None, None, None, "room"]
+    assert limiter.check("user9", "quiet", limiter.connection_bucket())[1] is None
+
+@pytest.mark.asyncio
+async def test_policies():
+    for policy, expected in ((DROP, DROP), (DISCONNECT, DISCONNECT)):
+        limiter = RateLimiter(policy, connection_rate=1, connection_burst=1)
+        bucket = limiter.connection_bucket()
+        assert (await limiter.acquire("u", 1, bucket))[0] == ALLOW
+        verdict, retry_after = await limiter.acquire("u", 1, bucket)
+        assert verdict == expected and retry_after > 0
+        assert limiter.stats()["limited"]["connection"] == 1
+    
+    limiter = RateLimiter(THROTTLE, connection_rate=50, connection_burst=1)
+    bucket = limiter.connection_bucket()
+    start = time.monotonic()
+    verdicts = [(await limiter.acquire("u", 1, bucket))[0] for _ in range(3)]
+    
+    assert verdicts == [ALLOW] * 3
+    assert time.monotonic() - start >= 0.035
+    assert limiter.stats()["throttled"] == 2
+
+def test_full_buckets_are_pruned(monkeypatch):
+    monkeypatch.setattr("app.ratelimit.PRUNE_INTERVAL", 3)
+    limiter = RateLimiter(DROP, user_rate=1e6, room_rate=1e6)
+    bucket = limiter.connection_bucket()
+    limiter.check("a", 1, bucket)
+    limiter.check("b", 2, bucket)
+    time.sleep(0.001)
+    limiter.check("c", 3, bucket)
+    
+    assert limiter.stats()["users"] == 1
+    assert limiter.stats()["rooms"] == 1
+
+def test_flooding_socket_gets_notices(client, db_session, monkeypatch):
+    from app import main
+    from app.auth import create_access_token
+    monkeypatch.setattr(main, "rate_limiter", RateLimiter(DROP, connection_rate=0.01, connection_burst=2))
+    crud.create_user(db_session, "flood", "flood@example.com", "hashedpw")
+    room = crud.create_chatroom(db_session, "Flood Room")
+    token = create_access_token({"sub": "flood"})
+    
+    with client.websocket_connect(f"/ws/{room.id}?token={token}") as websocket:
+        websocket.receive_json()
+        for i in range(3):
+            websocket.send_json({"content": f"spam {i}"})
+        frames = [websocket.receive_json() for _ in range(3)]
+    
+    assert [f.get("content") for f in frames[:2]] == ["spam 0", "spam 1"]
+    assert frames[2]["type"] == "rate_limited"
+    assert client.get("/metrics").json()["rate_limit"]["dropped"] == 1
+
+def test_flooding_socket_is_disconnected(client, db_session, monkeypatch):
+    from app import main
+    from app.auth import create_access_token
+    monkeypatch.setattr(main, "rate_limiter", RateLimiter(DISCONNECT, connection_rate=0.01, connection_burst=1))
+    crud.create_user(db_session, "flood", "flood@example.com", "hashedpw")
+    room = crud.create_chatroom(db_session, "Flood Room")
+    token = create_access_token({"sub": "flood"})
+    
+    with client.websocket_connect(f"/ws/{room.id}?token={token}") as websocket:
+        websocket.receive_json()
+        websocket.send_json({"content": "one"})
+        websocket.send_json({"content": "two"})
+        assert websocket.receive_json()["content"] == "one"
+        with pytest.raises(Exception):
+            while True:
+                websocket.receive_json()
+    
+    assert client.get("/metrics").json()["rate_limit"]["disconnected"] == 1
@@ -0,0 +1,102 @@
+import asyncio
+import pytest
+from starlette.websockets import WebSocketDisconnect
+from app import crud
+from app.broadcast import Connection, ConnectionRegistry, KICK, MUTE
+
+@pytest.fixture
+def connect(fake_socket):
+    def connect(registry, room_id, user_id):
+        sock = fake_socket()
+        connection = Connection(sock.send, sock.close)
+        registry.join(room_id, connection, user_id)
+        return connection
+    return connect
+
+def frames(connection):
+    return [frame for _, frame, _ in connection._queue]
+
+def test_users_can_have_several_connections(connect):
+    registry = ConnectionRegistry()
+    phone, laptop = connect(registry, 1, "ann"), connect(registry, 1, "ann")
+    elsewhere = connect(registry, 2, "ann")
+    bob = connect(registry, 1, "bob")
+
+    assert registry.send_to_user("ann", "all devices") == 3
+    assert registry.send_to_user("ann", "room 1", room_id=1) == 2
+    assert registry.send_to_connection(laptop.id, "laptop")
+    assert registry.broadcast(1, "not to phone", exclude=phone) == 2
+
+    assert frames(phone) == ["all devices", "room 1"]
+    assert frames(laptop) == ["all devices", "room 1", "laptop", "not to phone"]
+    assert frames(elsewhere) == ["all devices"]
+    assert frames(bob) == ["not to phone"]
+
+    registry.leave(1, phone)
+    registry.remove(elsewhere)
+    assert registry.user_connections("ann") == [laptop]
+    assert registry.get(phone.id) is None
+    registry.remove(laptop)
+    registry.remove(bob)
+    assert registry.users == {} and registry.connections == {} and registry.rooms == {}
+
+@pytest.mark.asyncio
+async def test_kick_closes_only_the_users_connections_in_the_room(connect):
+    registry = ConnectionRegistry()
+    ann, ann_elsewhere = connect(registry, 1, "ann"), connect(registry, 2, "ann")
+    bob = connect(registry, 1, "bob")
+
+    assert registry.kick("ann", 1) == 1
+    await asyncio.sleep(0)
+
+    assert ann.closed and not ann_elsewhere.closed
+    assert registry.rooms[1] == {bob}
+    assert registry.user_connections("ann") == [ann_elsewhere]
+    assert registry.kick("nobody") == 0
+    assert registry.stats()["kicked"] == 1
+
+def test_mutes_apply_per_room_or_everywhere(connect):
+    registry = ConnectionRegistry()
+    ann = connect(registry, 1, "ann")
+
+    registry.receive(1, registry.moderation(MUTE, "ann"))
+    assert registry.is_muted("ann", 1) and not registry.is_muted("ann", 2)
+    assert frames(ann) == ['{"type":"muted","room_id":1,"muted":true}']
+
+    registry.mute("bob")
+    assert registry.is_muted("bob", 1) and registry.is_muted("bob", 2)
+    registry.unmute("bob")
+    assert not registry.is_muted("bob", 2)
+
+    with pytest.raises(ValueError):
+        registry.moderation("ban", "ann")
+    assert registry.is_moderation(registry.moderation(KICK, "ann"))
+
+def test_moderators_mute_and_kick_over_websocket(client, db_session, monkeypatch):
+    from app import main
+    from app.auth import create_access_token
+    monkeypatch.setattr(main, "MODERATOR_USERNAMES", {"ann"})
+    crud.create_user(db_session, "ann", "ann@example.com", "hashedpw")
+    bob = crud.create_user(db_session, "bob", "bob@example.com", "hashedpw")
+    room = crud.create_chatroom(db_session, "Moderated Room")
+
+    client.cookies.set("access_token", create_access_token({"sub": "bob"}))
+    assert client.post(f"/rooms/{room.id}/members/{bob.id}/mute").status_code == 403
+    client.cookies.set("access_token", create_access_token({"sub": "ann"}))
+
+    with client.websocket_connect(f"/ws/{room.id}?token={create_access_token({'sub': 'bob'})}") as ws:
+        assert ws.receive_json()["type"] == "presence"
+        assert client.post(f"/rooms/{room.id}/members/{bob.id}/mute").status_code == 200
+        assert ws.receive_json() == {"type": "muted", "room_id": room.id, "muted": True}
+
+        ws.send_json({"content": "can anyone hear me"})
+        assert ws.receive_json() == {"type": "muted", "room_id": room.id, "muted": True}
+
+        assert client.post(f"/rooms/{room.id}/members/{bob.id}/kick").status_code == 200
+        with pytest.raises(WebSocketDisconnect) as closed:
+            ws.receive_json()
+        assert closed.value.code == 1008
+
+    assert client.get(f"/rooms/{room.id}/messages").json() == []
+    assert client.delete(f"/rooms/{room.id}/members/{bob.id}/mute").status_code == 200
+    assert not main.broadcaster.is_muted(bob.id, room.id)
@@ -0,0 +1,84 @@
+from functools import partial
+from datetime import datetime, timedelta, timezone
+from app import crud, search
+from app.cli import main as cli_main
+from app.retention import archive_expired, read_archived
+
+NOW = datetime(2026, 10, 18, 12, 0, tzinfo=timezone.utc)
+
+def seed(db_session, room, days_ago, count, start=0):
+    crud.create_messages(db_session, [
+        {
+            "room_id": room.id,
+            "content": f"Message {start + i}",
+            "role": "user",
+            "created_at": NOW - timedelta(days=days_ago, minutes=count - i)
+        }
+        for i in range(count)
+    ])
+
+def test_archive_moves_expired_messages_to_compressed_files(db_session, tmp_path):
+    room = crud.create_chatroom(db_session, "Short", retention_days=30)
+    keep = crud.create_chatroom(db_session, "Forever")
+    seed(db_session, room, 90, 3)
+    seed(db_session, room, 1, 2, start=3)
+    seed(db_session, keep, 90, 2)
+    
+    result = archive_expired(db_session, str(tmp_path), now=NOW)
+    
+    assert result["archived"] == {room.id: 3}
+    assert [m.content for m in crud.get_messages(db_session, room.id)] == ["Message 4", "Message 3"]
+    assert len(crud.get_messages(db_session, keep.id)) == 2
+    assert (tmp_path / f"room-{room.id}" / "2026-07.ndjson.gz").exists()
+    archived = read_archived(room.id, 10, archive_dir=str(tmp_path))
+    assert [m["content"] for m in archived] == ["Message 2", "Message 1", "Message 0"]
+    # Deleted rows are gone from the full-text index as well.
+    results, _ = search.search_messages(db_session, "Message", room.id)
+    assert len(results) == 2
+
+def test_archive_appends_across_runs(db_session, tmp_path):
+    room = crud.create_chatroom(db_session, "Short", retention_days=30)
+    seed(db_session, room, 60, 2)
+    archive_expired(db_session, str(tmp_path), now=NOW)
+    seed(db_session, room, 50, 2, start=2)
+    archive_expired(db_session, str(tmp_path), now=NOW)
+    
+    archived = read_archived(room.id, 10, archive_dir=str(tmp_path))
+    assert [m["content"] for m in archived] == ["Message 3", "Message 2", "Message 1", "Message 0"]
+    assert [m["content"] for m in read_archived(room.id, 2, before_id=archived[1]["id"], archive_dir=str(tmp_path))] == [
+        "Message 1", "Message 0"
+    ]
+
+def test_history_pages_into_archive_on_demand(client, db_session, tmp_path, monkeypatch):
+    monkeypatch.setattr("app.main.read_archived", partial(read_archived, archive_dir=str(tmp_path)))
+    room = crud.create_chatroom(db_session, "Short", retention_days=30)
+    seed(db_session, room, 90, 3)
+    seed(db_session, room, 1, 2, start=3)
+    archive_expired(db_session, str(tmp_path), now=NOW)
+    
+    response = client.get(f"/rooms/{room.id}/messages", params={"limit": 4})
+    assert [m["content"] for m in response.json()] == ["Message 3", "Message 4"]
+    
+    response = client.get(f"/rooms/{room.id}/messages", params={"limit": 4, "include_archived": True})
+    assert [m["content"] for m in response.json()] == ["Message 1", "Message 2", "Message 3", "Message 4"]
+
+def test_set_room_retention(client, db_session):
+    client.post("/auth/signup", json={"username": "testuser", "email": "test@example.com", "password": "testpassword123"})
+    client.post("/auth/login", json={"username": "testuser", "password": "testpassword123"})
+    room = client.post("/rooms", json={"name": "Room", "retention_days": 7}).json()
+    assert room["retention_days"] == 7
+    
+    response = client.put(f"/rooms/{room['id']}/retention", json={"retention_days": None})
+    
+    assert response.status_code == 200
+    assert response.json()["retention_days"] is None
+
+def test_archive_cli(db_session, tmp_path, monkeypatch, capsys):
+    from tests.conftest import TestingSessionLocal
+    monkeypatch.setattr("app.cli.SessionLocal", TestingSessionLocal)
+    room = crud.create_chatroom(db_session, "Short", retention_days=1)
+    seed(db_session, room, 10, 1)
+    
+    assert cli_main(["archive", "--archive-dir", str(tmp_path)]) == 0
+    
+    assert list((tmp_path / f"room-{room.id}").iterdir())
@@ -0,0 +1,46 @@
+from app import crud
+
+def test_search_ranks_and_filters_by_room(db_session):
+    room = crud.create_chatroom(db_session, "Test Room")
+    other = crud.create_chatroom(db_session, "Other Room")
+    crud.create_message(db_session, room.id, "pizza pizza pizza tonight")
+    crud.create_message(db_session, room.id, "anyone want pizza")
+    crud.create_message(db_session, room.id, "nothing to see here")
+    crud.create_messages(db_session, [{"room_id": other.id, "content": "pizza elsewhere", "role": "user"}])
+    
+    results, next_cursor = crud.search_messages(db_session, "pizza", room.id)
+    everywhere, _ = crud.search_messages(db_session, "pizza")
+    
+    assert [m.content for m, _ in results] == ["pizza pizza pizza tonight", "anyone want pizza"]
+    assert results[0][1] > results[1][1]
+    assert next_cursor is None
+    assert len(everywhere) == 3
+
+def test_search_keyset_pagination(db_session):
+    room = crud.create_chatroom(db_session, "Test Room")
+    for i in range(5):
+        crud.create_message(db_session, room.id, f"hello number {i}")
+    
+    seen = []
+    cursor = None
+    while True:
+        page, cursor = crud.search_messages(db_session, "hello", room.id, limit=2, cursor=cursor)
+        seen.extend(m.id for m, _ in page)
+        if cursor is None:
+            break
+    
+    assert len(seen) == 5
+    assert len(set(seen)) == 5
+
+def test_search_api(client, db_session):
+    room = crud.create_chatroom(db_session, "Test Room")
+    crud.create_message(db_session, room.id, "find me \"please\" OR NOT")
+    
+    response = client.get(f"/rooms/{room.id}/search", params={"q": "please OR"})
+    assert response.status_code == 200
+    data = response.json()
+    assert [r["content"] for r in data["results"]] == ["find me \"please\" OR NOT"]
+    assert data["next_cursor"] is None
+    
+    assert client.get(f"/rooms/{room.id}/search", params={"q": "x", "cursor": "bogus"}).status_code == 400
+    assert client.get("/search", params={"q": "please"}).status_code == 401
@@ -22,4 +22,56 @@ def test_websocket_handshake_with_auth(client, db_session):
     
     with client.websocket_connect(f"/ws/{room.id}?token={token}") as websocket:
         data = websocket.receive_json()
-        assert "joined the room" in data["content"]
+        assert data["type"] == "presence"
+        assert data["members"] == [{"user_id": user.id, "username": "wsuser"}]
+
+def test_websocket_resume_replays_missed_messages(client, db_session):
+    crud.create_user(db_session, "wsuser", "ws@example.com", "hashedpw")
+    room = crud.create_chatroom(db_session, "WS Test Room")
+    seen = crud.create_message(db_session, room.id, "seen")
+    crud.create_message(db_session, room.id, "missed 1")
+    crud.create_message(db_session, room.id, "missed 2")
+    
+    from app.auth import create_access_token
+    token = create_access_token({"sub": "wsuser"})
+    
+    with client.websocket_connect(f"/ws/{room.id}?token={token}&last_seen_id={seen.id}") as websocket:
+        replayed = [websocket.receive_json()["content"] for _ in range(2)]
+        live = websocket.receive_json()
+    
+    assert replayed == ["missed 1", "missed 2"]
+    assert live["type"] == "presence"
+
+def test_websocket_resume_too_far_behind_asks_for_resync(client, db_session, monkeypatch):
+    from app import main
+    monkeypatch.setattr(main, "RESUME_MAX_MESSAGES", 2)
+    crud.create_user(db_session, "wsuser", "ws@example.com", "hashedpw")
+    room = crud.create_chatroom(db_session, "WS Test Room")
+    for i in range(3):
+        crud.create_message(db_session, room.id, f"missed {i}")
+    
+    from app.auth import create_access_token
+    token = create_access_token({"sub": "wsuser"})
+    
+    with client.websocket_connect(f"/ws/{room.id}?token={token}&last_seen_id=0") as websocket:
+        assert websocket.receive_json() == {"type": "resync", "reason": "too_far_behind"}
+        assert websocket.receive_json()["type"] == "presence"
+
+def test_websocket_failed_setup_leaves_no_ghost_connection(client, db_session, monkeypatch):
+    from app import main
+    async def broken(db, room_id, last_seen_id):
+        raise RuntimeError("database went away")
+    monkeypatch.setattr(main, "missed_messages", broken)
+    user = crud.create_user(db_session, "wsuser", "ws@example.com", "hashedpw")
+    room = crud.create_chatroom(db_session, "WS Test Room")
+    
+    from app.auth import create_access_token
+    token = create_access_token({"sub": "wsuser"})
+    
+    with pytest.raises(Exception):
+        with client.websocket_connect(f"/ws/{room.id}?token={token}&last_seen_id=0") as websocket:
+            websocket.receive_json()
+    
+    assert room.id not in main.broadcaster.rooms
+    assert main.broadcaster.user_connections(user.id) == []
+    assert main.presence.lookup(room.id) == []
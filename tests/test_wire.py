@@ -0,0 +1,110 @@
+import zlib
+import msgpack
+import pytest
+from app import codec, crud
+from app.wire import FLAG_DEFLATE, FLAG_MSGPACK, MSGPACK, Wire, WireRegistry, epoch_ms
+
+FRAME = codec.dumps({
+    "id": 7, "user_id": 1, "username": "alice", "content": "hello",
+    "role": "user", "created_at": "2024-05-01 12:00:00"
+})
+
+def test_json_is_sent_unchanged():
+    wire = Wire()
+    
+    assert wire.encode(FRAME) is FRAME
+    assert wire.stats()["bytes_per_message"] == len(FRAME)
+
+def test_msgpack_uses_compact_schema():
+    wire = Wire(MSGPACK)
+    data = wire.encode(FRAME)
+    
+    assert data[0] == FLAG_MSGPACK
+    payload = msgpack.unpackb(data[1:])
+    assert payload == {"i": 7, "u": 1, "n": "alice", "c": "hello", "r": "user", "t": 1714564800000}
+    assert wire.decode(data) == {**codec.loads(FRAME), "created_at": 1714564800000}
+    assert len(data) < len(FRAME) * 0.7
+
+def test_created_at_keeps_offsets_and_odd_values():
+    assert epoch_ms("2024-05-01 14:00:00+02:00") == 1714564800000
+    assert epoch_ms("None") == "None"
+
+def test_deflate_only_above_threshold_and_when_smaller():
+    wire = Wire(compress=True, threshold=100)
+    short = codec.dumps({"content": "hi"})
+    long = codec.dumps({"content": "ha" * 500})
+    
+    assert wire.encode(short) == short
+    data = wire.encode(long)
+    assert data[0] == FLAG_DEFLATE
+    assert zlib.decompress(data[1:]).decode() == long
+    assert wire.decode(data) == {"content": "ha" * 500}
+    assert wire.stats()["deflated"] == 1
+
+def test_deflated_frames_may_not_inflate_past_the_limit():
+    wire = Wire(max_frame_bytes=1000)
+    bomb = bytes([FLAG_DEFLATE]) + zlib.compress(codec.dumps({"content": "a" * 100000}).encode(), 9)
+    fits = bytes([FLAG_DEFLATE]) + zlib.compress(codec.dumps({"content": "a" * 900}).encode())
+    
+    with pytest.raises(ValueError):
+        wire.decode(bomb)
+    assert wire.decode(fits) == {"content": "a" * 900}
+
+def test_frame_is_encoded_once_per_wire():
+    wires = WireRegistry()
+    wire = wires.get(MSGPACK, True)
+    assert wires.get(MSGPACK, True) is wire
+    
+    first = wire.encode(FRAME)
+    assert wire.encode(FRAME) is first
+    assert set(wires.stats()) == {"msgpack+deflate"}
+    assert wires.stats()["msgpack+deflate"]["frames"] == 1
+
+def test_websocket_msgpack_encoding(client, db_session):
+    from app.auth import create_access_token
+    crud.create_user(db_session, "packer", "packer@example.com", "hashedpw")
+    room = crud.create_chatroom(db_session, "Binary Room")
+    token = create_access_token({"sub": "packer"})
+    wire = Wire(MSGPACK)
+    
+    with client.websocket_connect(f"/ws/{room.id}?token={token}&encoding=msgpack") as websocket:
+        joined = wire.decode(websocket.receive_bytes())
+        websocket.send_bytes(bytes([FLAG_MSGPACK]) + msgpack.packb({"c": "packed"}))
+        echoed = wire.decode(websocket.receive_bytes())
+        websocket.send_text('{"content": "text still works"}')
+        assert wire.decode(websocket.receive_bytes())["content"] == "text still works"
+    
+    assert joined["type"] == "presence" and joined["count"] == 1
+    assert echoed["content"] == "packed"
+    assert echoed["username"] == "packer"
+    assert isinstance(echoed["created_at"], int)
+    assert "msgpack" in client.get("/metrics").json()["wire"]
+
+def test_websocket_rejects_frames_without_usable_content(client, db_session, monkeypatch):
+    from app import main
+    from app.auth import create_access_token
+    monkeypatch.setattr(main, "MESSAGE_MAX_LENGTH", 10)
+    crud.create_user(db_session, "packer", "packer@example.com", "hashedpw")
+    room = crud.create_chatroom(db_session, "Strict Room")
+    token = create_access_token({"sub": "packer"})
+    
+    with client.websocket_connect(f"/ws/{room.id}?token={token}") as websocket:
+        assert websocket.receive_json()["type"] == "presence"
+        websocket.send_bytes(bytes([FLAG_MSGPACK]) + msgpack.packb({"x": 1}))
+        for frame in ({"content": None}, {"content": 5}, {"content": " "}, {"content": "x" * 11}, [1]):
+            websocket.send_json(frame)
+        for _ in range(6):
+            assert websocket.receive_json()["type"] == "error"
+        websocket.send_json({"content": "fine"})
+        assert websocket.receive_json()["content"] == "fine"
+    
+    assert [m["content"] for m in client.get(f"/rooms/{room.id}/messages").json()] == ["fine"]
+
+def test_websocket_rejects_unknown_encoding(client, db_session):
+    from app.auth import create_access_token
+    crud.create_user(db_session, "packer", "packer@example.com", "hashedpw")
+    token = create_access_token({"sub": "packer"})
+    
+    with pytest.raises(Exception):
+        with client.websocket_connect(f"/ws/1?token={token}&encoding=xml"):
+            pass